@@ -0,0 +1,264 @@
+import asyncio
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import sqlite3
+import time
+
+from .errors import *
+
+logger = logging.getLogger(__name__)
+
+
+# Per-worker share accounting: shares submitted under each worker (account)
+# name are counted by outcome, and the difficulty of its accepted shares is
+# summed over sliding windows to estimate its hashrate.
+#
+# Recording a share is O(1): a worker's difficulty is kept in a ring of
+# one-minute buckets, with a running sum per window that's only adjusted as
+# buckets roll over. Stats are written to a SQLite database in batches, every
+# `flush_interval` seconds, by a thread of their own; share counts are added
+# to the totals already in the database (so they carry across restarts),
+# hashrates and last share times replace what's there. Workers that haven't
+# sent a share for longer than the longest window are dropped from memory
+# once that's written.
+
+# seconds per bucket, and the windows hashrates are estimated over (in
+# buckets) with the database columns they're written to
+BUCKET_SECONDS = 60
+WINDOWS = ((5, 'hashrate_5m'), (15, 'hashrate_15m'), (60, 'hashrate_1h'))
+BUCKETS = max(w for w, _ in WINDOWS)
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS worker_shares (
+    proxy TEXT NOT NULL,
+    worker TEXT NOT NULL,
+    accepted INTEGER NOT NULL DEFAULT 0,
+    rejected INTEGER NOT NULL DEFAULT 0,
+    stale INTEGER NOT NULL DEFAULT 0,
+    duplicate INTEGER NOT NULL DEFAULT 0,
+    last_share REAL,
+    {},
+    updated REAL,
+    PRIMARY KEY (proxy, worker)
+)""".format(',\n    '.join('{} REAL'.format(column) for _, column in WINDOWS))
+
+INSERT = "INSERT OR IGNORE INTO worker_shares (proxy, worker) VALUES (?, ?)"
+UPDATE = """UPDATE worker_shares SET
+    accepted = accepted + ?, rejected = rejected + ?, stale = stale + ?, duplicate = duplicate + ?,
+    last_share = ?, {}, updated = ?
+    WHERE proxy = ? AND worker = ?""".format(', '.join('{} = ?'.format(column) for _, column in WINDOWS))
+
+
+class WorkerShareStats(object):
+    # a worker's share counts (since they were last written) and the summed
+    # difficulty of its accepted shares per bucket; times are event loop
+    # times
+    __slots__ = ('accepted', 'rejected', 'stale', 'duplicate', 'since', 'last_share',
+                 'bucket', 'buckets', 'sums')
+
+    def __init__(self, now):
+        self.accepted = 0
+        self.rejected = 0
+        self.stale = 0
+        self.duplicate = 0
+        self.since = now
+        self.last_share = now
+
+        self.bucket = int(now // BUCKET_SECONDS)
+        self.buckets = array('d', bytes(8 * BUCKETS))
+        self.sums = array('d', bytes(8 * len(WINDOWS)))
+
+    def advance(self, now):
+        # rolls the ring over to the current bucket; buckets leaving a window
+        # come off its sum
+        bucket = int(now // BUCKET_SECONDS)
+        if bucket <= self.bucket:
+            return
+
+        buckets, sums = self.buckets, self.sums
+        for b in range(self.bucket + 1, min(bucket, self.bucket + BUCKETS) + 1):
+            for i, (window, _) in enumerate(WINDOWS):
+                sums[i] -= buckets[(b - window) % BUCKETS]
+            buckets[b % BUCKETS] = 0.0
+        if bucket - self.bucket >= BUCKETS:
+            # everything's rolled out; no rounding errors left behind
+            for i in range(len(WINDOWS)):
+                sums[i] = 0.0
+        self.bucket = bucket
+
+    def record_accepted(self, now, difficulty):
+        self.advance(now)
+        self.accepted += 1
+        self.last_share = now
+        if difficulty:
+            self.buckets[self.bucket % BUCKETS] += difficulty
+            sums = self.sums
+            for i in range(len(WINDOWS)):
+                sums[i] += difficulty
+
+    def snapshot(self, now):
+        # what's to be written (see `get_row`), taking the share counts
+        self.advance(now)
+        snapshot = (now, self.accepted, self.rejected, self.stale, self.duplicate,
+                    self.last_share, self.since, self.bucket, tuple(self.sums))
+        self.accepted = self.rejected = self.stale = self.duplicate = 0
+        return snapshot
+
+
+def get_row(snapshot, wall_offset, hashes_per_difficulty):
+    # a worker's counts, last share time (wall clock time, being event loop
+    # time plus `wall_offset`) and hashes per second over each window
+    # (windows reaching back before the worker was first seen only count
+    # the time since), as written to the database
+    now, accepted, rejected, stale, duplicate, last_share, since, bucket, sums = snapshot
+    row = [accepted, rejected, stale, duplicate, last_share + wall_offset]
+
+    if hashes_per_difficulty is None:
+        return row + [None] * len(WINDOWS)
+
+    current = now - bucket * BUCKET_SECONDS
+    seen = max(now - since, 1.0)
+    for s, (window, _) in zip(sums, WINDOWS):
+        row.append(max(s, 0.0) * hashes_per_difficulty / min((window - 1) * BUCKET_SECONDS + current, seen))
+    return row
+
+
+class ShareStats(object):
+    # workers snapshotted per event loop iteration when writing stats
+    collect_slice = 4096
+
+    def __init__(self, path, proxy_name, diff1_target=None, flush_interval=60.0, max_workers=65536):
+        self.path = path
+        self.proxy_name = proxy_name
+        self.flush_interval = flush_interval
+        # workers tracked at once; shares from any more aren't accounted
+        # (just counted, and logged on the next flush) until others go quiet
+        self.max_workers = max(int(max_workers), 1)
+        self.untracked = 0
+        # hashes it takes, on average, to find a share of difficulty 1
+        self.hashes_per_difficulty = 2 ** 256 / diff1_target if diff1_target else None
+
+        self.workers = {}
+
+        self.flush_handle = None
+        self.flush_future = None
+
+        # the database is only ever used from this one thread (after it's
+        # set up here)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            # worker processes (`processes` > 1) share the database
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(SCHEMA)
+            self.db.commit()
+        except sqlite3.Error as e:
+            self.executor.shutdown(wait=False)
+            raise ConfigurationError("Unable to open share stats database {} ({})".format(path, e))
+
+    def get_worker(self, name, now):
+        # `None` if there's no room for another worker
+        stats = self.workers.get(name)
+        if stats is None:
+            if len(self.workers) >= self.max_workers:
+                self.untracked += 1
+                return None
+            stats = self.workers[name] = WorkerShareStats(now)
+            self.schedule_flush()
+        return stats
+
+    def record_accepted(self, name, difficulty):
+        now = asyncio.get_event_loop().time()
+        stats = self.get_worker(name, now)
+        if stats is not None:
+            stats.record_accepted(now, difficulty)
+
+    def record_rejected(self, name, error=None):
+        # shares turned away, by the proxy or the pool; those the proxy
+        # refuses as stale (their job's gone) or duplicates are counted apart
+        now = asyncio.get_event_loop().time()
+        stats = self.get_worker(name, now)
+        if stats is None:
+            return
+        stats.last_share = now
+        if isinstance(error, JSONRPCJobNotFound):
+            stats.stale += 1
+        elif isinstance(error, JSONRPCDuplicateShare):
+            stats.duplicate += 1
+        else:
+            stats.rejected += 1
+
+    def schedule_flush(self):
+        # a flush that's already queued (or running) will pick this up
+        if self.flush_handle is None and self.flush_future is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        if not self.workers:
+            return
+
+        self.flush_future = asyncio.ensure_future(self.write_batch())
+        self.flush_future.add_done_callback(self.flushed)
+
+    async def write_batch(self):
+        # takes every worker's stats, for the writer thread to turn into
+        # rows, and forgets workers that have gone quiet. Only snapshots are
+        # taken on the event loop, a slice of workers at a time, so there's
+        # no stall however many workers there are
+        loop = asyncio.get_event_loop()
+        wall_offset = time.time() - loop.time()
+
+        workers = list(self.workers.items())
+        snapshots = []
+        for start in range(0, len(workers), self.collect_slice):
+            if start:
+                await asyncio.sleep(0)
+
+            now = loop.time()
+            idle_since = now - BUCKETS * BUCKET_SECONDS
+            for name, stats in workers[start:start + self.collect_slice]:
+                snapshot = stats.snapshot(now)
+                snapshots.append((name, snapshot))
+                if snapshot[5] < idle_since:
+                    del self.workers[name]
+
+        if self.untracked:
+            logger.warning("{} shares from workers over the {} tracked weren't accounted".format(
+                self.untracked, self.max_workers))
+            self.untracked = 0
+
+        await loop.run_in_executor(self.executor, self.write, snapshots, wall_offset)
+
+    def flushed(self, fut):
+        self.flush_future = None
+        if fut.exception():
+            logger.warning("unable to write share stats to {} ({})".format(self.path, fut.exception()))
+
+        # workers still mining have their hashrates written again
+        if self.workers:
+            self.schedule_flush()
+
+    def write(self, snapshots, wall_offset):
+        # runs in the writer thread; never on the event loop. A batch is a
+        # single transaction
+        updated = time.time()
+        keys = [(self.proxy_name, name) for name, _ in snapshots]
+        rows = [get_row(snapshot, wall_offset, self.hashes_per_difficulty) + [updated, self.proxy_name, name]
+                for name, snapshot in snapshots]
+        with self.db:
+            self.db.executemany(INSERT, keys)
+            self.db.executemany(UPDATE, rows)
+
+    async def close(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.flush_future is not None:
+            await asyncio.wait([self.flush_future])
+        self.flush()
+        if self.flush_future is not None:
+            await asyncio.wait([self.flush_future])
+
+        await asyncio.get_event_loop().run_in_executor(self.executor, self.db.close)
+        self.executor.shutdown()
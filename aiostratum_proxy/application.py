@@ -7,7 +7,14 @@ import yaml
 
 from . import app_version, logger as module_logger
 from .errors import *
-from .utils import import_from_module
+from .capture import TrafficCapture
+from .codec import json_backend
+from .health import BlockArrivals, PoolHealth
+from .metrics import MetricsServer, ProxyMetrics, registry
+from .multiprocess import WorkerProcesses, get_coordinator_settings
+from .profiling import DEFAULT_OUTPUT, install_toggle_signal, profiler
+from .supervisor import PoolSupervisor
+from .utils import get_pool_name, get_setting, import_from_module
 
 
 logger = logging.getLogger(__name__)
@@ -22,6 +29,54 @@ class Proxy(object):
         if isinstance(self.pool_settings, dict):
             self.pool_settings = [self.pool_settings]
 
+        self.workers = None
+        self.pool = None
+        self.pool_class = None
+        self.standby_pools = []
+        self.last_failover_time = None
+        self.supervisor = None
+
+        # pool health is measured for every configured pool, and (optionally)
+        # used to pick which pool to mine on
+        self.pool_health = {get_pool_name(s): PoolHealth(get_pool_name(s)) for s in self.pool_settings}
+        self.block_arrivals = BlockArrivals()
+
+        self.pool_selection = self.settings.get('pool_selection') or 'ordered'
+        if self.pool_selection not in ('ordered', 'latency'):
+            logger.warning("* {} proxy invalid 'pool_selection' setting ({}), defaulting to 'ordered' instead".format(
+                self.name, self.pool_selection))
+            self.pool_selection = 'ordered'
+        self.pool_selection_interval = get_setting(
+            self.settings, 'pool_selection_interval', 30, cast=float, minimum=1, log_prefix='* {} proxy'.format(self.name))
+        self.pool_selection_hysteresis = get_setting(
+            self.settings, 'pool_selection_hysteresis', 0.2, cast=float, minimum=0, log_prefix='* {} proxy'.format(self.name))
+        self.pool_selector_fut = None
+        self.better_pool = None
+        self.better_pool_count = 0
+        self.last_pool_switch = 0
+
+        # extra upstream sessions to the active pool, each with an
+        # extra_nonce1 (nonce space) and submit window of its own, opened as
+        # the workers outgrow a single session
+        self.pool_sessions = get_setting(
+            self.settings, 'pool_sessions', 1, minimum=1, log_prefix='* {} proxy'.format(self.name))
+        self.pool_session_idle_timeout = get_setting(
+            self.settings, 'pool_session_idle_timeout', 60, cast=float, minimum=0, log_prefix='* {} proxy'.format(self.name))
+        self.sessions = []
+        self.session_count = 0
+        self.session_opening = None
+
+        # multi-process mode; this process becomes the coordinator of
+        # `processes` worker processes accepting the miner connections
+        self.processes = get_setting(
+            self.settings, 'processes', 1, minimum=1, log_prefix='* {} proxy'.format(self.name))
+        self.worker_processes = None
+
+        self.metrics = ProxyMetrics(self)
+
+        # optionally record every worker and pool JSON-RPC line to a file
+        self.capture = None
+
     async def startup(self):
         try:
             wklass = import_from_module(self.settings.get('worker_class') or '')
@@ -29,39 +84,257 @@ class Proxy(object):
         except (ModuleNotFoundError, AttributeError) as e:
             raise ConfigurationError(e)
 
+        if profiler.enabled:
+            profiler.instrument()
+
         logger.info("* {} proxy starting".format(self.name))
 
-        self.workers = wklass(self, self.settings.get('listen'), **self.settings)
-        self.pool = pklass(self, self.pool_settings, **self.settings)
+        registry.register(self.metrics)
+
+        if self.settings.get('capture'):
+            self.capture = TrafficCapture(self.settings['capture'])
+            logger.info("* {} proxy capturing traffic to {}".format(self.name, self.settings['capture']))
+
+        if self.processes > 1:
+            self.worker_processes = WorkerProcesses(self, self.processes)
+            worker_settings = get_coordinator_settings(self.settings, self.processes)
+        else:
+            worker_settings = self.settings
+
+        self.supervisor = PoolSupervisor(self)
+        self.workers = wklass(self, worker_settings.get('listen'), **worker_settings)
+        self.pool_class = pklass
+
+        if self.settings.get('hot_standby', False) and len(self.pool_settings) > 1:
+            # every pool gets its own connection, the first one active and
+            # the rest kept connected as standbys
+            self.pool = pklass(self, self.pool_settings[:1], **self.settings)
+            for n, pool_settings in enumerate(self.pool_settings[1:], 1):
+                self.standby_pools.append(pklass(self, [pool_settings], **self.get_connection_settings(n)))
+
+            logger.info("* {} proxy keeping {} hot standby pool connection(s)".format(self.name, len(self.standby_pools)))
+        else:
+            self.pool = pklass(self, list(self.pool_settings), **self.settings)
 
         await self.workers.initialize()
+        self.supervisor.start()
         await self.workers.start_listening()
 
+        if self.worker_processes:
+            self.worker_processes.start(self.workers.servers[0].sockets[0].getsockname()[1])
+
+        if self.pool_selection == 'latency':
+            self.pool_selector_fut = asyncio.ensure_future(self.pool_selector())
+
         logger.info("* {} proxy started, waiting for worker connections".format(self.name))
 
+    def get_connection_settings(self, suffix):
+        settings = dict(self.settings)
+        if settings.get('share_journal'):
+            # shares are only valid on the pool (and session) they were found
+            # for, so each pool connection keeps a journal of its own
+            settings['share_journal'] = '{}.{}'.format(settings['share_journal'], suffix)
+        return settings
+
+    def get_pool_health(self, pool_settings):
+        name = get_pool_name(pool_settings)
+        health = self.pool_health.get(name)
+        if health is None:
+            health = self.pool_health[name] = PoolHealth(name)
+        return health
+
+    def get_pool_scores(self):
+        now = asyncio.get_event_loop().time()
+        return sorted([(h.score(now), n) for n, h in self.pool_health.items()])
+
+    def get_ready_standby_pools(self):
+        return [p for p in self.standby_pools if p.connected and p.is_ready()]
+
+    async def promote(self, standby):
+        # make a hot standby pool the active one, moving the workers onto it
+        previous = self.pool
+
+        self.standby_pools.remove(standby)
+        self.standby_pools.append(previous)
+        self.pool = self.workers.pool = standby
+        self.last_pool_switch = asyncio.get_event_loop().time()
+
+        await standby.activate(previous)
+
+    async def failover(self, failed_pool, started):
+        # switch the workers over to a connected, ready hot standby pool (if
+        # there is one) rather than disconnecting them all
+        standbys = self.get_ready_standby_pools()
+        if not standbys:
+            return False
+
+        standby = standbys[0]
+        if self.pool_selection == 'latency':
+            now = asyncio.get_event_loop().time()
+            standby = min(standbys, key=lambda p: p.health.score(now))
+
+        await self.promote(standby)
+        self.metrics.failovers.inc()
+
+        self.last_failover_time = asyncio.get_event_loop().time() - started
+        logger.warning("* {} proxy failed over from pool '{}' to '{}' in {:.1f}ms".format(
+            self.name, failed_pool.name, standby.name, self.last_failover_time * 1000))
+
+        return True
+
+    async def pool_selector(self):
+        while True:
+            await asyncio.sleep(self.pool_selection_interval)
+            try:
+                await self.select_pool()
+            except Exception:
+                logger.exception("* {} proxy pool selection failed".format(self.name))
+
+    async def select_pool(self):
+        now = asyncio.get_event_loop().time()
+
+        logger.info("* {} proxy pool scores: {}".format(self.name, ", ".join(
+            ["'{}' {:.1f}ms{}".format(n, s * 1000, ' (active)' if n == self.pool.name else '')
+             for s, n in self.get_pool_scores()])))
+        for n, h in self.pool_health.items():
+            logger.debug("* {} proxy pool '{}': {}".format(self.name, n, h))
+
+        # switching pools without disconnecting workers needs a standby
+        # that's ready to go
+        standbys = self.get_ready_standby_pools()
+        if not standbys or not self.pool.is_ready():
+            self.better_pool, self.better_pool_count = None, 0
+            return
+
+        best = min(standbys, key=lambda p: p.health.score(now))
+
+        # hysteresis; the standby needs to be clearly better, several times
+        # in a row, before we switch over (and pools don't flap back and forth)
+        if best.health.score(now) < self.pool.health.score(now) * (1 - self.pool_selection_hysteresis):
+            if best is self.better_pool:
+                self.better_pool_count += 1
+            else:
+                self.better_pool, self.better_pool_count = best, 1
+        else:
+            self.better_pool, self.better_pool_count = None, 0
+
+        if self.better_pool_count >= 3:
+            logger.warning("* {} proxy switching from pool '{}' to better scoring '{}'".format(
+                self.name, self.pool.name, best.name))
+            self.better_pool, self.better_pool_count = None, 0
+            await self.promote(best)
+
+    def can_open_session(self):
+        # not while the pool's being backed off after a failed attempt
+        return len(self.sessions) + 1 < self.pool_sessions and \
+            asyncio.get_event_loop().time() >= self.pool.health.retry_at
+
+    def open_session(self):
+        # opens another upstream session (one at a time); the returned future
+        # is done once it's ready, or has failed to connect
+        if self.session_opening is None:
+            self.session_opening = asyncio.ensure_future(self.start_session())
+        return self.session_opening
+
+    async def start_session(self):
+        self.session_count += 1
+        session = self.pool_class(
+            self, [dict(self.pool.connection_settings)], **self.get_connection_settings('s{}'.format(self.session_count)))
+
+        try:
+            await session.connect()
+            await session.initialize()
+            session.set_ready()
+        except Exception as e:
+            delay = session.schedule_retry()
+            logger.warning("* {} proxy unable to open another session to pool '{}' ({}), retrying in {:.1f}s".format(
+                self.name, session.name, str(e) or type(e).__name__, delay))
+            await session.close()
+            return None
+        finally:
+            self.session_opening = None
+
+        self.workers.add_session(session)
+        self.sessions.append(session)
+
+        logger.info("* {} proxy opened session {} to pool '{}' ({} workers on {} sessions)".format(
+            self.name, len(self.sessions) + 1, session.name, len(self.workers.clients), len(self.sessions) + 1))
+
+        return session
+
+    async def remove_session(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+            logger.info("* {} proxy closed a session to pool '{}' ({} left)".format(
+                self.name, session.name, len(self.sessions) + 1))
+        await self.workers.remove_session(session)
+
+    async def close_session(self, session):
+        await session.close()
+        await self.remove_session(session)
+
+    async def close_sessions(self):
+        for session in list(self.sessions):
+            await self.close_session(session)
+
     async def shutdown(self):
         logger.info("* {} proxy stopping".format(self.name))
 
-        await self.workers.close()
-        await self.pool.close()
+        if self.pool_selector_fut:
+            self.pool_selector_fut.cancel()
+
+        # nothing's reconnected while shutting down
+        if self.supervisor:
+            await self.supervisor.stop()
+
+        if self.worker_processes:
+            await self.worker_processes.stop()
+
+        if self.workers:
+            await self.workers.close()
+        if self.pool:
+            await self.pool.close()
+        for standby in self.standby_pools:
+            await standby.close()
+        await self.close_sessions()
+
+        if self.capture is not None:
+            await self.capture.close()
+
+        registry.unregister(self.metrics)
 
         logger.info("* {} proxy stopped".format(self.name))
 
 
 class Application(object):
-    proxies = {}
-    config = {}
-
     def __init__(self, config_file):
         self.config_file = config_file
 
+        self.proxies = {}
+        self.config = {}
+        self.metrics_server = None
+
     async def startup(self):
         try:
             with open(self.config_file, 'r') as cf:
-                self.config = yaml.load(cf.read())
+                self.config = yaml.safe_load(cf.read())
         except Exception:
             raise ConfigurationError("Unable to load configuration file")
 
+        metrics_settings = self.config.get('metrics')
+        if metrics_settings:
+            if not isinstance(metrics_settings, dict):
+                # ie. `metrics: true`; serve them on the default address
+                metrics_settings = {}
+
+            # started first, so connections get their bytes counted
+            self.metrics_server = MetricsServer(
+                metrics_settings.get('host') or '127.0.0.1', get_setting(metrics_settings, 'port', 9100, minimum=0))
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                raise ServerAddressInUse(e)
+
         for n, settings in enumerate(self.config.get('proxies', []), 1):
             name = settings.pop('name', '') or 'Proxy {}'.format(n)
             proxy = Proxy(name=name, **settings)
@@ -80,26 +353,12 @@ class Application(object):
         await asyncio.gather(*[p.shutdown() for p in self.proxies.values()])
         self.proxies.clear()
 
+        if self.metrics_server:
+            await self.metrics_server.close()
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-g", "--generate-config", action="store_true",
-                        help="output a starting config file template")
-    parser.add_argument("-c", "--config", dest="config_file",
-                        help="path to configuration file")
-    parser.add_argument("-q", "--quiet", action="store_true",
-                        help="minimum output verbosity (>=WARNING)")
-    parser.add_argument("-l", "--loud", action="store_true",
-                        help="maximum output verbosity (>=DEBUG)")
-    parser.add_argument("-v", "--version", action="version", version=app_version)
-    args = parser.parse_args()
-
-    if args.generate_config:
-        from .utils import output_config
-        output_config()
-        return
 
-    if args.loud:
+def setup_logging(loud=False, quiet=False):
+    if loud:
         logf = logging.Formatter('%(asctime)s %(levelname)8s - %(message)s (%(name)s:%(lineno)d)')
     else:
         logf = logging.Formatter('%(asctime)s %(levelname)8s - %(message)s')
@@ -112,18 +371,52 @@ def main():
     module_logger.setLevel(logging.INFO)
     jsonrpc_logger.setLevel(logging.INFO)
 
-    if args.loud:
+    if loud:
         logger.info('* Verbose mode enabled')
         module_logger.setLevel(logging.DEBUG)
         jsonrpc_logger.setLevel(logging.DEBUG)
-    elif args.quiet:
+    elif quiet:
         logger.info('* Quiet mode enabled')
         module_logger.setLevel(logging.WARNING)
         jsonrpc_logger.setLevel(logging.WARNING)
 
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-g", "--generate-config", action="store_true",
+                        help="output a starting config file template")
+    parser.add_argument("-c", "--config", dest="config_file",
+                        help="path to configuration file")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="minimum output verbosity (>=WARNING)")
+    parser.add_argument("-l", "--loud", action="store_true",
+                        help="maximum output verbosity (>=DEBUG)")
+    parser.add_argument("-p", "--profile", metavar="FILE", nargs="?", const=DEFAULT_OUTPUT,
+                        help="profile the event loop (handler/hook timings, loop lag, sampled stacks), "
+                             "reporting to FILE (default: {}); SIGUSR1 toggles profiling at runtime".format(
+                                 DEFAULT_OUTPUT))
+    parser.add_argument("--profile-interval", metavar="SECONDS", type=float, default=60,
+                        help="seconds between profiling reports (default: 60)")
+    parser.add_argument("-v", "--version", action="version", version=app_version)
+    args = parser.parse_args()
+
+    if args.generate_config:
+        from .utils import output_config
+        output_config()
+        return
+
+    setup_logging(loud=args.loud, quiet=args.quiet)
+    logger.info('* Stratum messages are JSON encoded with {}'.format(json_backend))
+
     app = Application(args.config_file)
 
     loop = asyncio.get_event_loop()
+
+    profiler.interval = args.profile_interval
+    if args.profile:
+        profiler.enable(args.profile)
+    install_toggle_signal()
+
     try:
         loop.run_until_complete(app.startup())
         running = True
@@ -139,4 +432,5 @@ def main():
             pass
 
     loop.run_until_complete(app.shutdown())
+    loop.run_until_complete(profiler.close())
     loop.close()
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+
+class AuthorizationCache(object):
+    # A pool connection's authorization results, by the account name and
+    # password sent to the pool; a denial never replaces another password's
+    # grant, so a miner authorizing someone else's account with the wrong
+    # password can't lock them out.
+    #
+    # Bounded to `capacity` accounts (least recently used are dropped
+    # first); granted authorizations are trusted for `ttl` seconds, and
+    # denied ones remembered for `denied_ttl` seconds, so a miner with bad
+    # credentials doesn't get them sent to the pool over and over, but can
+    # still get in once they're fixed. Accounts that drop out are simply
+    # authorized again, the next time they're used.
+
+    def __init__(self, capacity=65536, ttl=3600, denied_ttl=60):
+        self.capacity = max(int(capacity), 1)
+        self.ttl = ttl
+        self.denied_ttl = denied_ttl
+
+        # (account name, password): (result, expiry time)
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, account_name, account_password, now):
+        # True or False as the pool said, or `None` if it needs asking
+        key = (account_name, account_password)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        result, expires = entry
+        if now >= expires:
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return result
+
+    def set(self, account_name, account_password, result, now):
+        key = (account_name, account_password)
+        self.entries[key] = (result, now + (self.ttl if result else self.denied_ttl))
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class MinerAccounts(OrderedDict):
+    # The credentials the pool has granted workers (miner account name:
+    # password); bounded to `capacity` accounts, least recently authorized
+    # are dropped first.
+
+    def __init__(self, capacity=65536):
+        super().__init__()
+        self.capacity = max(int(capacity), 1)
+
+    def add(self, account_name, account_password):
+        self[account_name] = account_password
+        self.move_to_end(account_name)
+        if len(self) > self.capacity:
+            self.popitem(last=False)
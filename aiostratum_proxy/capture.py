@@ -0,0 +1,163 @@
+import asyncio
+from collections import namedtuple
+import logging
+import struct
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+# Traffic capture: every JSON-RPC line a proxy's worker and pool connections
+# read or write, timestamped, in a compact binary log (see `benchmarks/
+# bench_replay.py` to replay one).
+#
+# The file starts with a header (magic, format version, wall clock time the
+# capture started), followed by zlib compressed blocks, each a batch of
+# records; a record is a fixed size header (seconds since the capture
+# started, connection id, side and event, payload length) and its payload.
+# Records are batched up in memory and compressed and written by a thread
+# every `flush_interval` seconds, so the event loop never waits on the disk.
+
+MAGIC = b'ASPC'
+VERSION = 1
+
+HEADER = struct.Struct('<4sBd')
+BLOCK = struct.Struct('<I')
+RECORD = struct.Struct('<dIBI')
+
+SIDE_WORKER = 0
+SIDE_POOL = 1
+SIDES = {'worker': SIDE_WORKER, 'pool': SIDE_POOL}
+
+# data read from / written to the connection, connection opened (payload is
+# the peer's address) and closed
+EVENT_IN = 0
+EVENT_OUT = 1
+EVENT_OPEN = 2
+EVENT_CLOSE = 3
+
+CaptureRecord = namedtuple('CaptureRecord', 'time connection side event data')
+
+
+class TrafficCapture(object):
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self.started = asyncio.get_event_loop().time()
+        self.connection_count = 0
+
+        self.pending = bytearray()
+        self.flush_handle = None
+        self.flush_future = None
+
+        with open(self.path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, time.time()))
+
+    def open_connection(self, side, peername):
+        # returns the id the connection's records are captured under
+        self.connection_count += 1
+        self.record(self.connection_count, SIDES[side], EVENT_OPEN, str(peername).encode())
+        return self.connection_count
+
+    def record(self, connection_id, side, event, data=b''):
+        self.pending += RECORD.pack(
+            asyncio.get_event_loop().time() - self.started, connection_id, side | event << 1, len(data))
+        self.pending += data
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        # a flush that's already queued (or running) will pick this up
+        if self.flush_handle is None and self.flush_future is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        if not self.pending:
+            return
+
+        data, self.pending = bytes(self.pending), bytearray()
+        self.flush_future = asyncio.get_event_loop().run_in_executor(None, self.write, data)
+        self.flush_future.add_done_callback(self.flushed)
+
+    def flushed(self, fut):
+        self.flush_future = None
+        if fut.exception():
+            logger.warning("unable to write traffic capture {} ({})".format(self.path, fut.exception()))
+
+        # more may have come in while the batch was being written
+        if self.pending:
+            self.schedule_flush()
+
+    def write(self, data):
+        # runs in a thread; never on the event loop
+        block = zlib.compress(data)
+        with open(self.path, 'ab') as f:
+            f.write(BLOCK.pack(len(block)))
+            f.write(block)
+
+    async def close(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.flush_future is not None:
+            await asyncio.wait([self.flush_future])
+        if self.pending:
+            self.flush()
+            if self.flush_future is not None:
+                await asyncio.wait([self.flush_future])
+
+
+class CapturingWriter(object):
+    # stands in for a connection's StreamWriter, capturing data written
+    # (the connection closing is captured by its StratumStreamProtocol,
+    # whichever end closes it)
+    __slots__ = ('writer', 'capture', 'connection_id', 'side')
+
+    def __init__(self, writer, capture, connection_id, side):
+        self.writer = writer
+        self.capture = capture
+        self.connection_id = connection_id
+        self.side = side
+
+    def write(self, data):
+        self.capture.record(self.connection_id, self.side, EVENT_OUT, data.rstrip(b'\r\n'))
+        self.writer.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+def read_capture(path):
+    # returns (wall clock start time, generator of CaptureRecords); a block
+    # cut short (ie. the proxy was killed mid-write) ends the capture
+    f = open(path, 'rb')
+    header = f.read(HEADER.size)
+    if len(header) != HEADER.size:
+        f.close()
+        raise ValueError("{} is not a traffic capture".format(path))
+    magic, version, started = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        f.close()
+        raise ValueError("{} is not a traffic capture (or an unsupported version)".format(path))
+
+    def records():
+        with f:
+            while True:
+                size = f.read(BLOCK.size)
+                if len(size) != BLOCK.size:
+                    return
+                try:
+                    data = zlib.decompress(f.read(BLOCK.unpack(size)[0]))
+                except zlib.error:
+                    return
+
+                offset = 0
+                while offset < len(data):
+                    t, connection_id, flags, length = RECORD.unpack_from(data, offset)
+                    offset += RECORD.size
+                    yield CaptureRecord(t, connection_id, flags & 1, flags >> 1, data[offset:offset + length])
+                    offset += length
+
+    return started, records()
@@ -0,0 +1,303 @@
+import asyncio
+import json
+import logging
+
+from aiojsonrpc2.connection import Connection
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from .capture import EVENT_CLOSE, EVENT_IN
+from .errors import *
+
+logger = logging.getLogger(__name__)
+
+
+# Stratum line codec. Connections are `asyncio.Protocol`s rather than
+# StreamReaders: every complete line in a chunk of received data is split
+# off and decoded on the spot (leftovers of a partial line are the only
+# bytes ever copied into a buffer), and handed to the connection's `read`
+# through a queue - no readline round-trip through the event loop per line.
+#
+# JSON goes through orjson when it's installed (`pip install
+# aiostratum_proxy[speedups]`), falling back to the standard library for
+# anything orjson won't handle. orjson doesn't reject integers over 64 bits,
+# it turns them into (lossy) floats; messages with a float that big are
+# decoded again by the standard library, which keeps such integers exact
+# (and reads floats written out as such just the same).
+
+def json_loads(data):
+    return json.loads(str(data, 'utf-8'))
+
+
+def json_dumps(data):
+    return json.dumps(data).encode()
+
+
+def has_wide_float(value):
+    # whether there's a float at or past the edges of 64 bit integer range
+    # in a (decoded) list or dict; what orjson makes of integers it can't
+    # hold. The edges count too: orjson returns integers there as such, so
+    # a float of exactly -2 ** 63 is one just below it, rounded up
+    for item in value.values() if type(value) is dict else value:
+        item_type = type(item)
+        if item_type is float:
+            if not -2 ** 63 < item < 2 ** 64:
+                return True
+        elif item_type is list or item_type is dict:
+            if has_wide_float(item):
+                return True
+    return False
+
+
+def orjson_loads(data):
+    try:
+        message = orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json_loads(data)
+    if type(message) in (dict, list) and has_wide_float(message):
+        return json_loads(data)
+    return message
+
+
+def orjson_dumps(data):
+    try:
+        return orjson.dumps(data)
+    except TypeError:
+        return json_dumps(data)
+
+
+if orjson is not None:
+    json_backend, loads, dumps = 'orjson', orjson_loads, orjson_dumps
+else:
+    json_backend, loads, dumps = 'json', json_loads, json_dumps
+
+
+def encode_line(data):
+    return dumps(data) + b'\n'
+
+
+class StratumStreamProtocol(asyncio.Protocol):
+    # A connection's transport-facing end; also stands in for its reader.
+
+    # longest line accepted (StreamReader's default limit); longer ones
+    # get the connection closed
+    max_line_size = 65536
+    # reading is paused while this many decoded messages are waiting
+    max_queued = 1024
+
+    def __init__(self, connected_cb=None):
+        self.connected_cb = connected_cb
+
+        self._transport = None
+        self.buffer = bytearray()
+        # decoded messages, and how many of them have been read; a plain
+        # list is a fraction of an (even empty) deque's size, which adds up
+        # over tens of thousands of idle connections
+        self.messages = []
+        self.messages_read = 0
+        self.waiter = None
+        self.eof = False
+        self.reading_paused = False
+        self.writing_paused = False
+        self.drain_waiters = []
+
+        # optional byte counter (metrics) and traffic capture
+        self.bytes_counter = None
+        self.capture = None
+        self.capture_id = None
+        self.capture_side = None
+
+    def set_capture(self, capture, connection_id, side):
+        self.capture = capture
+        self.capture_id = connection_id
+        self.capture_side = side
+
+    def connection_made(self, transport):
+        self._transport = transport
+        if self.connected_cb is not None:
+            asyncio.ensure_future(self.connected_cb(self, StratumWriter(transport, self)))
+
+    def data_received(self, data):
+        if self.bytes_counter is not None:
+            self.bytes_counter.value += len(data)
+
+        buffered = bool(self.buffer)
+        if buffered:
+            self.buffer += data
+            data = self.buffer
+
+        pos = 0
+        with memoryview(data) as view:
+            while True:
+                end = data.find(b'\n', pos)
+                if end < 0:
+                    break
+                if end > pos:
+                    self.line_received(view[pos:end])
+                pos = end + 1
+
+        if buffered:
+            del self.buffer[:pos]
+        elif pos < len(data):
+            self.buffer += data[pos:]
+
+        if len(self.buffer) > self.max_line_size:
+            logger.warning("line too long ({} bytes) from {}, disconnecting".format(
+                len(self.buffer), self._transport.get_extra_info('peername')))
+            self.buffer.clear()
+            self._transport.close()
+
+        if self.messages:
+            self.wakeup()
+            if len(self.messages) - self.messages_read >= self.max_queued and not self.reading_paused:
+                self.reading_paused = True
+                self._transport.pause_reading()
+
+    def line_received(self, line):
+        if self.capture is not None:
+            self.capture.record(self.capture_id, self.capture_side, EVENT_IN, bytes(line).rstrip(b'\r'))
+
+        try:
+            message = loads(line)
+        except (ValueError, UnicodeDecodeError):
+            logger.debug('JSONRPC connection: invalid JSON data `{}`'.format(bytes(line)))
+            message = JSONRPCParseError()
+        self.messages.append(message)
+
+    def wakeup(self):
+        waiter = self.waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def eof_received(self):
+        self.eof = True
+        self.wakeup()
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.wakeup()
+
+        if self.capture is not None:
+            self.capture.record(self.capture_id, self.capture_side, EVENT_CLOSE)
+
+        for waiter in self.drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.drain_waiters = []
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        for waiter in self.drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.drain_waiters = []
+
+    async def drain(self):
+        if self.writing_paused and not self._transport.is_closing():
+            waiter = asyncio.get_event_loop().create_future()
+            self.drain_waiters.append(waiter)
+            await waiter
+
+    async def read_message(self):
+        # the next decoded message (a JSONRPCParseError instance for lines
+        # that aren't JSON), or `None` once the connection's closed
+        while not self.messages:
+            if self.eof:
+                return None
+            self.waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+
+        messages = self.messages
+        message = messages[self.messages_read]
+        messages[self.messages_read] = None
+        self.messages_read += 1
+        if self.messages_read == len(messages):
+            # all read; start over with an empty list
+            messages.clear()
+            self.messages_read = 0
+        elif self.messages_read >= self.max_queued:
+            # a connection that's never quite caught up; drop what's been read
+            del messages[:self.messages_read]
+            self.messages_read = 0
+
+        if self.reading_paused and len(messages) - self.messages_read <= self.max_queued // 2:
+            self.reading_paused = False
+            self._transport.resume_reading()
+        return message
+
+
+class StratumWriter(object):
+    # stands in for a connection's StreamWriter
+    __slots__ = ('transport', 'protocol')
+
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self.protocol = protocol
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def close(self):
+        self.transport.close()
+
+    def is_closing(self):
+        return self.transport.is_closing()
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    async def drain(self):
+        await self.protocol.drain()
+
+
+class StratumConnection(Connection):
+    # aiojsonrpc2's Connection, reading decoded messages off a
+    # StratumStreamProtocol (its `reader`)
+
+    def __init__(self, reader, writer):
+        # without aiojsonrpc2's `extra` dict; what's tracked per worker is
+        # kept in `worker` (see WorkerSession)
+        self.reader = reader
+        self.writer = writer
+        self.peername = reader._transport.get_extra_info('peername')
+        self.worker = None
+
+    async def read(self):
+        while True:
+            data = await self.reader.read_message()
+            if data is None:
+                await self.close()
+                raise JSONRPCNetworkDisconnection
+            if isinstance(data, JSONRPCError):
+                raise data
+
+            if isinstance(data, dict):
+                if self._handle_result(data):
+                    # a response to one of our requests, not a request
+                    continue
+            elif isinstance(data, list):
+                is_result = False
+                for _data in data:
+                    is_result = self._handle_result(_data) or is_result
+                if is_result:
+                    continue
+            else:
+                # numbers and strings aren't JSON-RPC
+                logger.debug('JSONRPC connection: invalid JSONRPC data `{}`'.format(data))
+                raise JSONRPCParseError
+
+            return data
+
+    async def send(self, data, wait=True):
+        self.writer.write(encode_line(data))
+        if wait:
+            await self.writer.drain()
@@ -49,3 +49,8 @@ class JSONRPCUnauthorizedWorker(JSONRPCError):
 class JSONRPCNotSubscribed(JSONRPCError):
     def __init__(self, msg=''):
         super().__init__(25, msg or "Not subscribed")
+
+
+class JSONRPCInvalidSolution(JSONRPCError):
+    def __init__(self, msg=''):
+        super().__init__(20, msg or "Invalid solution")
@@ -0,0 +1,128 @@
+from collections import OrderedDict
+import random
+
+from .pipeline import LatencyStats
+
+
+class PoolHealth(object):
+    # Rolling measurements for a single configured pool, boiled down to a
+    # score (in seconds, lower is better) used to rank pools.
+
+    # score for latency we haven't been able to measure yet
+    unknown_latency = 0.5
+    # a pool that's gone this long without a new job is suspect
+    notify_timeout = 300
+    # penalties (in seconds) for each consecutive connection failure, for a
+    # silent pool, and for a 100% reject/stale rate
+    failure_penalty = 1.0
+    silence_penalty = 1.0
+    reject_penalty = 1.0
+
+    def __init__(self, name):
+        self.name = name
+
+        self.connect_time = LatencyStats()
+        self.submit_rtt = LatencyStats()
+        self.job_delay = LatencyStats()
+
+        self.connected = False
+        self.connect_failures = 0
+        self.last_notify = None
+
+        # consecutive failed attempts at getting a connection to the pool
+        # ready (connected or not), and when it's next due to be tried
+        self.retries = 0
+        self.retry_at = 0
+
+        self.accepted = 0
+        self.rejected = 0
+        self.stale = 0
+
+        # exponentially weighted reject and stale rates (0.0 - 1.0)
+        self.reject_rate = 0.0
+        self.stale_rate = 0.0
+
+    def record_connect(self, elapsed):
+        self.connected = True
+        self.connect_failures = 0
+        self.connect_time.add(elapsed)
+
+    def record_connect_failure(self):
+        self.connected = False
+        self.connect_failures += 1
+
+    def record_disconnect(self):
+        self.connected = False
+
+    def record_ready(self):
+        self.retries = 0
+        self.retry_at = 0
+
+    def backoff(self, now, delay, max_delay):
+        # jittered exponential backoff; the delay doubles with every
+        # consecutive failure (up to `max_delay`) and is randomized between
+        # half and all of that, so the proxies (and connections) that lost a
+        # pool don't all come back to it at the same moment
+        self.retries += 1
+        delay = min(delay * 2 ** min(self.retries - 1, 32), max_delay)
+        delay = random.uniform(delay / 2, delay)
+        self.retry_at = now + delay
+        return delay
+
+    def record_notify(self, now, delay=None):
+        self.last_notify = now
+        if delay is not None:
+            self.job_delay.add(delay)
+
+    def record_share(self, rtt, accepted, stale=False, alpha=0.05):
+        self.submit_rtt.add(rtt)
+
+        if accepted:
+            self.accepted += 1
+        elif stale:
+            self.stale += 1
+        else:
+            self.rejected += 1
+
+        self.reject_rate += alpha * ((not accepted and not stale) - self.reject_rate)
+        self.stale_rate += alpha * (stale - self.stale_rate)
+
+    def score(self, now):
+        # latency is the connection time, the one measurement every pool
+        # gets alike: standbys never carry shares, so scoring the active
+        # pool on its submit round-trips (a different measurement, and a
+        # longer one) would always favour switching away from it
+        if self.connect_time.count:
+            latency = self.connect_time.ewma
+        else:
+            latency = self.unknown_latency
+
+        score = latency + (self.job_delay.ewma or 0.0)
+        score += (self.reject_rate + self.stale_rate) * self.reject_penalty
+        score += self.connect_failures * self.failure_penalty
+
+        if self.connected and self.last_notify is not None and now - self.last_notify > self.notify_timeout:
+            score += self.silence_penalty
+
+        return score
+
+    def __str__(self):
+        return "connect {}, rtt {}, job delay {}, {} accepted/{} rejected/{} stale, {} connect failures".format(
+            self.connect_time, self.submit_rtt, self.job_delay, self.accepted, self.rejected, self.stale, self.connect_failures)
+
+
+class BlockArrivals(object):
+    # Remembers when each new block (ie. previous block hash) was first seen
+    # on any pool, so each pool's job delivery can be compared to the fastest
+    def __init__(self, size=16):
+        self.size = size
+        self.blocks = OrderedDict()
+
+    def record(self, block, now):
+        # returns how long after the first pool this one delivered the block
+        first = self.blocks.get(block)
+        if first is None:
+            self.blocks[block] = first = now
+            while len(self.blocks) > self.size:
+                self.blocks.popitem(last=False)
+        return now - first
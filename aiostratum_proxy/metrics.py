@@ -0,0 +1,326 @@
+import asyncio
+from bisect import bisect_left
+from collections import OrderedDict
+import logging
+
+from .errors import *
+
+logger = logging.getLogger(__name__)
+
+
+# Metrics are plain counters and histograms kept on `__slots__` objects;
+# they're only ever updated from the event loop thread, so updating one is
+# an attribute increment - no locks, no allocations - and all the work of
+# formatting them (Prometheus text format) is left to whoever scrapes them.
+
+# latency buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# share rejections (by the proxy itself) by reason
+REJECT_REASONS = OrderedDict([
+    (JSONRPCDuplicateShare, 'duplicate'),
+    (JSONRPCJobNotFound, 'stale'),
+    (JSONRPCLowDifficultyShare, 'low_difficulty'),
+    (JSONRPCInvalidSolution, 'invalid_solution'),
+    (JSONRPCUnauthorizedWorker, 'unauthorized'),
+    (JSONRPCInvalidParams, 'invalid_params'),
+])
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram(object):
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # buckets are upper bounds (inclusive), the last one is +Inf
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(['{}="{}"'.format(k, escape_label(v)) for k, v in labels]) + '}'
+
+
+class MetricFamily(object):
+    # collects one metric's samples (across proxies) at render time
+    def __init__(self, name, kind, help_text):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.lines = []
+
+    def add(self, labels, value):
+        self.lines.append('{}{} {}'.format(self.name, format_labels(labels), value))
+
+    def add_histogram(self, labels, histogram):
+        cumulative = 0
+        for bound, count in zip(histogram.bounds, histogram.counts):
+            cumulative += count
+            self.lines.append('{}_bucket{} {}'.format(
+                self.name, format_labels(labels + [('le', repr(float(bound)))]), cumulative))
+        self.lines.append('{}_bucket{} {}'.format(
+            self.name, format_labels(labels + [('le', '+Inf')]), histogram.count))
+        self.lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), histogram.sum))
+        self.lines.append('{}_count{} {}'.format(self.name, format_labels(labels), histogram.count))
+
+    def render(self):
+        if not self.lines:
+            return []
+        return ['# HELP {} {}'.format(self.name, self.help_text),
+                '# TYPE {} {}'.format(self.name, self.kind)] + self.lines
+
+
+class ProxyMetrics(object):
+    # Everything measured for a single proxy.
+    __slots__ = (
+        'proxy',
+        'shares_accepted', 'shares_rejected', 'shares_stale', 'shares_absorbed', 'shares_refused',
+        'submit_rtt', 'submit_queue_wait', 'notify_fanout',
+        'pool_connects', 'pool_connect_failures', 'pool_disconnects', 'failovers',
+        'worker_bytes_in', 'worker_bytes_out', 'pool_bytes_in', 'pool_bytes_out',
+    )
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+        # pool responses to forwarded shares
+        self.shares_accepted = Counter()
+        self.shares_rejected = Counter()
+        self.shares_stale = Counter()
+        # shares meeting the worker's target but not the pool's (vardiff)
+        self.shares_absorbed = Counter()
+        # shares turned away by the proxy, by reason
+        self.shares_refused = OrderedDict([(r, Counter()) for r in list(REJECT_REASONS.values()) + ['other']])
+
+        self.submit_rtt = Histogram()
+        self.submit_queue_wait = Histogram()
+        self.notify_fanout = Histogram()
+
+        self.pool_connects = Counter()
+        self.pool_connect_failures = Counter()
+        self.pool_disconnects = Counter()
+        self.failovers = Counter()
+
+        self.worker_bytes_in = Counter()
+        self.worker_bytes_out = Counter()
+        self.pool_bytes_in = Counter()
+        self.pool_bytes_out = Counter()
+
+    def record_refused(self, error):
+        self.shares_refused[REJECT_REASONS.get(type(error), 'other')].inc()
+
+    def record_share(self, rtt, queue_wait, accepted, stale=False):
+        self.submit_rtt.observe(rtt)
+        self.submit_queue_wait.observe(queue_wait)
+        if accepted:
+            self.shares_accepted.inc()
+        elif stale:
+            self.shares_stale.inc()
+        else:
+            self.shares_rejected.inc()
+
+    def get_byte_counters(self, side):
+        # (in, out) for 'worker' or 'pool' connections
+        if side == 'worker':
+            return self.worker_bytes_in, self.worker_bytes_out
+        return self.pool_bytes_in, self.pool_bytes_out
+
+    def collect(self, families):
+        proxy = self.proxy
+        labels = [('proxy', proxy.name)]
+
+        workers = proxy.workers
+        families['workers'].add(labels, len(workers.clients) if workers else 0)
+        queued, backlogged = workers.get_send_queue_totals() if workers else (0, 0)
+        families['worker_send_buffer_bytes'].add(labels, queued)
+        families['workers_backlogged'].add(labels, backlogged)
+        families['pool_sessions'].add(labels, (len(proxy.sessions) + 1) if proxy.pool else 0)
+        families['pool_connected'].add(labels, int(bool(proxy.pool and proxy.pool.connected)))
+        families['standby_pools_ready'].add(labels, len(proxy.get_ready_standby_pools()))
+
+        for result, counter in (('accepted', self.shares_accepted), ('rejected', self.shares_rejected),
+                                ('stale', self.shares_stale)):
+            families['shares'].add(labels + [('result', result)], counter.value)
+        families['shares_absorbed'].add(labels, self.shares_absorbed.value)
+        for reason, counter in self.shares_refused.items():
+            families['shares_refused'].add(labels + [('reason', reason)], counter.value)
+
+        families['submit_rtt_seconds'].add_histogram(labels, self.submit_rtt)
+        families['submit_queue_wait_seconds'].add_histogram(labels, self.submit_queue_wait)
+        families['notify_fanout_seconds'].add_histogram(labels, self.notify_fanout)
+
+        families['pool_connects'].add(labels, self.pool_connects.value)
+        families['pool_connect_failures'].add(labels, self.pool_connect_failures.value)
+        families['pool_disconnects'].add(labels, self.pool_disconnects.value)
+        families['failovers'].add(labels, self.failovers.value)
+
+        for side in ('worker', 'pool'):
+            bytes_in, bytes_out = self.get_byte_counters(side)
+            families['bytes_received'].add(labels + [('side', side)], bytes_in.value)
+            families['bytes_sent'].add(labels + [('side', side)], bytes_out.value)
+
+
+class MetricsRegistry(object):
+    # The process' proxies' metrics, plus event loop lag.
+    def __init__(self):
+        self.proxies = OrderedDict()
+        self.loop_lag = Histogram()
+        self.loop_lag_max = 0.0
+
+        # byte counting wraps every connection's reader and writer, so it's
+        # only done when metrics are being served
+        self.enabled = False
+
+    def register(self, metrics):
+        self.proxies[metrics.proxy.name] = metrics
+
+    def unregister(self, metrics):
+        if self.proxies.get(metrics.proxy.name) is metrics:
+            del self.proxies[metrics.proxy.name]
+
+    def get_families(self):
+        families = OrderedDict()
+        for key, kind, help_text in (
+                ('workers', 'gauge', 'Connected workers'),
+                ('worker_send_buffer_bytes', 'gauge', "Bytes written to workers that their sockets haven't sent yet"),
+                ('workers_backlogged', 'gauge', 'Workers over the write buffer limit, skipped by broadcasts'),
+                ('pool_sessions', 'gauge', 'Upstream pool sessions workers are mining on'),
+                ('pool_connected', 'gauge', 'Whether the active pool is connected'),
+                ('standby_pools_ready', 'gauge', 'Hot standby pools ready to take over'),
+                ('shares', 'counter', 'Shares sent to the pool, by pool response'),
+                ('shares_absorbed', 'counter', "Shares meeting the worker's target but not the pool's"),
+                ('shares_refused', 'counter', 'Shares refused by the proxy, by reason'),
+                ('submit_rtt_seconds', 'histogram', 'Pool share submission round-trip time in seconds'),
+                ('submit_queue_wait_seconds', 'histogram', 'Time shares wait for the submit window in seconds'),
+                ('notify_fanout_seconds', 'histogram', 'Time from a pool job arriving to the last worker write in seconds'),
+                ('pool_connects', 'counter', 'Pool connections established'),
+                ('pool_connect_failures', 'counter', 'Failed pool connection attempts'),
+                ('pool_disconnects', 'counter', 'Pool disconnections'),
+                ('failovers', 'counter', 'Failovers to hot standby pools'),
+                ('bytes_received', 'counter', 'Bytes received, by connection side'),
+                ('bytes_sent', 'counter', 'Bytes sent, by connection side')):
+            suffix = '_total' if kind == 'counter' else ''
+            families[key] = MetricFamily('aiostratum_{}{}'.format(key, suffix), kind, help_text)
+        return families
+
+    def render(self):
+        families = self.get_families()
+        for metrics in list(self.proxies.values()):
+            metrics.collect(families)
+
+        lag = MetricFamily('aiostratum_event_loop_lag_seconds', 'histogram', 'Event loop scheduling lag in seconds')
+        lag.add_histogram([], self.loop_lag)
+        lag_max = MetricFamily('aiostratum_event_loop_lag_max_seconds', 'gauge', 'Largest event loop lag seen in seconds')
+        lag_max.add([], self.loop_lag_max)
+
+        lines = []
+        for family in list(families.values()) + [lag, lag_max]:
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class CountingWriter(object):
+    # stands in for a connection's StreamWriter, counting bytes written
+    __slots__ = ('writer', 'counter')
+
+    def __init__(self, writer, counter):
+        self.writer = writer
+        self.counter = counter
+
+    def write(self, data):
+        self.counter.value += len(data)
+        self.writer.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+class MetricsServer(object):
+    # Serves the registry's metrics at http://host:port/metrics, and
+    # measures event loop lag while it's at it.
+
+    # seconds between event loop lag measurements
+    lag_interval = 0.5
+
+    def __init__(self, host='127.0.0.1', port=9100, registry=registry):
+        self.host = host
+        self.port = port
+        self.registry = registry
+
+        self.server = None
+        self.lag_fut = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.registry.enabled = True
+        self.lag_fut = asyncio.ensure_future(self.measure_loop_lag())
+
+        logger.info("* metrics available at http://{}:{}/metrics".format(
+            self.host, self.server.sockets[0].getsockname()[1]))
+
+    async def close(self):
+        if self.lag_fut:
+            self.lag_fut.cancel()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def measure_loop_lag(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            lag = max(loop.time() - started - self.lag_interval, 0.0)
+            self.registry.loop_lag.observe(lag)
+            if lag > self.registry.loop_lag_max:
+                self.registry.loop_lag_max = lag
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # the headers aren't needed
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if not line or line in (b'\r\n', b'\n'):
+                    break
+
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+
+            writer.write('HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(status, len(body)).encode())
+            writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import socket
+
+from . import logger as module_logger
+from .errors import *
+from .profiling import install_toggle_signal, profiler
+
+
+logger = logging.getLogger(__name__)
+
+
+# Multi-process mode (`processes` > 1): a proxy's worker connections are
+# spread over several processes, each accepting miners on the same `listen`
+# ports (SO_REUSEPORT; the kernel balances new connections between them).
+#
+# The proxy's own process becomes the coordinator; it keeps the only pool
+# connection(s) - and with them the job state, hot standbys, journal, pool
+# selection - and serves the worker processes over a local stratum
+# connection. Each worker process is handed a distinct extra_nonce1 tail by
+# the coordinator (just like any other worker), then splits what's left of
+# the nonce space among its own miners, so nonce ranges never overlap.
+
+def next_power_of_two(n):
+    size = 1
+    while size < n:
+        size <<= 1
+    return size
+
+
+def get_coordinator_settings(settings, processes):
+    settings = dict(settings)
+    settings['listen'] = [{'host': '127.0.0.1', 'port': settings.get('coordinator_port') or 0}]
+    settings['max_workers'] = next_power_of_two(processes)
+    # the worker processes carry every miner's traffic; don't treat them
+    # as stalled rigs
+    settings['worker_write_buffer_limit'] = 16 * 1024 * 1024
+    # shares are checked against worker targets in the worker processes
+    settings['vardiff'] = False
+    # as are share stats kept, per miner
+    settings['share_stats'] = None
+    return settings
+
+
+def get_worker_process_settings(settings, port):
+    settings = dict(settings)
+    for name in ('processes', 'coordinator_port', 'hot_standby', 'share_journal',
+                 'pool_selection', 'pool_sessions'):
+        settings.pop(name, None)
+
+    # the coordinator sends worker processes its extra_nonce1 changes
+    settings['extranonce_subscribe'] = True
+
+    settings['listen'] = [dict(s, reuse_port=True) for s in settings.get('listen') or []]
+    settings['pools'] = [{
+        'name': 'coordinator',
+        'host': '127.0.0.1',
+        'port': port,
+        'passthrough_credentials': True,
+    }]
+    return settings
+
+
+def run_worker_process(name, settings, loud, quiet, profile=None):
+    # entry point of a worker process; `profile` is (report file, interval,
+    # enabled) for the process' own event loop profiling
+    from .application import Proxy, setup_logging
+
+    # Ctrl+C reaches the whole process group; shutting down is left to the
+    # coordinator, which terminates its worker processes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    setup_logging(loud=loud, quiet=quiet)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+    if profile is not None:
+        profiler.output, profiler.interval, enabled = profile
+        if enabled:
+            profiler.enable()
+    install_toggle_signal()
+
+    proxy = Proxy(name=name, **settings)
+    try:
+        loop.run_until_complete(proxy.startup())
+        running = True
+    except (OSError, ConfigurationError) as e:
+        logger.critical("* {} proxy unable to start: {}".format(name, e))
+        running = False
+
+    if running:
+        loop.run_forever()
+
+    loop.run_until_complete(proxy.shutdown())
+    loop.run_until_complete(profiler.close())
+    loop.close()
+
+
+class WorkerProcesses(object):
+    # Starts (and restarts, should one die) a proxy's worker processes.
+
+    # seconds between checks on the worker processes
+    check_interval = 5
+
+    def __init__(self, proxy, count):
+        self.proxy = proxy
+        self.count = count
+
+        self.port = None
+        self.processes = [None] * count
+        self.monitor_fut = None
+
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise ConfigurationError("* {} proxy: 'processes' requires SO_REUSEPORT, which this platform lacks".format(
+                proxy.name))
+        # worker processes are daemonic (so they never outlive the
+        # coordinator), and daemonic processes can't start the process pool
+        # solutions are verified in
+        if proxy.settings.get('verify_solutions'):
+            raise ConfigurationError("* {} proxy: 'verify_solutions' can't be used with 'processes'".format(
+                proxy.name))
+
+    def start(self, port):
+        self.port = port
+        for n in range(self.count):
+            self.start_process(n)
+        self.monitor_fut = asyncio.ensure_future(self.monitor())
+
+        logger.info("* {} proxy started {} worker processes".format(self.proxy.name, self.count))
+
+    def start_process(self, n):
+        level = module_logger.getEffectiveLevel()
+        settings = get_worker_process_settings(self.proxy.settings, self.port)
+        if settings.get('capture'):
+            # every worker process captures its own traffic
+            settings['capture'] = '{}.{}'.format(settings['capture'], n + 1)
+        # likewise profiles its own event loop (if profiling's enabled, or
+        # once it's sent a SIGUSR1)
+        profile = ('{}.{}'.format(profiler.output, n + 1), profiler.interval, profiler.enabled)
+
+        # spawned (not forked), so nothing of the coordinator's event loop
+        # and sockets leaks into the worker processes
+        ctx = multiprocessing.get_context('spawn')
+        process = ctx.Process(
+            target=run_worker_process,
+            args=('{}#{}'.format(self.proxy.name, n + 1), settings,
+                  level <= logging.DEBUG, level >= logging.WARNING, profile),
+            daemon=True)
+        process.start()
+        self.processes[n] = process
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            for n, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.warning("* {} proxy worker process {} exited ({}), restarting it".format(
+                        self.proxy.name, n + 1, process.exitcode))
+                    self.start_process(n)
+
+    async def stop(self, timeout=5):
+        if self.monitor_fut:
+            self.monitor_fut.cancel()
+
+        loop = asyncio.get_event_loop()
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                await loop.run_in_executor(None, process.join, timeout)
+                if process.is_alive():
+                    process.kill()
@@ -0,0 +1,60 @@
+from collections import deque
+
+from .errors import *
+
+
+# the largest nonce space we'll hand out tails for; 2 bytes (0000 through
+# FFFF) is already a lot of rigs sharing a single pool connection
+MAX_NONCE_SPACE = 65536
+
+
+def is_valid_nonce_space(size):
+    # nonce spaces must be a power of two, so every tail value of the
+    # given width is usable
+    return isinstance(size, int) and 1 <= size <= MAX_NONCE_SPACE and not size & (size - 1)
+
+
+class ExtraNonce1TailAllocator(object):
+    # Hands out distinct extra_nonce1 'tails' (hex strings appended to the
+    # pool's extra_nonce1) so each worker mines its own nonce space. Tails
+    # are handed out by index; a worker keeps its index (see
+    # WorkerSession.allocate_tail) and looks the hex string up in `tails`.
+    #
+    # Free indexes are kept in a deque (a free-list), so both allocating and
+    # releasing a tail is O(1) regardless of how many workers are connected;
+    # the hex strings themselves are built once up front.
+
+    def __init__(self, size):
+        if not is_valid_nonce_space(size):
+            raise ConfigurationError("invalid nonce space size {}".format(size))
+
+        self.size = size
+
+        # 1 byte for up to 256 workers, 2 bytes for up to 65536, etc; a
+        # nonce space of 1 (solo mode) needs no tail at all
+        self.tail_size = ((size - 1).bit_length() + 7) // 8
+        _format = '{{:0{}x}}'.format(self.tail_size * 2)
+
+        self.tails = [_format.format(i) for i in range(size)] if self.tail_size else []
+        self.free = deque(range(size))
+        self.in_use = bytearray(size)
+
+    def __len__(self):
+        # number of tails currently allocated
+        return self.size - len(self.free)
+
+    def allocate(self):
+        try:
+            index = self.free.popleft()
+        except IndexError:
+            raise MaxClientsConnected
+
+        self.in_use[index] = 1
+        return index
+
+    def release(self, index):
+        # guard against double releases, which would otherwise put the
+        # same tail on the free-list twice
+        if 0 <= index < self.size and self.in_use[index]:
+            self.in_use[index] = 0
+            self.free.append(index)
@@ -0,0 +1,80 @@
+import asyncio
+from collections import deque
+
+
+class LatencyStats(object):
+    # Running latency figures (in seconds) without keeping every sample
+    __slots__ = ('count', 'total', 'last', 'max', 'ewma', 'alpha')
+
+    def __init__(self, alpha=0.1):
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = None
+        self.max = 0.0
+        self.ewma = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value > self.max:
+            self.max = value
+        self.ewma = value if self.ewma is None else self.ewma + self.alpha * (value - self.ewma)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def __str__(self):
+        if not self.count:
+            return 'n/a'
+        return 'avg {:.1f}ms, ewma {:.1f}ms, max {:.1f}ms ({} samples)'.format(
+            self.mean * 1000, self.ewma * 1000, self.max * 1000, self.count)
+
+
+class InFlightWindow(object):
+    # Caps the number of outstanding requests on a connection (ie. share
+    # submissions to the pool); once the window is full, callers queue up in
+    # FIFO order and are let through as responses come back.
+
+    def __init__(self, size):
+        self.size = max(int(size), 1)
+        self.in_flight = 0
+        self.waiters = deque()
+
+    @property
+    def queued(self):
+        return len(self.waiters)
+
+    async def acquire(self):
+        # fast path; room in the window and nobody waiting ahead of us
+        if self.in_flight < self.size and not self.waiters:
+            self.in_flight += 1
+            return
+
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # if the slot was handed to us just as we were cancelled, pass
+            # it on rather than leaking it
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        # hand the slot directly to the next waiter (in_flight is unchanged),
+        # otherwise free it up
+        while self.waiters:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+
+        if self.in_flight > 0:
+            self.in_flight -= 1
@@ -0,0 +1,380 @@
+import asyncio
+from collections import deque
+import functools
+import inspect
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Event loop profiling. Everything a proxy does happens on one event loop,
+# so any slow handler delays every miner; when profiling is enabled:
+#
+# * every `handle_*` and `hook_*` method of the protocol classes is timed;
+#   for coroutines, both the time spent running on the event loop (what
+#   holds up everyone else) and the time until they return (including
+#   waiting on the pool)
+# * event loop lag is sampled
+# * a thread samples the event loop thread's stack, for a (folded, ie.
+#   flamegraph-ready) stack profile, and captures what the loop is stuck on
+#   whenever it stalls for longer than `slow_callback_duration`
+#
+# The top-N slowest call sites, lag and stalls are written to a report file
+# every `interval` seconds (the stack profile to the same path plus
+# `.folded`). When profiling is disabled nothing is wrapped or running.
+
+DEFAULT_OUTPUT = 'aiostratum_proxy.profile'
+
+
+class CallSite(object):
+    __slots__ = ('name', 'calls', 'busy', 'busy_max', 'elapsed', 'elapsed_max')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        # seconds running on the event loop
+        self.busy = 0.0
+        self.busy_max = 0.0
+        # seconds until returning
+        self.elapsed = 0.0
+        self.elapsed_max = 0.0
+
+    def add(self, busy, elapsed):
+        self.calls += 1
+        self.busy += busy
+        self.elapsed += elapsed
+        if busy > self.busy_max:
+            self.busy_max = busy
+        if elapsed > self.elapsed_max:
+            self.elapsed_max = elapsed
+
+
+class TimedCoroutine(object):
+    # Drives a coroutine step by step, adding up the time each step spends
+    # running (as opposed to waiting on a future).
+    __slots__ = ('coro', 'site')
+
+    def __init__(self, coro, site):
+        self.coro = coro
+        self.site = site
+
+    def __await__(self):
+        coro = self.coro
+        busy = 0.0
+        started = time.perf_counter()
+        send, value = coro.send, None
+        try:
+            while True:
+                step = time.perf_counter()
+                try:
+                    future = send(value)
+                except StopIteration as e:
+                    return e.value
+                finally:
+                    busy += time.perf_counter() - step
+
+                try:
+                    value, send = (yield future), coro.send
+                except GeneratorExit:
+                    coro.close()
+                    raise
+                except BaseException as e:
+                    value, send = e, coro.throw
+        finally:
+            self.site.add(busy, time.perf_counter() - started)
+
+
+def time_coroutine_function(fn, site):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await TimedCoroutine(fn(*args, **kwargs), site)
+    wrapper.profiled_site = site
+    return wrapper
+
+
+def time_function(fn, site):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            site.add(elapsed, elapsed)
+    wrapper.profiled_site = site
+    return wrapper
+
+
+def get_subclasses(klass):
+    subclasses = []
+    for subclass in klass.__subclasses__():
+        subclasses.append(subclass)
+        subclasses.extend(get_subclasses(subclass))
+    return subclasses
+
+
+def fold_stack(frame):
+    # `file:function;...` outermost first, like flamegraph.pl's input
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+class Profiler(object):
+    # seconds between event loop lag samples (and heartbeats for the stack
+    # sampler's stall detection)
+    lag_interval = 0.05
+    # lag samples kept between reports
+    max_lag_samples = 100000
+
+    def __init__(self):
+        self.enabled = False
+        self.output = DEFAULT_OUTPUT
+        self.interval = 60.0
+        self.top = 20
+        self.sample_interval = 0.01
+        self.slow_callback_duration = 0.1
+
+        self.sites = {}
+        self.wrapped = []
+        self.started = None
+
+        self.lag_samples = deque(maxlen=self.max_lag_samples)
+        self.lag_max = 0.0
+        self.heartbeat = None
+
+        # written by the sampler thread
+        self.lock = threading.Lock()
+        self.stacks = {}
+        self.stalls = {}
+        self.stall_count = 0
+        self.sampler = None
+        self.sampler_stop = None
+
+        self.lag_fut = None
+        self.report_fut = None
+        self.write_future = None
+
+    def get_site(self, name):
+        site = self.sites.get(name)
+        if site is None:
+            site = self.sites[name] = CallSite(name)
+        return site
+
+    def enable(self, output=None, interval=None, top=None, sample_interval=None, slow_callback_duration=None):
+        if self.enabled:
+            return
+        if output:
+            self.output = output
+        if interval:
+            self.interval = interval
+        if top:
+            self.top = top
+        if sample_interval:
+            self.sample_interval = sample_interval
+        if slow_callback_duration:
+            self.slow_callback_duration = slow_callback_duration
+
+        self.enabled = True
+        self.started = time.time()
+        self.instrument()
+
+        self.heartbeat = time.monotonic()
+        self.lag_fut = asyncio.ensure_future(self.measure_loop_lag())
+        self.report_fut = asyncio.ensure_future(self.reporter())
+
+        self.sampler_stop = threading.Event()
+        self.sampler = threading.Thread(
+            target=self.sample_stacks, args=(threading.get_ident(), self.sampler_stop), daemon=True)
+        self.sampler.start()
+
+        logger.info("* profiling enabled, reporting to {} every {}s".format(self.output, self.interval))
+
+    def disable(self):
+        if not self.enabled:
+            return
+
+        self.uninstrument()
+        self.lag_fut.cancel()
+        self.report_fut.cancel()
+        self.sampler_stop.set()
+        self.sampler.join()
+        self.sampler = None
+
+        # the final report
+        self.report()
+        self.enabled = False
+
+        self.sites = {}
+        self.lag_samples.clear()
+        self.lag_max = 0.0
+        with self.lock:
+            self.stacks, self.stalls, self.stall_count = {}, {}, 0
+
+        logger.info("* profiling disabled, last report written to {}".format(self.output))
+
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def instrument(self):
+        # time the handlers and hooks of every (loaded) protocol class; the
+        # wrappers go on the classes, so connections made later are covered.
+        # Classes already instrumented are left as they are, so this is run
+        # again whenever protocol classes get loaded
+        from .protocols import StratumDispatchMixin
+
+        for klass in get_subclasses(StratumDispatchMixin):
+            for name, fn in list(vars(klass).items()):
+                if not name.startswith(('handle_', 'hook_')) or not inspect.isfunction(fn) \
+                        or hasattr(fn, 'profiled_site'):
+                    continue
+                site = self.get_site('{}.{}.{}'.format(klass.__module__, klass.__qualname__, name))
+                if asyncio.iscoroutinefunction(fn):
+                    wrapper = time_coroutine_function(fn, site)
+                else:
+                    wrapper = time_function(fn, site)
+                setattr(klass, name, wrapper)
+                self.wrapped.append((klass, name, fn))
+
+    def uninstrument(self):
+        for klass, name, fn in self.wrapped:
+            setattr(klass, name, fn)
+        self.wrapped = []
+
+    async def measure_loop_lag(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.lag_interval)
+            self.heartbeat = now = time.monotonic()
+            lag = max(now - started - self.lag_interval, 0.0)
+            self.lag_samples.append(lag)
+            if lag > self.lag_max:
+                self.lag_max = lag
+
+    def sample_stacks(self, loop_thread, stop):
+        # runs in a thread; never on the event loop
+        stalled = False
+        while not stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(loop_thread)
+            if frame is None:
+                continue
+            stack = fold_stack(frame)
+            del frame
+
+            # the event loop's stalled if it's missed its heartbeat by more
+            # than `slow_callback_duration`
+            stall = time.monotonic() - self.heartbeat > self.lag_interval + self.slow_callback_duration
+            with self.lock:
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                if stall:
+                    self.stalls[stack] = self.stalls.get(stack, 0) + 1
+                    if not stalled:
+                        self.stall_count += 1
+            stalled = stall
+
+    async def reporter(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.report()
+            except Exception:
+                logger.exception("* profiling report failed")
+
+    def report(self):
+        lines = ["# aiostratum_proxy profile, {} (profiling since {})".format(
+            time.strftime('%Y-%m-%d %H:%M:%S'), time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)))]
+
+        lag = list(self.lag_samples)
+        self.lag_samples.clear()
+        lines.append("")
+        lines.append("event loop lag (since last report): {} samples, p50 {:.2f}ms, p99 {:.2f}ms, max {:.2f}ms "
+                     "(max since profiling {:.2f}ms)".format(
+                         len(lag), percentile(lag, 50) * 1000, percentile(lag, 99) * 1000,
+                         max(lag or [0.0]) * 1000, self.lag_max * 1000))
+
+        lines.append("")
+        lines.append("slowest call sites (by longest time on the event loop):")
+        lines.append("{:>10} {:>12} {:>12} {:>12} {:>14} {:>14}  {}".format(
+            'calls', 'loop total', 'loop mean', 'loop max', 'elapsed mean', 'elapsed max', 'site'))
+        sites = sorted([s for s in self.sites.values() if s.calls], key=lambda s: -s.busy_max)
+        for s in sites[:self.top]:
+            lines.append("{:>10} {:>10.1f}ms {:>10.3f}ms {:>10.3f}ms {:>12.3f}ms {:>12.3f}ms  {}".format(
+                s.calls, s.busy * 1000, s.busy / s.calls * 1000, s.busy_max * 1000,
+                s.elapsed / s.calls * 1000, s.elapsed_max * 1000, s.name))
+
+        with self.lock:
+            stacks = dict(self.stacks)
+            stalls = dict(self.stalls)
+            stall_count = self.stall_count
+
+        lines.append("")
+        lines.append("event loop stalls over {:.0f}ms: {} (stack samples taken while stalled, innermost last):".format(
+            self.slow_callback_duration * 1000, stall_count))
+        for stack, count in sorted(stalls.items(), key=lambda s: -s[1])[:self.top]:
+            lines.append("{:>10}  {}".format(count, stack))
+
+        total = sum(stacks.values())
+        lines.append("")
+        lines.append("stack samples: {} every {:.0f}ms (top {}, innermost frame; all in {}.folded):".format(
+            total, self.sample_interval * 1000, self.top, self.output))
+        innermost = {}
+        for stack, count in stacks.items():
+            frame = stack.rsplit(';', 1)[-1]
+            innermost[frame] = innermost.get(frame, 0) + count
+        for frame, count in sorted(innermost.items(), key=lambda s: -s[1])[:self.top]:
+            lines.append("{:>10} {:>6.1f}%  {}".format(count, count * 100.0 / (total or 1), frame))
+
+        report = "\n".join(lines) + "\n"
+        folded = "".join("{} {}\n".format(stack, count) for stack, count in stacks.items())
+
+        # written from a thread; an earlier report still being written is
+        # simply superseded
+        self.write_future = asyncio.get_event_loop().run_in_executor(None, self.write, report, folded)
+        self.write_future.add_done_callback(self.written)
+
+    def write(self, report, folded):
+        # runs in a thread; never on the event loop
+        with open(self.output, 'w') as f:
+            f.write(report)
+        with open(self.output + '.folded', 'w') as f:
+            f.write(folded)
+
+    def written(self, fut):
+        if fut.exception():
+            logger.warning("* unable to write profiling report {} ({})".format(self.output, fut.exception()))
+
+    async def close(self):
+        self.disable()
+        if self.write_future is not None:
+            await asyncio.wait([self.write_future])
+
+
+profiler = Profiler()
+
+
+def install_toggle_signal():
+    # SIGUSR1 turns profiling on and off at runtime (where there's SIGUSR1)
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    try:
+        asyncio.get_event_loop().add_signal_handler(signal.SIGUSR1, profiler.toggle)
+    except (NotImplementedError, RuntimeError):
+        pass
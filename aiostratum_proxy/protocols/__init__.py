@@ -1,30 +1,204 @@
 import asyncio
-import binascii
-from collections import deque, OrderedDict
 import logging
 import socket
-import struct
+import ssl
 
 from aiojsonrpc2 import ServerProtocol, ClientProtocol
 
+from ..auth import AuthorizationCache, MinerAccounts
+from ..capture import CapturingWriter, SIDES
+from ..codec import StratumConnection, StratumStreamProtocol, StratumWriter, encode_line
 from ..errors import *
+from ..metrics import CountingWriter, registry
+from ..nonces import ExtraNonce1TailAllocator, is_valid_nonce_space
+from ..pipeline import InFlightWindow
+from ..shares import DuplicateShareDetector, ShareJournal
+from ..state import PoolState, SessionState, WorkerSession, WorkerState, state_property
+from ..utils import get_pool_name, get_setting
 
 logger = logging.getLogger(__name__)
 
 
-class BaseWorkerProtocol(ServerProtocol):
+class StratumDispatchMixin(object):
+    # Splits aiojsonrpc2's `process` into reading and dispatching, so that
+    # requests listed in `background_methods` can be handled in the
+    # background while the connection carries on reading (ie. a miner's
+    # burst of share submissions gets pipelined to the pool rather than
+    # waiting a full pool round-trip per share)
+    background_methods = ()
+
+    # 'worker' or 'pool'; which side of the proxy the connections are on
+    # (for metrics and traffic capture)
+    connection_side = None
+
+    def build_connection(self, reader, writer):
+        # `reader` is the connection's StratumStreamProtocol
+        if registry.enabled and self.connection_side:
+            bytes_in, bytes_out = self.proxy.metrics.get_byte_counters(self.connection_side)
+            reader.bytes_counter = bytes_in
+            writer = CountingWriter(writer, bytes_out)
+
+        capture = self.proxy.capture
+        if capture is not None and self.connection_side:
+            connection_id = capture.open_connection(self.connection_side, writer.get_extra_info('peername'))
+            reader.set_capture(capture, connection_id, SIDES[self.connection_side])
+            writer = CapturingWriter(writer, capture, connection_id, SIDES[self.connection_side])
+
+        connection = StratumConnection(reader, writer)
+        # aiojsonrpc2 keeps response futures in a class-level dict shared by
+        # every connection; responses are correlated by id, and ids are only
+        # unique per connection, so each connection needs its own
+        connection.result_futures = {}
+        return connection
+
+    async def process(self, connection):
+        try:
+            data = await connection.read()
+        except JSONRPCError as e:
+            logger.debug('{} {} {} ({})'.format(
+                self.log_prefix, e.code, str(e), connection.peername))
+            await connection.send({'id': None, 'error': {'code': e.code, 'message': e.msg}}, wait=False)
+            return
+
+        # batches are handled as if each request arrived on its own
+        for _data in (data if isinstance(data, list) else [data]):
+            if isinstance(_data, dict) and _data.get('id') is not None \
+                    and _data.get('method') in self.background_methods:
+                asyncio.ensure_future(self.dispatch_in_background(connection, _data))
+            else:
+                await self.dispatch(connection, _data)
+
+    async def dispatch_in_background(self, connection, data):
+        try:
+            method, params = data['method'], data.get('params')
+            if isinstance(params, list) and 'jsonrpc' not in data:
+                # fast path for the bulk of a worker's traffic (shares); the
+                # method's known to be valid, so there's nothing to check
+                await self.call_handler(connection, method, params, {'id': data['id']}, False)
+            else:
+                await self.dispatch(connection, data)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # the upstream request this was waiting on went away (ie. pool
+            # disconnection); nobody else will answer the worker, so we do
+            if not self.stopping:
+                e = JSONRPCOtherUnknownError()
+                await connection.send({'id': data.get('id'), 'error': {'code': e.code, 'message': e.msg}}, wait=False)
+
+    async def dispatch(self, connection, data):
+        is_notification = False
+        response = {'id': None}
+        try:
+            if not isinstance(data, dict):
+                raise JSONRPCInvalidRequest
+
+            # JSON-RPC: if `id` is not in the request data or is `None`, we
+            # must consider it to be a notification
+            _id = data.get('id')
+            response['id'] = _id
+            is_notification = _id is None
+
+            jsonrpc_version = str(data.get('jsonrpc') or '').strip()
+            if jsonrpc_version:
+                # JSON-RPC: for version 2 of the spec, this must be '2.0'
+                if jsonrpc_version != '2.0':
+                    logger.debug('{} invalid version `{}`'.format(self.log_prefix, jsonrpc_version))
+                    raise JSONRPCInvalidRequest
+                response['jsonrpc'] = jsonrpc_version
+
+            # JSON-RPC: `method` is required!
+            method = data.get('method')
+            if not isinstance(method, str):
+                logger.debug('{} `method` parameter missing from request `{}`'.format(self.log_prefix, data))
+                raise JSONRPCMethodNotFound
+
+            # JSON-RPC: params are not required
+            params = data.get('params')
+            if params is not None and not isinstance(params, (list, dict)):
+                raise JSONRPCInvalidParams
+
+        except JSONRPCError as e:
+            logger.debug('{} {} {} ({})'.format(
+                self.log_prefix, e.code, str(e), connection.peername))
+
+            if not is_notification:
+                response['error'] = {'code': e.code, 'message': e.msg}
+                await connection.send(response, wait=False)
+            return
+
+        await self.call_handler(connection, method, params, response, is_notification)
+
+    async def call_handler(self, connection, method, params, response, is_notification):
+        # debug output is only put together when it's going to be logged;
+        # formatting every share's params adds up
+        debug = logger.isEnabledFor(logging.DEBUG)
+        try:
+            # valid methods will be identically named to the incoming
+            # method, with `.` replaced by `_` and prefaced with `handle_`
+            handler_name = 'handle_' + method.replace('.', '_')
+            handler = getattr(self, handler_name, None)
+            if handler is None:
+                raise JSONRPCMethodNotFound('handler `{}` not found'.format(handler_name))
+
+            try:
+                if debug:
+                    logger.debug('{} handling {} {}, {}'.format(
+                        self.log_prefix, method,
+                        'notification' if is_notification else 'request',
+                        params))
+
+                # all handlers must be asyncio coroutines
+                result = await handler(connection, params, is_notification=is_notification)
+                if not is_notification:
+                    response['result'] = result
+                    if debug:
+                        logger.debug('{} handling {} response, {}'.format(
+                            self.log_prefix, method, result))
+            except (asyncio.TimeoutError, asyncio.CancelledError, JSONRPCBaseError):
+                # make sure these are not swallowed up by the
+                # following `Exception` clause
+                raise
+            except Exception as e:
+                raise JSONRPCInternalError('{} handler `{}` unknown error: {}'.format(
+                    self.log_prefix, handler_name, str(e)))
+
+        except JSONRPCError as e:
+            if debug:
+                logger.debug('{} {} {} ({})'.format(
+                    self.log_prefix, e.code, str(e), connection.peername))
+
+            if not is_notification:
+                response['error'] = {'code': e.code, 'message': e.msg}
+
+        if not is_notification:
+            await connection.send(response, wait=False)
+
+
+class BaseWorkerProtocol(StratumDispatchMixin, ServerProtocol):
+    # share submissions are answered whenever the pool responds, while the
+    # worker connection keeps reading
+    background_methods = ('mining.submit',)
+    connection_side = 'worker'
+
     pool = None
-    pool_watchdog_fut = None
 
-    registered_extra_nonce1_tails = set()
+    # per-proxy state (see WorkerState); aiojsonrpc2 keeps `clients` and
+    # `servers` as class attributes, shared by every proxy in the process
+    state = None
+    clients = state_property('clients')
+    servers = state_property('servers')
+    extra_nonce1_tails = state_property('extra_nonce1_tails')
+    sessions = state_property('sessions')
 
-    # we'll optionally track the most recent n shares/solutions
-    # for duplicate detection; this needs to be 'enabled' in
-    # hook_validate_share_params by adding 'unique' data to be
-    # checked (which likely differs by algo/coin)
-    recent_shares = deque(maxlen=500)
+    # we'll optionally track shares/solutions per job for duplicate
+    # detection; this needs to be 'enabled' in hook_validate_share_params
+    # by adding 'unique' data to be checked (which likely differs by algo/coin)
+    recent_shares = state_property('recent_shares')
+
+    # (method, params, encoded data) of the last notification fanned out
+    last_notification = None
 
     def __init__(self, proxy, connection_settings, *args, **kwargs):
+        self.state = WorkerState(None, None)
         self.proxy = proxy
         self.settings = kwargs
         self.log_prefix = 'W:{}:'.format(self.proxy.name)
@@ -38,39 +212,79 @@ class BaseWorkerProtocol(ServerProtocol):
         else:
             try:
                 self.max_workers = int(mw)
-                if self.max_workers not in [1, 256, 65536]:
+                if not is_valid_nonce_space(self.max_workers):
                     raise ValueError
             except (ValueError, TypeError):
                 self.max_workers = 256
                 logger.warning("{} invalid 'max_workers' setting ({}), defaulting to {} instead".format(self.log_prefix, mw, self.max_workers))
 
+        self.extra_nonce1_tails = ExtraNonce1TailAllocator(self.max_workers)
+
+        self.recent_shares = DuplicateShareDetector(get_setting(
+            self.settings, 'duplicate_share_capacity', 16384, minimum=1, log_prefix=self.log_prefix))
+
+        # backpressure; workers whose transport has more than this many bytes
+        # waiting to be sent get skipped, and dropped if it lasts too long
+        self.write_buffer_limit = get_setting(
+            self.settings, 'worker_write_buffer_limit', 65536, minimum=1, log_prefix=self.log_prefix)
+        self.write_buffer_timeout = get_setting(
+            self.settings, 'worker_write_buffer_timeout', 30, cast=float, minimum=0, log_prefix=self.log_prefix)
+
+        # workers per upstream session before another session is opened
+        # (with `pool_sessions` > 1)
+        self.session_workers = get_setting(
+            self.settings, 'pool_session_workers', self.max_workers, minimum=1, log_prefix=self.log_prefix)
+
         if self.max_workers != 1:
             logger.info("{} up to {} workers supported (distinct nonce spaces)".format(self.log_prefix, self.max_workers))
         else:
             logger.info("{} solo worker mode (single nonce space)".format(self.log_prefix, self.max_workers))
 
-    async def pool_watchdog(self):
-        while not self.stopping:
-            await asyncio.sleep(1)
-
-            # only try to reconnect to the pool if we have existing client
-            # connections
-            if len(self.clients) and not self.pool.connected:
-                while True:
-                    try:
-                        await self.pool.connect()
-                        break
-                    except:
-                        if self.stopping:
-                            return
-                        await self.pool.use_next_pool_config()
-
-                await self.pool.initialize()
-                self.pool.set_ready()
+    def build_connection(self, reader, writer):
+        connection = super().build_connection(reader, writer)
+        connection.worker = WorkerSession()
+        return connection
+
+    async def start_listening(self):
+        # same as aiojsonrpc2's, with the addition of SO_REUSEPORT support
+        # (`reuse_port: true`), letting several processes accept connections
+        # on the same port, and connections using the stratum codec
+        for settings in self.connection_settings:
+            opts = {
+                'host': settings.get('host') or '',  # default to all network interfaces
+                'port': settings.get('port'),
+            }
+
+            if settings.get('reuse_port', False):
+                opts['reuse_port'] = True
+
+            use_ssl = settings.get('ssl', False)
+            ssl_cert_file = settings.get('ssl_cert_file', '')
+            ssl_cert_key_file = settings.get('ssl_cert_key_file', '')
+            if use_ssl:
+                if ssl_cert_file and ssl_cert_key_file:
+                    ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+                    ssl_ctx.load_cert_chain(ssl_cert_file, ssl_cert_key_file)
+                    ssl_ctx.options |= ssl.OP_NO_SSLv2
+                    ssl_ctx.options |= ssl.OP_NO_SSLv3
+                    opts['ssl'] = ssl_ctx
+                else:
+                    logger.warning('{} unable to secure connection, missing parameters'.format(
+                        self.log_prefix))
+                    use_ssl = False
+
+            s = await asyncio.get_event_loop().create_server(
+                lambda: StratumStreamProtocol(self.handle_connection), **opts)
+            self.servers.append(s)
+
+            bound_to = ", ".join(sorted(
+                ["|".join([str(t) for t in t.getsockname()[:2]]) for t in s.sockets]))
+
+            logger.info('{} accepting {} connections on {}'.format(
+                self.log_prefix, 'secure' if use_ssl else 'plaintext', bound_to))
 
     async def initialize(self):
         self.pool = self.proxy.pool
-        self.pool_watchdog_fut = asyncio.ensure_future(self.pool_watchdog())
 
     async def loop(self, connection):
         _socket = connection.reader._transport.get_extra_info('socket')
@@ -92,6 +306,10 @@ class BaseWorkerProtocol(ServerProtocol):
             # Some socket features are not available on all platforms (Windows and macOS!)
             logger.exception("{} unable to set socket keep-alive due to platform constraints".format(self.log_prefix))
 
+        # pool connections are only kept up while there are workers; have
+        # the supervisor (re)connect any that aren't
+        self.proxy.supervisor.wakeup()
+
         if not self.pool.connected or not self.pool.is_ready():
             self.recent_shares.clear()
 
@@ -99,7 +317,7 @@ class BaseWorkerProtocol(ServerProtocol):
             await self.pool.wait_until_ready()
 
         try:
-            connection.extra['extra_nonce1_tail'] = self.get_extra_nonce1_tail()
+            await self.assign_session(connection)
         except MaxClientsConnected:
             await self.close_connection(connection)
             # connection.close()
@@ -109,59 +327,232 @@ class BaseWorkerProtocol(ServerProtocol):
                 self.log_prefix, len(self.clients)))
             return
 
-        connection.extra['subscriptions'] = {}
-
         await super().loop(connection)
 
-    def cleanup_connection(self, connection):
-        tail = connection.extra.get('extra_nonce1_tail')
-        if tail:
-            try:
-                self.registered_extra_nonce1_tails.remove(tail)
-            except:
-                pass
+    def get_pool(self, connection):
+        # the pool connection a worker is mining on; workers not on an extra
+        # upstream session follow the proxy's active pool (over failovers too)
+        return connection.worker.pool or self.pool
+
+    def get_clients(self, pool):
+        # the workers mining on the given pool connection
+        session = self.sessions.get(pool)
+        if session is not None:
+            return list(session.clients)
+        if not self.sessions:
+            return list(self.clients.keys())
+        return [c for c in self.clients.keys() if c.worker.pool is None]
+
+    def get_session_candidates(self):
+        # (worker count, pool connection, session) for the active pool and
+        # every ready extra session with room for another worker
+        candidates = []
+        if self.max_workers == 1 or len(self.extra_nonce1_tails) < self.max_workers:
+            candidates.append((len(self.extra_nonce1_tails), self.pool, None))
+        for pool, session in self.sessions.items():
+            if pool.is_ready() and len(session.extra_nonce1_tails) < self.max_workers:
+                candidates.append((len(session.extra_nonce1_tails), pool, session))
+        return candidates
+
+    def is_session_busy(self, workers, pool):
+        # busy sessions have reached their share of workers, or have more
+        # shares to send than their submit window lets through
+        return workers >= self.session_workers or pool.submit_window.queued > 0
+
+    async def assign_session(self, connection):
+        # put a new worker on the least loaded upstream session (the active
+        # pool's own, or an extra one), opening another session once they're
+        # all busy; a worker is only turned away if every session is full
+        candidates = self.get_session_candidates()
+
+        if self.proxy.can_open_session() and all(self.is_session_busy(w, p) for w, p, s in candidates):
+            opening = self.proxy.open_session()
+            if not candidates:
+                await opening
+                candidates = self.get_session_candidates()
+
+        if not candidates:
+            raise MaxClientsConnected
 
-    async def close(self):
-        await super().close()
-        await self.pool_watchdog_fut
+        workers, pool, session = min(candidates, key=lambda c: c[0])
+        if session is None:
+            # solo mode (max_workers of 1) shares a single nonce space, so
+            # there's no tail to hand out
+            if self.max_workers != 1:
+                connection.worker.allocate_tail(self.extra_nonce1_tails)
+            return
 
-    def get_extra_nonce1_tail(self):
-        if self.max_workers != 1:
-            if self.max_workers == 65536:
-                # 2 bytes allows for 65536 (0000 through FFFF)
-                _format = '>H'
-            else:
-                # 1 byte allows for 256 workers (00 through FF)
-                _format = '>B'
+        connection.worker.allocate_tail(session.extra_nonce1_tails)
+        connection.worker.pool = pool
+        session.clients.add(connection)
+
+    def add_session(self, pool):
+        self.sessions[pool] = SessionState(
+            ExtraNonce1TailAllocator(self.max_workers), asyncio.get_event_loop().time())
+        self.proxy.supervisor.wakeup()
+
+    async def remove_session(self, pool):
+        # workers on a closed session reconnect, and are assigned again
+        session = self.sessions.pop(pool, None)
+        if session is not None:
+            for connection in list(session.clients):
+                await self.close_connection(connection)
+
+    @staticmethod
+    def encode_notification(method, params):
+        # same JSON-RPC notification layout aiojsonrpc2 builds per connection
+        return encode_line({
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params or []
+        })
+
+    def get_send_queue_depth(self, connection):
+        # bytes written to the worker that the transport hasn't sent yet
+        try:
+            return connection.writer.transport.get_write_buffer_size()
+        except AttributeError:
+            return 0
+
+    def get_send_queue_totals(self):
+        # bytes queued to all workers, and how many workers are over
+        # `write_buffer_limit` (see metrics)
+        queued = backlogged = 0
+        for connection in self.clients.keys():
+            depth = self.get_send_queue_depth(connection)
+            queued += depth
+            if depth > self.write_buffer_limit:
+                backlogged += 1
+        return queued, backlogged
+
+    def is_backlogged(self, connection, now):
+        worker = connection.worker
+        if self.get_send_queue_depth(connection) <= self.write_buffer_limit:
+            worker.backlogged_since = None
+            return False
+
+        if worker.backlogged_since is None:
+            worker.backlogged_since = now
+        since = worker.backlogged_since
+        if now - since >= self.write_buffer_timeout and not worker.dropping:
+            logger.warning("{} worker {} not reading ({} bytes queued for {:.0f}s), disconnecting".format(
+                self.log_prefix, connection.peername, self.get_send_queue_depth(connection), now - since))
+            self.drop_connection(connection)
+
+        return True
+
+    def drop_connection(self, connection):
+        # close a worker connection without holding up the caller (ie. in
+        # the middle of a fan-out to every other worker)
+        if not connection.worker.dropping:
+            connection.worker.dropping = True
+            asyncio.ensure_future(self.close_connection(connection))
+
+    def send_notification(self, connection, data, now):
+        # queue already encoded data on the worker's transport, never waiting
+        # for it to drain; backlogged workers are skipped so one stalled rig
+        # can't hold up (or balloon memory for) everyone else
+        if self.is_backlogged(connection, now):
+            return False
+
+        connection.writer.write(data)
+        return True
+
+    async def _rpc_request(self, connection, method, params):
+        try:
+            await connection.rpc(method, params, timeout=self.write_buffer_timeout or None)
+        except Exception as e:
+            logger.debug('{} {} request to {} failed ({})'.format(
+                self.log_prefix, method, connection.peername, e))
+
+    async def broadcast(self, method, params, is_notification=False, received=None, pool=None):
+        # sent to the workers mining on `pool` (the active pool by default)
+        loop = asyncio.get_event_loop()
+        if received is None:
+            received = loop.time()
+
+        logger.debug('{} broadcasting {}, {}'.format(self.log_prefix, method, params))
+
+        clients = self.get_clients(pool or self.pool)
+
+        if not is_notification:
+            # requests need a distinct id per connection, so they can't share
+            # a single encoded payload; send them all at once and let each
+            # worker's response arrive (or time out) on its own
+            for connection in clients:
+                asyncio.ensure_future(self._rpc_request(connection, method, params))
+            return loop.time() - received
+
+        # encode the notification once, then hand the very same buffer to
+        # every worker transport; upstream sessions usually get the very same
+        # job, which is then only encoded once for all of them
+        if self.last_notification is not None and self.last_notification[:2] == (method, params):
+            data = self.last_notification[2]
+        else:
+            data = self.encode_notification(method, params)
+            self.last_notification = (method, params, data)
 
-            for i in range(0, self.max_workers):
-                tail = binascii.hexlify(struct.pack(_format, i)).decode('ascii')
+        sent = 0
+        for connection in clients:
+            sent += self.send_notification(connection, data, received)
 
-                if tail not in self.registered_extra_nonce1_tails:
-                    self.registered_extra_nonce1_tails.add(tail)
-                    return tail
+        # time from the pool message arriving to the last worker write
+        elapsed = loop.time() - received
+        if method == 'mining.notify':
+            self.proxy.metrics.notify_fanout.observe(elapsed)
+        logger.debug('{} {} fan-out to {}/{} workers took {:.3f}ms'.format(
+            self.log_prefix, method, sent, len(clients), elapsed * 1000))
 
-            raise MaxClientsConnected
+        return elapsed
+
+    def cleanup_connection(self, connection):
+        connection.worker.release_tail()
+
+        session = self.sessions.get(connection.worker.pool)
+        if session is not None:
+            session.clients.discard(connection)
+            if not session.clients:
+                session.idle_since = asyncio.get_event_loop().time()
+                # to be closed once it's been idle for long enough
+                self.proxy.supervisor.wakeup()
 
 
-class BasePoolProtocol(ClientProtocol):
+class BasePoolProtocol(StratumDispatchMixin, ClientProtocol):
+    connection_side = 'pool'
+
     workers = None
 
     pool_configs = []
 
-    ready = asyncio.Event()
+    # per-connection state (see PoolState); a proxy running hot standby pool
+    # connections has more than one of these at a time, and each proxy in
+    # the process has its own
+    state = None
+    ready = state_property('ready')
+
+    subscriptions = state_property('subscriptions')
+    extra_nonce1 = state_property('extra_nonce1')
+    extra_nonce2_size = state_property('extra_nonce2_size')
+
+    target_difficulty = state_property('target_difficulty')
+
+    jobs = state_property('jobs')
+    current_job = state_property('current_job')
 
-    subscriptions = {}
-    extra_nonce1 = None
-    extra_nonce2_size = None
+    authorizations = state_property('authorizations')
+    pending_authorizations = state_property('pending_authorizations')
+    miner_accounts = state_property('miner_accounts')
 
-    target_difficulty = None
+    submit_window = None
+    share_journal = None
 
-    jobs = OrderedDict()
-    current_job = None
+    # hot standby connection management
+    connecting = False
 
-    authorized_workers = {}
-    unauthorized_workers = set()
+    # (extra_nonce1, extra_nonce2_size) the workers were mining with when
+    # the pool connection dropped, while they're kept connected waiting on
+    # it to be reconnected (see `keep_workers_connected`)
+    resuming = None
 
     def __init__(self, proxy, connection_settings, *args, **kwargs):
         self.proxy = proxy
@@ -173,28 +564,73 @@ class BasePoolProtocol(ClientProtocol):
             self.pool_configs = connection_settings
 
         self.log_prefix = 'P:{}:'.format(self.proxy.name)
+
+        # authorizations are cached (bounded, with expiry), so workers
+        # reconnecting, or many rigs on one account, don't each get a
+        # `mining.authorize` sent to the pool
+        auth_cache_size = get_setting(
+            self.settings, 'auth_cache_size', 65536, minimum=1, log_prefix=self.log_prefix)
+        self.state = PoolState(
+            AuthorizationCache(
+                auth_cache_size,
+                get_setting(self.settings, 'auth_cache_ttl', 3600, cast=float, minimum=0, log_prefix=self.log_prefix),
+                get_setting(self.settings, 'auth_cache_denied_ttl', 60, cast=float, minimum=0, log_prefix=self.log_prefix)),
+            MinerAccounts(auth_cache_size))
+
+        # shares from every worker go through the one pool connection; allow
+        # up to this many to be awaiting the pool's response at once
+        self.submit_window = InFlightWindow(get_setting(
+            self.settings, 'submit_window', 64, minimum=1, log_prefix=self.log_prefix))
+
+        # optionally hold on to shares submitted while the pool is unavailable,
+        # to be sent once it's back (if their job is still valid by then)
+        journal_path = self.settings.get('share_journal')
+        if journal_path:
+            self.share_journal = ShareJournal(
+                journal_path,
+                get_setting(self.settings, 'share_journal_size', 10000, minimum=1, log_prefix=self.log_prefix),
+                get_setting(self.settings, 'share_journal_flush_interval', 1.0, cast=float, minimum=0, log_prefix=self.log_prefix))
+
+        # when the pool connection drops (and there's no standby to fail
+        # over to), workers stay connected while it's reconnected, rather
+        # than all being disconnected to come back at once
+        self.keep_workers_connected = bool(self.settings.get('keep_workers_connected', True))
+
+        # a pool that can't be connected to is tried again after a delay
+        # doubling with every consecutive failure, from `reconnect_delay` up
+        # to `reconnect_max_delay` seconds (see PoolSupervisor); connecting
+        # and subscribing each give up after `connect_timeout` seconds
+        self.reconnect_delay = get_setting(
+            self.settings, 'reconnect_delay', 1, cast=float, minimum=0, log_prefix=self.log_prefix)
+        self.reconnect_max_delay = get_setting(
+            self.settings, 'reconnect_max_delay', 60, cast=float, minimum=0, log_prefix=self.log_prefix)
+        self.connect_timeout = get_setting(
+            self.settings, 'connect_timeout', 10, cast=float, minimum=0.1, log_prefix=self.log_prefix)
+
         # start things up with the first pool configuration in the list!
         super().__init__(self.pool_configs.pop(0))
 
     async def use_next_pool_config(self):
-        # If we get here, there was a pool disconnection and we should
-        # try the next pool and/or exponentially back off our reconnection
-        # attempts (local internet disconnection, perhaps???)
+        # If we get here, there was a pool disconnection (or a failed attempt
+        # at connecting) and we should move on to the next pool, if there's
+        # one; when it's tried is up to the supervisor, which backs off pools
+        # that keep failing (local internet disconnection, perhaps???)
 
         # reset the ready indicator
         self.ready.clear()
 
+        if self.proxy.pool_selection == 'latency':
+            # try the healthiest of the other pools next
+            now = asyncio.get_event_loop().time()
+            self.pool_configs.sort(key=lambda c: self.proxy.get_pool_health(c).score(now))
+
         try:
             next_config = self.pool_configs.pop(0)
         except IndexError:
-            # There wasn't another pool configuration available (no fallback pool!)
+            # There wasn't another pool configuration available (no fallback
+            # pool!), so the current one is tried again
             next_config = None
 
-            # No other pool to connect to, so let's wait a few seconds and
-            # try to reconnect to the current and only pool settings
-            logger.warning("{} waiting 10 seconds before reconnecting to current pool".format(self.log_prefix))
-            await asyncio.sleep(10)
-
         if next_config:
             # Store the current (disconnected) config back in our pool config list
             self.pool_configs.append(self.connection_settings)
@@ -204,12 +640,120 @@ class BasePoolProtocol(ClientProtocol):
     async def initialize(self):
         self.workers = self.proxy.workers
 
+    @property
+    def is_active(self):
+        # the pool connection the proxy's workers are currently mining on
+        return self.proxy.pool is self
+
+    @property
+    def is_session(self):
+        # an extra upstream session, with workers of its own
+        return self in self.proxy.sessions
+
+    @property
+    def is_serving(self):
+        # whether any workers are mining on this connection
+        return self.is_active or self.is_session
+
+    @property
+    def name(self):
+        return get_pool_name(self.connection_settings)
+
+    @property
+    def health(self):
+        # health is tracked per pool configuration, which can change as the
+        # connection falls back to other pools
+        return self.proxy.get_pool_health(self.connection_settings)
+
+    async def connect(self):
+        if self.connected:
+            return
+
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        try:
+            await self.open_connection()
+        except Exception:
+            self.health.record_connect_failure()
+            self.proxy.metrics.pool_connect_failures.inc()
+            raise
+        self.health.record_connect(loop.time() - started)
+        self.proxy.metrics.pool_connects.inc()
+
+    async def open_connection(self):
+        # same as aiojsonrpc2's `connect`, with the connection using the
+        # stratum codec
+        opts = {
+            'host': self.connection_settings.get('host'),
+            'port': self.connection_settings.get('port'),
+        }
+        use_ssl = self.connection_settings.get('ssl', False)
+        if use_ssl:
+            ssl_ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+            ssl_ctx.options |= ssl.OP_NO_SSLv2
+            ssl_ctx.options |= ssl.OP_NO_SSLv3
+
+            if not self.connection_settings.get('ssl_verify', False):
+                ssl_ctx.check_hostname = False
+                ssl_ctx.verify_mode = ssl.CERT_NONE
+
+            opts['ssl'] = ssl_ctx
+
+        try:
+            fut = asyncio.get_event_loop().create_connection(StratumStreamProtocol, **opts)
+            transport, protocol = await asyncio.wait_for(fut, timeout=self.connect_timeout)
+        except Exception as e:
+            logger.warning("{} unable to connect to {} ({})".format(
+                self.log_prefix, "|".join([str(opts['host']), str(opts['port'])]), str(e)))
+            raise JSONRPCNetworkError
+
+        logger.info('{} {}connection established to {}'.format(
+            self.log_prefix, "secure " if use_ssl else "",
+            "|".join([str(opts['host']), str(opts['port'])])))
+
+        await self.handle_connection(protocol, StratumWriter(transport, protocol))
+
+    async def connect_standby(self):
+        self.connecting = True
+        try:
+            await self.connect()
+            await self.initialize()
+            self.set_ready()
+            logger.info("{} hot standby pool '{}' ready".format(self.log_prefix, self.name))
+        except Exception as e:
+            delay = self.schedule_retry()
+            logger.warning("{} hot standby pool '{}' unavailable ({}), retrying in {:.1f}s".format(
+                self.log_prefix, self.name, str(e) or type(e).__name__, delay))
+            await self.close_connection()
+        finally:
+            self.connecting = False
+            self.proxy.supervisor.wakeup()
+
+    def schedule_retry(self):
+        # backs off this pool (configuration) after a failed attempt at
+        # getting a connection to it ready; returns the delay
+        return self.health.backoff(
+            asyncio.get_event_loop().time(), self.reconnect_delay, self.reconnect_max_delay)
+
+    async def activate(self, previous):
+        # called when this (hot standby) connection takes over from the
+        # `previous` pool connection; protocols should bring the workers
+        # across to this pool's nonce space, target and job here
+        pass
+
+    def reset_session(self, keep_jobs=False):
+        self.state.reset(keep_jobs)
+
+        if not keep_jobs and self.is_active:
+            self.workers.recent_shares.clear()
+
     def is_ready(self):
         return self.ready.is_set()
 
     def set_ready(self):
         if not self.ready.is_set():
             self.ready.set()
+            self.health.record_ready()
 
     async def wait_until_ready(self):
         await self.ready.wait()
@@ -222,17 +766,55 @@ class BasePoolProtocol(ClientProtocol):
         await super().loop(connection)
 
         if not self.stopping:
-            # All client connections will need to be closed so they
-            # auto-reconnect to resubscribe for the new nonce, etc
-            await self.workers.close_all_connections()
+            disconnected = asyncio.get_event_loop().time()
+            self.proxy.metrics.pool_disconnects.inc()
+
+            if self.is_session:
+                # an extra session isn't reconnected; its workers move over
+                # to the other sessions, and more are opened as needed
+                await self.proxy.remove_session(self)
+                return
+
+            self.health.record_disconnect()
+
+            if self.is_active and not await self.proxy.failover(self, disconnected):
+                if self.keep_workers_connected:
+                    # workers are kept connected (extra sessions carry on as
+                    # they are), their shares rejected as stale, or journaled,
+                    # until the pool's back; then they're brought across to
+                    # its nonce space, target and job (see `resume_workers`).
+                    # Failed attempts at reconnecting end up here too; the
+                    # workers are still on the nonce space from before
+                    if self.resuming is None:
+                        self.resuming = (self.extra_nonce1, self.extra_nonce2_size)
+                        logger.warning("{} pool connection lost, keeping {} workers connected while reconnecting".format(
+                            self.log_prefix, len(self.workers.get_clients(self))))
+                else:
+                    # All client connections will need to be closed so they
+                    # auto-reconnect to resubscribe for the new nonce, etc
+                    await self.workers.close_all_connections()
+                    await self.proxy.close_sessions()
+
+                # with a share journal, jobs are kept around so shares for them
+                # can still be journaled; the pool's next `clean_jobs` retires
+                # them (along with journaled shares for any other block)
+                self.reset_session(keep_jobs=self.share_journal is not None)
+
+                await self.use_next_pool_config()
+            else:
+                # either a standby connection dropped, or a standby has just
+                # taken over from this connection; either way, it'll be
+                # reconnected (as a standby) in the background
+                self.reset_session()
 
-            self.jobs.clear()
-            self.current_job = None
+            # reconnected right away (unless it's being backed off)
+            self.proxy.supervisor.wakeup()
 
-            self.authorized_workers.clear()
-            self.unauthorized_workers.clear()
+    async def close(self):
+        await super().close()
 
-            await self.use_next_pool_config()
+        if self.share_journal is not None:
+            await self.share_journal.close()
 
     # async def _DELETE_THIS_test_method(self):
     #     await asyncio.sleep(4)
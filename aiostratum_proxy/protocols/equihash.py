@@ -1,21 +1,48 @@
+import hashlib
 import logging
+import os
 
 from .. import app_version
 from ..errors import *
+from ..utils import get_setting
+from ..verifier import EquihashVerifier
 from .stratum import BaseStratumPoolProtocol, BaseStratumWorkerProtocol
 
 logger = logging.getLogger(__name__)
 
 
 class EquihashWorkerProtocol(BaseStratumWorkerProtocol):
+    # the share target of difficulty 1 used by Equihash pools
+    diff1_target = int('0007' + 'f' * 60, 16)
+
+    def __init__(self, proxy, connection_settings, *args, **kwargs):
+        super().__init__(proxy, connection_settings, *args, **kwargs)
+
+        # optionally verify share solutions before they're accepted
+        if self.settings.get('verify_solutions', False):
+            n = get_setting(self.settings, 'equihash_n', 200, minimum=1, log_prefix=self.log_prefix)
+            k = get_setting(self.settings, 'equihash_k', 9, minimum=1, log_prefix=self.log_prefix)
+            personalization = self.settings.get('equihash_personalization') or 'ZcashPoW'
+            processes = get_setting(
+                self.settings, 'verify_processes', os.cpu_count() or 1, minimum=1, log_prefix=self.log_prefix)
+            try:
+                self.verifier = EquihashVerifier(n, k, personalization, processes)
+            except ConfigurationError as e:
+                logger.warning("{} {}, not verifying solutions".format(self.log_prefix, e))
+            else:
+                logger.info("{} verifying Equihash {},{} ({}) solutions in {} processes".format(
+                    self.log_prefix, n, k, personalization, processes))
+
     async def hook_post_subscribe(self, connection):
+        pool = self.get_pool(connection)
+
         # checks around these to ensure the first miner connecting doesn't get
         # sent these notification before the pool sends this proxy the initial
         # values for them! (otherwise, we send junk values)
-        if self.pool.target_difficulty is not None:
-            await connection.rpc('mining.set_target', [self.pool.target_difficulty], is_notification=True)
-        if self.pool.current_job is not None:
-            await connection.rpc('mining.notify', self.pool.current_job, is_notification=True)
+        if pool.target_difficulty is not None:
+            await self.send_target(connection, pool)
+        if pool.current_job is not None:
+            await connection.rpc('mining.notify', pool.current_job, is_notification=True)
 
     async def hook_validate_share_params(self, connection, params):
         if len(params) == 5:
@@ -24,22 +51,67 @@ class EquihashWorkerProtocol(BaseStratumWorkerProtocol):
 
             # handle the distinct nonce spacing by prepending the nonce1
             # tail to the nonce2 from the worker
-            nonce2 = connection.extra['extra_nonce1_tail'] + params[-2]
+            nonce2 = connection.worker.extra_nonce1_tail + params[-2]
             params[-2] = nonce2
 
-            if job_id not in self.pool.jobs:
+            pool = self.get_pool(connection)
+            if job_id not in pool.jobs:
                 raise JSONRPCJobNotFound
 
-            check = (job_id, nonce2)
-            if check in self.recent_shares:
+            # workers on different upstream sessions have different
+            # extra_nonce1s, so the same nonce2 isn't a duplicate across them
+            share = nonce2 if pool is self.pool else pool.extra_nonce1 + nonce2
+            if not self.recent_shares.add(job_id, share):
                 raise JSONRPCDuplicateShare
 
-            self.recent_shares.append(check)
-
             return params
 
         raise JSONRPCInvalidParams
 
+    def hook_prepare_job(self, params):
+        # job_id, version, prevhash, merkleroot, reserved, time, bits, clean_jobs;
+        # the header up to the time, and the bits that follow it
+        return bytes.fromhex(''.join(params[1:5])), bytes.fromhex(params[6])
+
+    def get_share_header(self, job_data, pool, params):
+        # account_name, job_id, time, nonce2 (tail included), equihash_solution;
+        # the 140 byte header, without the solution
+        header_start, bits = job_data
+        return header_start + bytes.fromhex(params[2]) + bits + bytes.fromhex(pool.extra_nonce1 + params[3])
+
+    def hook_share_hash(self, connection, job_data, pool, params):
+        if job_data is None:
+            return None
+
+        # the block header hash covers the solution too
+        header = self.get_share_header(job_data, pool, params)
+        digest = hashlib.sha256(hashlib.sha256(header + bytes.fromhex(params[4])).digest()).digest()
+        return int.from_bytes(digest, 'little')
+
+    async def hook_verify_share(self, connection, pool, params):
+        job_data = self.get_job_data(pool, params[1])
+        if job_data is None:
+            return True
+
+        try:
+            header = self.get_share_header(job_data, pool, params)
+            solution = bytes.fromhex(params[4])
+        except (ValueError, TypeError):
+            raise JSONRPCInvalidParams
+
+        # not worth a trip to the process pool
+        if not solution:
+            raise JSONRPCInvalidSolution
+
+        return await self.verifier.verify(header, solution)
+
+    def hook_pool_target(self, pool):
+        # pools send the target as 256-bit big-endian hex
+        try:
+            return int(pool.target_difficulty, 16)
+        except (TypeError, ValueError):
+            return None
+
 
 class EquihashPoolProtocol(BaseStratumPoolProtocol):
     async def hook_subscription_request_params(self):
@@ -53,6 +125,10 @@ class EquihashPoolProtocol(BaseStratumPoolProtocol):
     # async def hook_extra_nonce2_size(self):
     #     return int(32 - len(self.extra_nonce1) / 2)
 
+    def get_job_block(self, params):
+        # job_id, version, prevhash, ...
+        return params[2] if len(params) > 2 else None
+
     async def hook_validate_job_params(self, params):
         # normally only 8 params, some pools send another bool at the end
         if len(params) in (8, 9):
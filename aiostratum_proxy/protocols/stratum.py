@@ -1,24 +1,105 @@
 import asyncio
+from collections import OrderedDict
+import hashlib
 import logging
+import struct
 
 from .. import app_version
+from ..accounting import ShareStats
 from ..errors import *
+from ..utils import get_setting
+from ..vardiff import VarDiff
 from . import BaseWorkerProtocol, BasePoolProtocol
 
 logger = logging.getLogger(__name__)
 
 
 class BaseStratumWorkerProtocol(BaseWorkerProtocol):
+    # protocols supporting vardiff (and local share difficulty checks) set
+    # the share target of difficulty 1, and the method workers are sent
+    # their targets with
+    diff1_target = None
+    worker_target_method = 'mining.set_target'
+
+    # whether shares are checked against the pool's target before they're
+    # sent on, without vardiff (see `check_share_targets` setting)
+    check_share_targets = False
+
+    vardiff_fut = None
+
+    # optional local solution verification (see hook_verify_share)
+    verifier = None
+
+    # optional per-worker share accounting (see `share_stats` setting)
+    share_stats = None
+
+    def __init__(self, proxy, connection_settings, *args, **kwargs):
+        super().__init__(proxy, connection_settings, *args, **kwargs)
+
+        # variable difficulty; each worker is sent a share target of its own,
+        # shares are checked against it here, and only those meeting the
+        # pool's target are passed on
+        self.vardiff = bool(self.settings.get('vardiff', False))
+        if self.vardiff and self.diff1_target is None:
+            logger.warning("{} vardiff isn't supported by this protocol, disabling it".format(self.log_prefix))
+            self.vardiff = False
+
+        if self.vardiff:
+            self.vardiff_share_interval = get_setting(
+                self.settings, 'vardiff_share_interval', 10, cast=float, minimum=0.1, log_prefix=self.log_prefix)
+            self.vardiff_retarget_interval = get_setting(
+                self.settings, 'vardiff_retarget_interval', 60, cast=float, minimum=1, log_prefix=self.log_prefix)
+            min_difficulty = get_setting(
+                self.settings, 'vardiff_min_difficulty', 1, cast=float, minimum=1e-9, log_prefix=self.log_prefix)
+            self.vardiff_easiest_target = int(self.diff1_target / min_difficulty)
+
+            logger.info("{} vardiff enabled, aiming for a share every {}s per worker".format(
+                self.log_prefix, self.vardiff_share_interval))
+
+        self.check_share_targets = bool(self.settings.get('check_share_targets', self.check_share_targets))
+
+        # data prepared from recent jobs for local share checks, keyed by
+        # (pool connection, job id)
+        self.job_data = OrderedDict()
+
+        if self.settings.get('share_stats'):
+            flush_interval = get_setting(
+                self.settings, 'share_stats_flush_interval', 60, cast=float, minimum=1, log_prefix=self.log_prefix)
+            try:
+                self.share_stats = ShareStats(
+                    self.settings['share_stats'], self.proxy.name, self.diff1_target, flush_interval,
+                    get_setting(self.settings, 'share_stats_max_workers', 65536, minimum=1,
+                                log_prefix=self.log_prefix))
+            except ConfigurationError as e:
+                logger.warning("{} {}, not recording share stats".format(self.log_prefix, e))
+            else:
+                logger.info("{} recording share stats to {}".format(self.log_prefix, self.settings['share_stats']))
+
+    async def initialize(self):
+        await super().initialize()
+        if self.vardiff:
+            self.vardiff_fut = asyncio.ensure_future(self.vardiff_retargeter())
+
+    async def close(self):
+        if self.vardiff_fut:
+            self.vardiff_fut.cancel()
+        await super().close()
+        if self.verifier is not None:
+            self.verifier.close()
+        if self.share_stats is not None:
+            await self.share_stats.close()
+
     async def hook_get_subscription_response_params(self, connection):
-        extra_nonce1_tail = connection.extra.get('extra_nonce1_tail') or ''
+        extra_nonce1_tail = connection.worker.extra_nonce1_tail
+        pool = self.get_pool(connection)
 
         # `None` here because we don't need to support resuming subscriptions
-        params = [None, self.pool.extra_nonce1 + extra_nonce1_tail]
+        params = [None, pool.extra_nonce1 + extra_nonce1_tail]
 
-        # if self.pool.extra_nonce2_size is `None`, it's a stratum-like
+        # if pool.extra_nonce2_size is `None`, it's a stratum-like
         # protocol that doesn't pass it around (ie. zcash & derivatives)
-        if self.pool.extra_nonce2_size is not None:
-            params.append(int(self.pool.extra_nonce2_size - len(extra_nonce1_tail) / 2))
+        if pool.extra_nonce2_size is not None:
+            params.append(int(pool.extra_nonce2_size - len(extra_nonce1_tail) / 2))
 
         return params
 
@@ -38,6 +119,7 @@ class BaseStratumWorkerProtocol(BaseWorkerProtocol):
         # problematic
 
     async def handle_mining_subscribe(self, connection, params, **kwargs):
+        connection.worker.subscribed = True
         asyncio.ensure_future(self.hook_post_subscribe(connection))
         return await self.hook_get_subscription_response_params(connection)
 
@@ -50,6 +132,12 @@ class BaseStratumWorkerProtocol(BaseWorkerProtocol):
         else:
             raise JSONRPCInvalidParams
 
+        # workers kept connected while the pool's being reconnected wait
+        # for it, just like newly connected workers
+        pool = self.get_pool(connection)
+        if not pool.is_ready():
+            await pool.wait_until_ready()
+
         # possible future auth ideas:
         # - proxy settings define the auth user/pass params for the pool connection
         #   - but enforce worker user/pass auth through local proxy settings (so not just anyone can join)
@@ -58,16 +146,259 @@ class BaseStratumWorkerProtocol(BaseWorkerProtocol):
         #   we'd store if the user was already authed
         #   - multiple miners can use the same user/pass OR use separate credentials
 
-        return await self.pool.authorize(account_name, account_password)
+        result = await pool.authorize(account_name, account_password)
+        if result:
+            # remembered, to authorize the worker again should the pool
+            # connection be re-established under it
+            connection.worker.add_account(account_name, account_password)
+        return result
 
     async def handle_mining_submit(self, connection, params, **kwargs):
+        share_stats = self.share_stats
+        if share_stats is not None:
+            # only accounts this worker's authorized are accounted (taken
+            # before the share's params are rewritten for the pool)
+            worker_name = params[0] if isinstance(params, list) and params else None
+            if connection.worker.get_account_password(worker_name) is None:
+                share_stats = None
+            else:
+                difficulty = self.get_share_difficulty(connection)
+
+        try:
+            result = await self.submit_share(connection, params)
+        except JSONRPCError as e:
+            connection.worker.rejected += 1
+            self.proxy.metrics.record_refused(e)
+            if share_stats is not None:
+                share_stats.record_rejected(worker_name, e)
+            raise
+
+        if result:
+            connection.worker.accepted += 1
+            if share_stats is not None:
+                share_stats.record_accepted(worker_name, difficulty)
+        else:
+            connection.worker.rejected += 1
+            if share_stats is not None:
+                share_stats.record_rejected(worker_name)
+        return result
+
+    def get_share_difficulty(self, connection):
+        # the difficulty the worker's shares are found at (its own target's,
+        # with vardiff), or `None` if it's not known
+        if self.diff1_target is None:
+            return None
+        vardiff = connection.worker.vardiff
+        target = vardiff.target if vardiff is not None else self.hook_pool_target(self.get_pool(connection))
+        return self.diff1_target / target if target else None
+
+    async def submit_share(self, connection, params):
         params = await self.hook_validate_share_params(connection, params)
-        return await self.pool.submit(params)
+        pool = self.get_pool(connection)
+
+        forward = True
+        if self.vardiff or self.check_share_targets or self.verifier is not None:
+            forward = self.check_share_target(connection, pool, params)
+
+        if self.verifier is not None and not await self.hook_verify_share(connection, pool, params):
+            raise JSONRPCInvalidSolution
+
+        if not forward:
+            # good enough for the worker's target, but not for the pool's
+            self.proxy.metrics.shares_absorbed.inc()
+            return True
+
+        # sent under the password this worker authorized the account with
+        return await pool.submit(params, connection.worker.get_account_password(params[0]))
+
+    def hook_prepare_job(self, params):
+        # anything worth working out once per job for hook_share_hash
+        return None
+
+    def hook_share_hash(self, connection, job_data, pool, params):
+        # the hash of a submitted share as an integer (to compare against
+        # share targets), or `None` if it can't be checked locally
+        return None
+
+    async def hook_verify_share(self, connection, pool, params):
+        # whether a submitted share's solution is valid (with a `verifier`)
+        return True
+
+    def hook_pool_target(self, pool):
+        # the pool's current share target as an integer
+        return None
+
+    def hook_encode_target(self, target):
+        # params to send a worker its target with
+        return ['{:064x}'.format(target)]
+
+    def get_job_data(self, pool, job_id):
+        params = pool.jobs.get(job_id)
+        if params is None:
+            return None
+
+        key = (pool, job_id)
+        cached = self.job_data.get(key)
+        # the same job id can come round again with different params (ie.
+        # after a reconnection), so the params are checked too
+        if cached is None or cached[0] is not params:
+            cached = self.job_data[key] = (params, self.hook_prepare_job(params))
+            while len(self.job_data) > 16:
+                self.job_data.popitem(last=False)
+
+        return cached[1]
+
+    def check_share_target(self, connection, pool, params):
+        # returns whether the share meets the pool's target (and so should
+        # be sent on); shares that don't meet the worker's own are rejected
+        try:
+            share_hash = self.hook_share_hash(connection, self.get_job_data(pool, params[1]), pool, params)
+        except (ValueError, TypeError, IndexError):
+            raise JSONRPCInvalidParams
+
+        vardiff = connection.worker.vardiff
+        pool_target = self.hook_pool_target(pool)
+        if share_hash is None or pool_target is None:
+            return True
+
+        if vardiff is None:
+            # no vardiff (or no target sent yet); shares are checked against
+            # the pool's target
+            if share_hash > pool_target:
+                raise JSONRPCLowDifficultyShare
+            return True
+
+        if share_hash > vardiff.accept_target:
+            raise JSONRPCLowDifficultyShare
+
+        vardiff.record_share()
+        self.retarget(connection, vardiff, asyncio.get_event_loop().time())
+
+        return share_hash <= pool_target
+
+    def get_worker_target_range(self, pool):
+        # workers get pool's target at the hardest, so they never hold back
+        # shares the pool would accept
+        hardest = self.hook_pool_target(pool)
+        return hardest, max(self.vardiff_easiest_target, hardest)
+
+    def send_worker_target(self, connection, target, now):
+        self.send_notification(connection, self.encode_notification(
+            self.worker_target_method, self.hook_encode_target(target)), now)
+
+    def retarget(self, connection, vardiff, now):
+        hardest, easiest = self.get_worker_target_range(self.get_pool(connection))
+        target = vardiff.retarget(
+            now, self.vardiff_share_interval, self.vardiff_retarget_interval, hardest, easiest)
+        if target is not None:
+            logger.debug("{} worker {} retargeted to difficulty {:.4g}".format(
+                self.log_prefix, connection.peername, self.diff1_target / target))
+            self.send_worker_target(connection, target, now)
+
+    async def vardiff_retargeter(self):
+        # workers that haven't sent a share in a while don't get retargeted
+        # on submission, so they're checked on here
+        loop = asyncio.get_event_loop()
+        while not self.stopping:
+            await asyncio.sleep(self.vardiff_retarget_interval)
+
+            now = loop.time()
+            for connection in list(self.clients.keys()):
+                vardiff = connection.worker.vardiff
+                if vardiff is not None and now - vardiff.since >= self.vardiff_retarget_interval:
+                    self.retarget(connection, vardiff, now)
+
+    async def send_target(self, connection, pool):
+        # a newly subscribed worker's first target
+        if not self.vardiff or self.hook_pool_target(pool) is None:
+            await connection.rpc(pool.target_method, [pool.target_difficulty], is_notification=True)
+            return
+
+        now = asyncio.get_event_loop().time()
+        vardiff = connection.worker.vardiff = VarDiff(self.hook_pool_target(pool), now)
+        self.send_worker_target(connection, vardiff.target, now)
+
+    async def broadcast_target(self, method, params, received=None, pool=None):
+        pool = pool or self.pool
+        if not self.vardiff or self.hook_pool_target(pool) is None:
+            return await self.broadcast(method, params, is_notification=True, received=received, pool=pool)
+
+        # the pool's target changed; workers with a harder target than the
+        # pool's are brought up to it, the rest carry on as they are
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        hardest = self.hook_pool_target(pool)
+        data = None
+        for connection in self.get_clients(pool):
+            vardiff = connection.worker.vardiff
+            if vardiff is None:
+                # (connected before the pool sent its first target)
+                connection.worker.vardiff = VarDiff(hardest, now)
+            elif vardiff.target < hardest:
+                vardiff.set_target(hardest, now)
+            else:
+                continue
+
+            if data is None:
+                data = self.encode_notification(self.worker_target_method, self.hook_encode_target(hardest))
+            self.send_notification(connection, data, now)
+
+        return loop.time() - (received or now)
+
+    async def handle_mining_extranonce_subscribe(self, connection, params, **kwargs):
+        # the proxy takes care of extra_nonce1 changes itself (the pool's, or
+        # a new pool connection's), whether or not the pool supports this
+        connection.worker.extranonce_subscribed = True
+        return True
+
+    def broadcast_extra_nonce(self, pool):
+        # sends every worker mining on `pool` its new extra_nonce1 (the
+        # pool's, with the worker's tail) and extra_nonce2 size, in a single
+        # pass; the notification is encoded once per tail length, and each
+        # worker's tail spliced in. Workers that haven't subscribed to
+        # extranonce changes, or are too backlogged to be sent it, are
+        # dropped, to reconnect
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+
+        templates = {}
+        sent, dropped = 0, 0
+        for connection in self.get_clients(pool):
+            worker = connection.worker
+            if worker.dropping:
+                continue
+            if not worker.subscribed:
+                # (ie. still waiting on the pool) gets the new one when it
+                # subscribes
+                continue
+            if not worker.extranonce_subscribed:
+                self.drop_connection(connection)
+                dropped += 1
+                continue
+
+            tail = worker.extra_nonce1_tail
+            template = templates.get(len(tail))
+            if template is None:
+                # extra_nonce2_size is only set if the coin/algo supports it
+                # (eg. zcash/zclassic do not)
+                extra_nonce2_size = pool.extra_nonce2_size
+                if extra_nonce2_size is not None:
+                    extra_nonce2_size = int(extra_nonce2_size - len(tail) / 2)
+                template = templates[len(tail)] = self.encode_notification(
+                    'mining.set_extranonce', [pool.extra_nonce1 + '<tail>', extra_nonce2_size]).split(b'<tail>')
+
+            # unlike jobs, a missed extra_nonce1 can't be made up for by the
+            # next one; backlogged workers would carry on mining on the old
+            # one, so they're dropped too
+            if self.send_notification(connection, template[0] + tail.encode() + template[1], now):
+                sent += 1
+            else:
+                self.drop_connection(connection)
+                dropped += 1
+
+        logger.debug('{} mining.set_extranonce fan-out to {} workers ({} dropped) took {:.3f}ms'.format(
+            self.log_prefix, sent, dropped, (loop.time() - now) * 1000))
 
-    # async def handle_mining_extranonce_subscribe(self, connection, params, **kwargs):
-    #     connection.extra['subscriptions']['mining.extranonce.subscribe'] = True
-    #     return True
-    #
     # async def handle_mining_suggest_difficulty(self, connection, params, **kwargs):
     #     pass
     #
@@ -80,12 +411,64 @@ class BaseStratumWorkerProtocol(BaseWorkerProtocol):
 
 
 class BaseStratumPoolProtocol(BasePoolProtocol):
+    # the method the pool last used to set the share target, so it can be
+    # repeated to the workers when this pool connection takes over
+    target_method = 'mining.set_target'
+
+    # the block the pool's latest job builds on (see get_job_block)
+    current_block = None
+
     async def initialize(self):
         await super().initialize()
 
         await self.subscribe()
         await self.extranonce_subscribe()
 
+        if self.resuming is not None:
+            await self.resume_workers()
+        elif self in self.proxy.standby_pools:
+            # a hot standby; authorize the workers mining on the active pool
+            # (extra sessions authorize their own workers as they come)
+            accounts = self.proxy.pool.miner_accounts
+            await asyncio.gather(*[self.authorize(n, p) for n, p in list(accounts.items())])
+
+    async def resume_workers(self):
+        # the pool's been reconnected under workers that were kept connected;
+        # they're authorized again, and moved over to the new nonce space if
+        # it's changed (workers unable to take a new extra_nonce1 are dropped,
+        # to reconnect)
+        resuming, self.resuming = self.resuming, None
+
+        if (self.extra_nonce1, self.extra_nonce2_size) != resuming:
+            self.push_extra_nonce()
+            # anything sent in the meantime went out ahead of the new nonce
+            if self.target_difficulty is not None:
+                await self.workers.broadcast_target(self.target_method, [self.target_difficulty], pool=self)
+            if self.current_job is not None:
+                await self.workers.broadcast('mining.notify', self.current_job, is_notification=True, pool=self)
+
+        clients = [c for c in self.workers.get_clients(self) if not c.worker.dropping]
+        accounts = {}
+        for connection in clients:
+            accounts.update(connection.worker.accounts or ())
+        await asyncio.gather(*[self.authorize(n, p) for n, p in accounts.items()])
+
+        logger.info("{} pool reconnected, resumed {} workers ({} accounts){}".format(
+            self.log_prefix, len(clients), len(accounts),
+            '' if (self.extra_nonce1, self.extra_nonce2_size) == resuming else ' with a new extra_nonce1'))
+
+    async def activate(self, previous):
+        self.workers.recent_shares.clear()
+
+        # workers mining on the previous pool need to move over to this pool's
+        # nonce space, then get this pool's target and latest job
+        if (self.extra_nonce1, self.extra_nonce2_size) != (previous.extra_nonce1, previous.extra_nonce2_size):
+            self.push_extra_nonce()
+        if self.target_difficulty is not None:
+            await self.workers.broadcast_target(self.target_method, [self.target_difficulty])
+        if self.current_job is not None:
+            await self.workers.broadcast('mining.notify', self.current_job, is_notification=True)
+
     async def hook_subscription_request_params(self):
         # This is in its own method to allow subclassing for future coins.
         return []
@@ -104,6 +487,12 @@ class BaseStratumPoolProtocol(BasePoolProtocol):
         # most stratum-based protocols seem to have job id first and clean_jobs last
         return params[0], params[-1]
 
+    def get_job_block(self, params):
+        # identifies the block a job builds on (ie. the previous block hash),
+        # used to compare how quickly pools deliver new blocks; `None` if
+        # the protocol doesn't support it
+        return None
+
     async def hook_set_target(self, params):
         try:
             self.target_difficulty = params[0]
@@ -111,7 +500,10 @@ class BaseStratumPoolProtocol(BasePoolProtocol):
             raise JSONRPCInvalidParams
 
     async def subscribe(self):
-        response = await self.connection.rpc('mining.subscribe', await self.hook_subscription_request_params())
+        # a pool that accepts the connection but never answers is given up
+        # on like one that can't be reached
+        response = await self.connection.rpc(
+            'mining.subscribe', await self.hook_subscription_request_params(), timeout=self.connect_timeout)
         if not response.success:
             logger.warning('{} mining.subscribe response error code {}, message "{}"'.format(
                 self.log_prefix, response.data.get('code'), response.data.get('msg')))
@@ -157,12 +549,18 @@ class BaseStratumPoolProtocol(BasePoolProtocol):
                 logger.info("{} pool doesn't support 'mining.extranonce.subscribe'".format(self.log_prefix))
         return False
 
-    def is_authorized(self, account_name, account_password):
-        if account_name in self.authorized_workers:
-            return self.authorized_workers.get(account_name) == account_password
-        return False
+    @property
+    def passthrough_credentials(self):
+        # pass-through mode: workers are authorized with the pool using their
+        # own credentials, rather than the pool settings' account; set per
+        # pool or for the whole proxy
+        return self.connection_settings.get(
+            'passthrough_credentials', self.settings.get('passthrough_credentials', False))
 
     def get_auth_params(self, miner_account_name, miner_account_password):
+        if self.passthrough_credentials:
+            return miner_account_name, miner_account_password
+
         paccount_name = self.connection_settings.get('account_name', '')
         paccount_password = self.connection_settings.get('account_password', '')
         if not paccount_name:
@@ -184,42 +582,170 @@ class BaseStratumPoolProtocol(BasePoolProtocol):
     async def authorize(self, account_name, account_password):
         paccount_name, paccount_password = self.get_auth_params(account_name, account_password)
 
-        if self.is_authorized(paccount_name, paccount_password):
-            return True
+        result = self.authorizations.get(paccount_name, paccount_password, asyncio.get_event_loop().time())
+        if result is None:
+            # rigs authorizing the same account at the same time share a
+            # single request to the pool
+            key = (paccount_name, paccount_password)
+            pending = self.pending_authorizations.get(key)
+            if pending is None:
+                pending = self.pending_authorizations[key] = asyncio.ensure_future(
+                    self.request_authorization(paccount_name, paccount_password))
+                pending.add_done_callback(lambda fut: self.authorization_done(key, fut))
+            result = await asyncio.shield(pending)
+
+        # only credentials the pool's granted are remembered; a denied
+        # attempt leaves whatever was granted before alone
+        if result:
+            if self.is_active and self.miner_accounts.get(account_name) != account_password:
+                # get hot standby pools authorized ahead of them taking over
+                for standby in self.proxy.standby_pools:
+                    if standby.is_ready():
+                        asyncio.ensure_future(standby.authorize(account_name, account_password))
+            self.miner_accounts.add(account_name, account_password)
 
-        result = False
-        if paccount_name and paccount_name not in self.unauthorized_workers:
-            response = await self.connection.rpc('mining.authorize', [paccount_name, paccount_password])
-            if response.success:
-                result = response.data
-                if result:
-                    self.authorized_workers[paccount_name] = paccount_password
-                else:
-                    logger.warning("{} pool authorization denied".format(self.log_prefix))
-                    self.unauthorized_workers.add(paccount_name)
+        return result
+
+    def authorization_done(self, key, fut):
+        # (the pool connection may have been reset, and the same account
+        # authorized again, in the meantime)
+        if self.pending_authorizations.get(key) is fut:
+            del self.pending_authorizations[key]
+
+    async def request_authorization(self, paccount_name, paccount_password):
+        if not paccount_name:
+            return False
+
+        response = await self.connection.rpc('mining.authorize', [paccount_name, paccount_password])
+        result = bool(response.success and response.data)
+        if not result:
+            logger.warning("{} pool authorization denied{}".format(
+                self.log_prefix, " for '{}'".format(paccount_name) if self.passthrough_credentials else ''))
 
+        self.authorizations.set(paccount_name, paccount_password, result, asyncio.get_event_loop().time())
         return result
 
-    async def submit(self, params):
+    def set_ready(self):
+        was_ready = self.is_ready()
+        super().set_ready()
+
+        if not was_ready and self.share_journal:
+            asyncio.ensure_future(self.replay_journal())
+
+    async def replay_journal(self):
+        entries = self.share_journal.pop_all()
+
+        # shares are only valid for the extra_nonce1 they were found with,
+        # and for jobs on the block the pool's still working on (or jobs
+        # it's still got, when blocks aren't known)
+        block = self.get_job_block(self.current_job) if self.current_job is not None else None
+        valid, invalid = [], []
+        for entry in entries:
+            en1, job_id, entry_block = entry[:3]
+            if en1 == self.extra_nonce1 and (job_id in self.jobs or (block is not None and entry_block == block)):
+                valid.append(entry)
+            else:
+                invalid.append(entry)
+        self.share_journal.fail(invalid)
+
+        logger.info("{} replaying {} journaled shares ({} no longer valid)".format(
+            self.log_prefix, len(valid), len(invalid)))
+
+        results = await asyncio.gather(*[self.replay_share(e[3]) for e in valid], return_exceptions=True)
+        for entry, result in zip(valid, results):
+            self.share_journal.resolve(entry, result)
+
+        logger.info("{} {} of {} journaled shares accepted".format(
+            self.log_prefix, len([r for r in results if r is True]), len(valid)))
+
+    async def replay_share(self, params):
+        # the worker that found the share may not have reconnected (and
+        # re-authorized) yet; it's sent under the credentials the pool last
+        # granted the account, if they're still known
+        return await self.submit(params, self.miner_accounts.get(params[0]))
+
+    async def submit(self, params, account_password=None):
+        # `account_password` is the one the submitting worker authorized the
+        # account with (`None` if it hasn't)
+        if not self.connected or not self.is_ready():
+            # pool is unavailable; journal the share if it's for a job
+            # that might still be valid when the pool is back
+            if self.share_journal is not None and params[1] in self.jobs:
+                journaled = self.share_journal.append(
+                    self.extra_nonce1, params[1], self.get_job_block(self.jobs[params[1]]), params)
+                logger.debug('{} mining.submit params journaled {}'.format(self.log_prefix, params))
+                # the worker's answered once the share's been replayed (or
+                # dropped as stale); not before, as it may never make it
+                return await journaled
+            # otherwise, it's for a job of the connection that's gone
+            raise JSONRPCJobNotFound
+
         # params[0] is the account_name from the miner, 'translate'
         # it as necessary to the account name we need for the pool
-        paccount_name, paccount_password = self.get_auth_params(params[0], '')
+        paccount_name, paccount_password = self.get_auth_params(params[0], account_password or '')
+
+        loop = asyncio.get_event_loop()
 
-        if not self.is_authorized(paccount_name, paccount_password):
-            raise JSONRPCUnauthorizedWorker
+        authorized = self.authorizations.get(paccount_name, paccount_password, loop.time())
+        if not authorized:
+            # an authorization that's expired (or been dropped from the cache)
+            # is renewed; workers that never authorized are turned away
+            if authorized is False or account_password is None or \
+                    not await self.authorize(params[0], account_password):
+                raise JSONRPCUnauthorizedWorker
 
         params[0] = paccount_name
 
-        logger.debug('{} mining.submit params sent to pool {}'.format(self.log_prefix, params))
-        response = await self.connection.rpc('mining.submit', params)
+        queued = loop.time()
+        await self.submit_window.acquire()
+        try:
+            sent = loop.time()
+
+            logger.debug('{} mining.submit params sent to pool {}'.format(self.log_prefix, params))
+            response = await self.connection.rpc('mining.submit', params)
+
+            rtt = loop.time() - sent
+        finally:
+            self.submit_window.release()
+
+        accepted = bool(response.success and response.data)
+        stale = not accepted and self.is_stale_response(response)
+        self.health.record_share(rtt, accepted, stale=stale)
+        self.proxy.metrics.record_share(rtt, sent - queued, accepted, stale=stale)
+
         return response.success and response.data
 
+    def is_stale_response(self, response):
+        # pools report errors as either [code, message, ...] or
+        # {"code": code, "message": message}
+        data = response.data
+        code = data.get('code') if isinstance(data, dict) else (data[0] if isinstance(data, list) and data else None)
+        return code == JSONRPCJobNotFound().code
+
     async def handle_mining_notify(self, connection, params, **kwargs):
+        received = asyncio.get_event_loop().time()
+
         job_id, clean_jobs = await self.hook_validate_job_params(params)
         if job_id:
+            # how long after the first pool did this one deliver a new block?
+            # (extra sessions get the same jobs from the same pool; they're
+            # only counted once, on the pool's main connection)
+            if not self.is_session:
+                block, delay = self.get_job_block(params), None
+                if block is not None and block != self.current_block:
+                    self.current_block = block
+                    delay = self.proxy.block_arrivals.record(block, received)
+                self.health.record_notify(received, delay)
+
             if clean_jobs:
                 # TODO: abandon/clean all current jobs
                 self.jobs.clear()
+                if self.is_serving:
+                    self.workers.recent_shares.clear()
+                if self.share_journal is not None:
+                    # journaled shares for the same block may still be good
+                    # (ie. the first job of a resumed session)
+                    self.share_journal.retire(self.get_job_block(params))
 
             self.current_job = params
             self.jobs[job_id] = params
@@ -230,18 +756,33 @@ class BaseStratumPoolProtocol(BasePoolProtocol):
                 # as it will be an old job that shouldn't be worked on anymore
                 k, v = next(iter(self.jobs.items()))
                 self.jobs.pop(k)
+                if self.is_serving:
+                    self.workers.recent_shares.drop_job(k)
+                if self.share_journal is not None:
+                    self.share_journal.drop_job(k)
 
-            await self.workers.broadcast('mining.notify', params, is_notification=True)
+            # hot standby pools keep their jobs current, but only the jobs of
+            # the connections workers are mining on go out to (those) workers
+            if self.is_serving:
+                await self.workers.broadcast('mining.notify', params, is_notification=True, received=received, pool=self)
 
     async def handle_mining_set_target(self, connection, params, **kwargs):
+        received = asyncio.get_event_loop().time()
+
         await self.hook_set_target(params)
-        await self.workers.broadcast('mining.set_target', params, is_notification=True)
+        self.target_method = 'mining.set_target'
+        if self.is_serving:
+            await self.workers.broadcast_target('mining.set_target', params, received=received, pool=self)
 
     async def handle_mining_set_difficulty(self, connection, params, **kwargs):
+        received = asyncio.get_event_loop().time()
+
         # TODO: add another hook for hook_set_difficulty if it
         # needs to be treated differently at the proxy level
         await self.hook_set_target(params)
-        await self.workers.broadcast('mining.set_difficulty', params, is_notification=True)
+        self.target_method = 'mining.set_difficulty'
+        if self.is_serving:
+            await self.workers.broadcast_target('mining.set_difficulty', params, received=received, pool=self)
 
     async def handle_client_get_version(self, connection, params, **kwargs):
         return app_version
@@ -249,7 +790,8 @@ class BaseStratumPoolProtocol(BasePoolProtocol):
     async def handle_client_show_message(self, connection, params, **kwargs):
         if len(params) != 1:
             raise JSONRPCInvalidParams
-        await self.workers.broadcast('client.show_message', params)
+        if self.is_serving:
+            await self.workers.broadcast('client.show_message', params, is_notification=True, pool=self)
 
     async def handle_mining_set_extranonce(self, connection, params, **kwargs):
         if len(params) != 2:
@@ -257,28 +799,11 @@ class BaseStratumPoolProtocol(BasePoolProtocol):
 
         self.set_extra_nonce_data(*params[:2])
 
-        for conn in self.workers.clients.keys():
-            # has the user subscribed to receive new extranonce notifications?
-            if conn.extra.get('subscriptions', {}).get('mining.extranonce.subscribe'):
-                tail = conn.extra.get('extra_nonce1_tail')
-                if tail:
-                    # copy the params...
-                    _p = params[:]
-
-                    # ... so we can add the connection's nonce 'tail' on (maintains
-                    # distinct nonce spaces between multiple workers)
-                    _p[0] = _p[0] + tail
+        if self.is_serving:
+            self.push_extra_nonce()
 
-                    # extra_nonce2_size is only set if the coin/algo supports it
-                    # (eg. zcash/zclassic do not)
-                    if self.extra_nonce2_size is not None:
-                        _p[1] = int(self.extra_nonce2_size - len(tail) / 2)
-
-                    await conn.rpc('mining.set_extranonce', _p, True)
-            else:
-                # Need to drop worker connections that aren't able (haven't subscribed!)
-                # to receive new extranonce values? So they'll reconnect...
-                self.workers.close_connection(conn)
+    def push_extra_nonce(self):
+        self.workers.broadcast_extra_nonce(self)
 
     # async def handle_client_reconnect(self, connection, params, **kwargs):
     #     pass
@@ -293,11 +818,129 @@ class BaseStratumPoolProtocol(BasePoolProtocol):
     #     pass
 
 
+def sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
 class StratumWorkerProtocol(BaseStratumWorkerProtocol):
-    # TODO: need to implement hooks; these are for bitcoin, litecoin, etc,  I believe?
-    pass
+    # Bitcoin-family (SHA-256d) stratum; shares are checked by rebuilding
+    # the coinbase, merkle root and block header locally
+
+    # the share target of difficulty 1 (bdiff)
+    diff1_target = 0xffff << 208
+    worker_target_method = 'mining.set_difficulty'
+
+    # cheap enough to always do
+    check_share_targets = True
+
+    # BIP 320 version rolling bits, for shares that include version bits
+    version_rolling_mask = 0x1fffe000
+
+    async def hook_post_subscribe(self, connection):
+        pool = self.get_pool(connection)
+
+        # as with Equihash, don't send these before the pool has sent them
+        if pool.target_difficulty is not None:
+            await self.send_target(connection, pool)
+        if pool.current_job is not None:
+            await connection.rpc('mining.notify', pool.current_job, is_notification=True)
+
+    async def hook_validate_share_params(self, connection, params):
+        if len(params) in (5, 6):
+            # account_name, job_id, extra_nonce2, ntime, nonce[, version_bits]
+            job_id = params[1]
+            pool = self.get_pool(connection)
+            extra_nonce1_tail = connection.worker.extra_nonce1_tail
+
+            # the worker's extra_nonce2 is what's left of the pool's after
+            # the nonce1 tail
+            if pool.extra_nonce2_size is not None and \
+                    len(params[2]) != pool.extra_nonce2_size * 2 - len(extra_nonce1_tail):
+                raise JSONRPCInvalidParams
+
+            extra_nonce2 = extra_nonce1_tail + params[2]
+            params[2] = extra_nonce2
+
+            if job_id not in pool.jobs:
+                raise JSONRPCJobNotFound
+
+            share = ''.join(params[2:])
+            if pool is not self.pool:
+                share = pool.extra_nonce1 + share
+            if not self.recent_shares.add(job_id, share):
+                raise JSONRPCDuplicateShare
+
+            return params
+
+        raise JSONRPCInvalidParams
+
+    def hook_prepare_job(self, params):
+        # job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs;
+        # the coinbase hash is carried on from coinb1's state for every share,
+        # and the header fields are put in block (little-endian) byte order
+        prevhash = bytes.fromhex(params[1])
+        return (
+            hashlib.sha256(bytes.fromhex(params[2])),
+            bytes.fromhex(params[3]),
+            [bytes.fromhex(h) for h in params[4]],
+            int(params[5], 16),
+            # stratum sends prevhash with each 4 byte word byte-swapped
+            b''.join([prevhash[i:i + 4][::-1] for i in range(0, 32, 4)]),
+            bytes.fromhex(params[6])[::-1],
+        )
+
+    def get_merkle_root(self, job_data, extra_nonce):
+        coinbase_start, coinb2, merkle_branch = job_data[:3]
+
+        coinbase = coinbase_start.copy()
+        coinbase.update(extra_nonce)
+        coinbase.update(coinb2)
+
+        merkle_root = hashlib.sha256(coinbase.digest()).digest()
+        for h in merkle_branch:
+            merkle_root = sha256d(merkle_root + h)
+        return merkle_root
+
+    def get_header(self, job_data, merkle_root, params):
+        version, prevhash, nbits = job_data[3:]
+        if len(params) > 5:
+            version = (version & ~self.version_rolling_mask) | (int(params[5], 16) & self.version_rolling_mask)
+
+        return struct.pack('<I', version) + prevhash + merkle_root + \
+            bytes.fromhex(params[3])[::-1] + nbits + bytes.fromhex(params[4])[::-1]
+
+    def hook_share_hash(self, connection, job_data, pool, params):
+        if job_data is None:
+            return None
+
+        merkle_root = self.get_merkle_root(job_data, bytes.fromhex(pool.extra_nonce1 + params[2]))
+        return int.from_bytes(sha256d(self.get_header(job_data, merkle_root, params)), 'little')
+
+    def hook_pool_target(self, pool):
+        try:
+            difficulty = float(pool.target_difficulty)
+        except (TypeError, ValueError):
+            return None
+        return int(self.diff1_target / difficulty) if difficulty > 0 else None
+
+    def hook_encode_target(self, target):
+        return [float('{:.8g}'.format(self.diff1_target / target))]
 
 
 class StratumPoolProtocol(BaseStratumPoolProtocol):
-    # TODO: need to implement hooks; these are for bitcoin, litecoin, etc,  I believe?
-    pass
+    async def hook_subscription_request_params(self):
+        # on reconnecting, ask to resume the previous subscription (and get
+        # the same extra_nonce1 back), as pools supporting it allow
+        session_id = self.subscriptions.get('mining.notify')
+        return [app_version, session_id] if session_id else [app_version]
+
+    def get_job_block(self, params):
+        # job_id, prevhash, ...
+        return params[1] if len(params) > 1 else None
+
+    async def hook_validate_job_params(self, params):
+        # job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs
+        if len(params) == 9 and isinstance(params[4], list):
+            return params[0], params[8]
+
+        raise JSONRPCInvalidParams
@@ -0,0 +1,231 @@
+import asyncio
+from collections import deque, OrderedDict
+import json
+import logging
+import os
+
+from .errors import *
+
+logger = logging.getLogger(__name__)
+
+
+class DuplicateShareDetector(object):
+    # Tracks submitted shares per job for duplicate detection.
+    #
+    # Each job gets its own ordered set (an OrderedDict with `None` values)
+    # so membership checks are O(1), memory is bounded to `capacity` entries
+    # per job (oldest entries are dropped first), and every share for a job
+    # can be forgotten at once when the pool retires that job.
+
+    def __init__(self, capacity=16384):
+        self.capacity = max(int(capacity), 1)
+        self.jobs = {}
+
+    def __len__(self):
+        return sum(len(s) for s in self.jobs.values())
+
+    def __contains__(self, job_share):
+        job_id, share = job_share
+        shares = self.jobs.get(job_id)
+        return shares is not None and share in shares
+
+    def add(self, job_id, share):
+        # returns False if the share was already seen for this job
+        shares = self.jobs.get(job_id)
+        if shares is None:
+            shares = self.jobs[job_id] = OrderedDict()
+        elif share in shares:
+            return False
+
+        shares[share] = None
+        if len(shares) > self.capacity:
+            shares.popitem(last=False)
+
+        return True
+
+    def drop_job(self, job_id):
+        self.jobs.pop(job_id, None)
+
+    def clear(self):
+        self.jobs.clear()
+
+
+class ShareJournal(object):
+    # Append-only, on-disk journal of shares that couldn't be sent to the
+    # pool (ie. while it's disconnected), so they can be replayed once the
+    # connection is back - as long as they're still valid. Shares are only
+    # good for the extra_nonce1 they were found with and the block their job
+    # builds on, so a replay only gets anywhere when the reconnected pool
+    # hands back the same extra_nonce1 (resuming the previous subscription)
+    # before a new block comes along; the pool has the final say.
+    #
+    # Each share journaled by a worker comes with a future the worker's
+    # answer waits on: the pool's result once the share's replayed, or a
+    # stale rejection once it's dropped (its job retired, its block
+    # superseded, the journal full). Shares left behind by a previous run
+    # are replayed the same way, with nobody waiting on them.
+    #
+    # The journal is bounded to `max_entries` (oldest shares are dropped
+    # first); writes are batched up and handed to a thread (with a single
+    # fsync per batch) every `flush_interval` seconds, so the event loop
+    # never blocks on disk I/O.
+
+    def __init__(self, path, max_entries=10000, flush_interval=1.0):
+        self.path = path
+        self.max_entries = max(int(max_entries), 1)
+        self.flush_interval = flush_interval
+
+        # (extra_nonce1, job id, block, params, future or `None`)
+        self.entries = deque()
+        self.pending = []
+        self.rewrite = False
+
+        self.flush_handle = None
+        self.flush_future = None
+
+        self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        # pick up anything left behind by a previous run; these will only
+        # be replayed if the pool still considers their job valid
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # most likely a partial write from a crash
+                        continue
+                    if len(entry) == 3:
+                        # journaled before blocks were recorded
+                        extra_nonce1, job_id, params = entry
+                        block = None
+                    else:
+                        extra_nonce1, job_id, block, params = entry
+                    self.entries.append((extra_nonce1, job_id, block, params, None))
+                    if len(self.entries) > self.max_entries:
+                        self.entries.popleft()
+
+            # the file may have held more (or partial lines) than we're keeping
+            self.rewrite = True
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("unable to read share journal {} ({})".format(self.path, e))
+
+    def append(self, extra_nonce1, job_id, block, params):
+        # returns the future the worker's answer waits on
+        future = asyncio.get_event_loop().create_future()
+        entry = (extra_nonce1, job_id, block, params[:], future)
+        if len(self.entries) == self.max_entries:
+            # the oldest entry falls off the journal
+            self.fail([self.entries.popleft()])
+            self.rewrite = True
+        self.entries.append(entry)
+        self.pending.append(entry)
+        self.schedule_flush()
+        return future
+
+    def drop(self, keep):
+        # drops (as stale) the entries `keep` returns false for
+        kept = deque(e for e in self.entries if keep(e))
+        if len(kept) != len(self.entries):
+            self.fail([e for e in self.entries if not keep(e)])
+            self.entries = kept
+            self.rewrite = True
+            self.schedule_flush()
+
+    def drop_job(self, job_id):
+        self.drop(lambda e: e[1] != job_id)
+
+    def retire(self, block):
+        # the pool's retired its jobs (`clean_jobs`) for jobs on `block`;
+        # shares for other blocks (or unknown ones) are stale
+        self.drop(lambda e: block is not None and e[2] == block)
+
+    def clear(self):
+        self.drop(lambda e: False)
+
+    def pop_all(self):
+        entries, self.entries = list(self.entries), deque()
+        if entries:
+            self.rewrite = True
+            self.schedule_flush()
+        return entries
+
+    @staticmethod
+    def resolve(entry, result):
+        # answers the worker waiting on an entry (if there is one) with the
+        # pool's result, or a stale rejection if it couldn't be sent
+        future = entry[4]
+        if future is None or future.done():
+            return
+        if isinstance(result, BaseException):
+            future.set_exception(result if isinstance(result, JSONRPCError) else JSONRPCJobNotFound())
+        else:
+            future.set_result(result)
+
+    def fail(self, entries):
+        for entry in entries:
+            self.resolve(entry, JSONRPCJobNotFound())
+
+    def schedule_flush(self):
+        # a flush that's already queued (or running) will pick this up
+        if self.flush_handle is None and self.flush_future is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+
+        if self.rewrite:
+            # entries were dropped; rewrite the journal with what's left
+            lines, append = [json.dumps(e[:4]) for e in self.entries], False
+        elif self.pending:
+            lines, append = [json.dumps(e[:4]) for e in self.pending], True
+        else:
+            return
+
+        self.pending = []
+        self.rewrite = False
+
+        self.flush_future = asyncio.get_event_loop().run_in_executor(None, self.write, lines, append)
+        self.flush_future.add_done_callback(self.flushed)
+
+    def flushed(self, fut):
+        self.flush_future = None
+        if fut.exception():
+            logger.warning("unable to write share journal {} ({})".format(self.path, fut.exception()))
+
+        # more may have come in while the batch was being written
+        if self.pending or self.rewrite:
+            self.schedule_flush()
+
+    def write(self, lines, append):
+        # runs in a thread; never on the event loop
+        data = ''.join(line + '\n' for line in lines)
+        if append:
+            with open(self.path, 'a') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+
+    async def close(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.flush_future is not None:
+            await asyncio.wait([self.flush_future])
+        if self.pending or self.rewrite:
+            self.flush()
+            if self.flush_future is not None:
+                await asyncio.wait([self.flush_future])
@@ -0,0 +1,147 @@
+import asyncio
+from collections import OrderedDict
+
+from .auth import AuthorizationCache, MinerAccounts
+
+
+def state_property(name):
+    # exposes an attribute of a protocol's `state` object as if it were an
+    # attribute of the protocol itself (ie. `self.pool.jobs`)
+    return property(
+        lambda self: getattr(self.state, name),
+        lambda self, value: setattr(self.state, name, value))
+
+
+class PoolState(object):
+    # Everything tracked for a single pool connection. Kept in one compact
+    # object per connection (rather than class attributes, which are shared
+    # by every instance), so multiple proxies - and hot standby connections
+    # within a proxy - never see each other's jobs, nonces or authorizations.
+    __slots__ = (
+        'ready', 'subscriptions', 'extra_nonce1', 'extra_nonce2_size',
+        'target_difficulty', 'jobs', 'current_job',
+        'authorizations', 'pending_authorizations', 'miner_accounts',
+    )
+
+    def __init__(self, authorizations=None, miner_accounts=None):
+        self.ready = asyncio.Event()
+        self.subscriptions = {}
+        self.extra_nonce1 = None
+        self.extra_nonce2_size = None
+        self.target_difficulty = None
+        self.jobs = OrderedDict()
+        self.current_job = None
+
+        # the pool's answers to `mining.authorize` (see AuthorizationCache),
+        # and the requests still awaiting one, by (account name, password)
+        self.authorizations = authorizations if authorizations is not None else AuthorizationCache()
+        self.pending_authorizations = {}
+
+        # credentials the pool has granted workers, so standby connections
+        # can authorize them ahead of taking over (and journaled shares can
+        # be sent under them)
+        self.miner_accounts = miner_accounts if miner_accounts is not None else MinerAccounts()
+
+    def reset(self, keep_jobs=False):
+        self.ready.clear()
+        if not keep_jobs:
+            self.jobs.clear()
+        self.current_job = None
+        self.authorizations.clear()
+        self.pending_authorizations.clear()
+
+
+class WorkerState(object):
+    # Everything tracked for a proxy's worker (miner) connections.
+    __slots__ = ('clients', 'servers', 'extra_nonce1_tails', 'recent_shares', 'sessions')
+
+    def __init__(self, extra_nonce1_tails, recent_shares):
+        self.clients = {}
+        self.servers = []
+        self.extra_nonce1_tails = extra_nonce1_tails
+        self.recent_shares = recent_shares
+
+        # extra upstream pool sessions, and the workers mining on each
+        self.sessions = {}
+
+
+class SessionState(object):
+    # The workers mining on one of a proxy's extra upstream pool sessions;
+    # each session has its own extra_nonce1, so its own set of tails.
+    __slots__ = ('extra_nonce1_tails', 'clients', 'idle_since')
+
+    def __init__(self, extra_nonce1_tails, now):
+        self.extra_nonce1_tails = extra_nonce1_tails
+        self.clients = set()
+        self.idle_since = now
+
+
+class WorkerSession(object):
+    # Everything tracked for a single worker (miner) connection, kept as
+    # `connection.worker`. One compact record per connection, rather than a
+    # dict (with more dicts inside it), since a proxy can have tens of
+    # thousands of these.
+    __slots__ = (
+        'tails', 'tail_index', 'pool', 'subscribed', 'extranonce_subscribed',
+        'accounts', 'vardiff', 'dropping', 'backlogged_since', 'accepted', 'rejected',
+    )
+
+    def __init__(self):
+        # the worker's extra_nonce1 tail; an index into the precomputed tail
+        # strings of the allocator it came from (see `extra_nonce1_tail`)
+        self.tails = None
+        self.tail_index = None
+
+        # the extra upstream session the worker's mining on (`None` for the
+        # proxy's active pool)
+        self.pool = None
+
+        self.subscribed = False
+        self.extranonce_subscribed = False
+
+        # {account name: password} the worker's been authorized with (the
+        # passwords its shares are sent under); `None` until it authorizes
+        self.accounts = None
+
+        # variable difficulty (see VarDiff), when enabled
+        self.vardiff = None
+
+        # backpressure (see `BaseWorkerProtocol.is_backlogged`)
+        self.dropping = False
+        self.backlogged_since = None
+
+        # shares accepted, and rejected (by the proxy or the pool)
+        self.accepted = 0
+        self.rejected = 0
+
+    @property
+    def extra_nonce1_tail(self):
+        if self.tail_index is None or not self.tails.tail_size:
+            return ''
+        return self.tails.tails[self.tail_index]
+
+    def allocate_tail(self, tails):
+        self.tail_index = tails.allocate()
+        self.tails = tails
+
+    def release_tail(self):
+        # cleared, so a connection cleaned up twice can't release a tail
+        # that's since been handed to another worker
+        if self.tail_index is not None:
+            self.tails.release(self.tail_index)
+            self.tail_index = None
+
+    def add_account(self, account_name, account_password):
+        if self.accounts is None:
+            self.accounts = {}
+        self.accounts[account_name] = account_password
+
+    def get_account_password(self, account_name):
+        # the password the worker authorized the account with, or `None` if
+        # it hasn't (on this connection)
+        if not self.accounts:
+            return None
+        try:
+            return self.accounts.get(account_name)
+        except TypeError:
+            return None
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PoolSupervisor(object):
+    # Keeps a proxy's pool connections up while there are workers to mine
+    # on them. Rather than polling, it runs whenever something happens that
+    # may need it to act - a worker connecting, a pool connection dropping
+    # or failing to get ready, an extra session losing its last worker - and
+    # otherwise sleeps until the next thing it's scheduled: a pool's next
+    # connection attempt (pools that fail back off, see `PoolHealth.backoff`)
+    # or an idle session's closing. With nothing scheduled, it doesn't wake
+    # up at all.
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.stopping = False
+
+        self.wakeup_event = asyncio.Event()
+        self.run_fut = None
+        self.reconnect_fut = None
+
+    def start(self):
+        self.run_fut = asyncio.ensure_future(self.run())
+
+    def wakeup(self):
+        self.wakeup_event.set()
+
+    async def stop(self):
+        self.stopping = True
+        self.wakeup()
+
+        if self.reconnect_fut is not None:
+            self.reconnect_fut.cancel()
+        if self.run_fut is not None:
+            await self.run_fut
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+
+        while not self.stopping:
+            # cleared first; anything happening from here on runs it again
+            self.wakeup_event.clear()
+
+            now = loop.time()
+            deadline = self.supervise(now)
+
+            try:
+                await asyncio.wait_for(
+                    self.wakeup_event.wait(), None if deadline is None else max(deadline - now, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    def supervise(self, now):
+        # acts on whatever's due, and returns when it's next needed (or
+        # `None`, until something happens)
+        proxy = self.proxy
+        deadlines = []
+
+        # pools are only (re)connected while there are workers connected
+        if len(proxy.workers.clients):
+            pool = proxy.pool
+            if not pool.connected and self.reconnect_fut is None:
+                if now >= pool.health.retry_at:
+                    self.reconnect_fut = asyncio.ensure_future(self.reconnect(pool))
+                else:
+                    deadlines.append(pool.health.retry_at)
+
+            # hot standby pool connections are (re)established in the
+            # background, so they're ready to take over at a moment's notice
+            for standby in proxy.standby_pools:
+                if not standby.connected and not standby.connecting:
+                    if now >= standby.health.retry_at:
+                        standby.connecting = True
+                        asyncio.ensure_future(standby.connect_standby())
+                    else:
+                        deadlines.append(standby.health.retry_at)
+
+        # extra upstream sessions nobody's mining on are closed again
+        for session in list(proxy.sessions):
+            state = proxy.workers.sessions.get(session)
+            if state is not None and not state.clients and not session.stopping:
+                idle_until = state.idle_since + proxy.pool_session_idle_timeout
+                if now >= idle_until:
+                    asyncio.ensure_future(proxy.close_session(session))
+                else:
+                    deadlines.append(idle_until)
+
+        return min(deadlines) if deadlines else None
+
+    async def reconnect(self, pool):
+        # a single attempt at getting the active pool connection ready; when
+        # it fails, the pool is backed off and the next pool configuration
+        # (if there's one) is tried straight away
+        connected = False
+        try:
+            await pool.connect()
+            connected = True
+            await pool.initialize()
+            pool.set_ready()
+        except Exception as e:
+            if self.stopping:
+                return
+
+            name = pool.name
+            delay = pool.schedule_retry()
+            logger.warning("{} pool '{}' unavailable ({}), retrying it in {:.1f}s".format(
+                pool.log_prefix, name, str(e) or type(e).__name__, delay))
+
+            if connected:
+                # the pool's own disconnection handling moves it on to the
+                # next pool configuration
+                await pool.close_connection()
+            else:
+                await pool.use_next_pool_config()
+        finally:
+            self.reconnect_fut = None
+            self.wakeup()
@@ -1,8 +1,11 @@
 from datetime import datetime, timezone
 from importlib import import_module
+import logging
 
 from . import app_version
 
+logger = logging.getLogger(__name__)
+
 
 def import_from_module(s):
     p, m = s.rsplit('.', 1)
@@ -10,8 +13,42 @@ def import_from_module(s):
     return getattr(mod, m)
 
 
+def get_pool_name(settings):
+    return settings.get('name') or "|".join([str(settings.get('host')), str(settings.get('port'))])
+
+
+def get_setting(settings, name, default, cast=int, minimum=None, log_prefix=''):
+    # fetch a numeric setting, falling back to the default (with a warning)
+    # when it's present but unusable
+    value = settings.get(name)
+    if value is None:
+        return default
+
+    try:
+        value = cast(value)
+        if minimum is not None and value < minimum:
+            raise ValueError
+    except (ValueError, TypeError):
+        logger.warning("{} invalid '{}' setting ({}), defaulting to {} instead".format(
+            log_prefix, name, settings.get(name), default))
+        return default
+
+    return value
+
+
 default_config = """# This file was generated by {app_version} on {generated_datetime}
 
+## Optionally serve metrics (connected workers, bytes queued to them and
+## how many are backlogged, shares by result and by rejection reason,
+## submit round-trip and notify fan-out latencies, pool (re)connections,
+## bytes in/out, event loop lag) for Prometheus to scrape at
+## http://host:port/metrics. With `processes` > 1, only the coordinator
+## process' metrics are served (its workers being the worker processes)
+
+#metrics:
+#  host: 127.0.0.1
+#  port: 9100
+
 proxies:
 - ## Optional name to give your log output some flair and order
 
@@ -20,18 +57,189 @@ proxies:
   ## max_workers allows the proxy to ensure each worker up to this limit
   ## has a unique nonce-space in which to generate solutions, avoiding
   ## duplicate shares from multiple rigs.
-  ## Options are 1 (solo mode), 256 (the default), or 65536
+  ## Options are 1 (solo mode), 256 (the default), or any other power of
+  ## two up to 65536
 
   #max_workers: 256
 
+  ## Shares are tracked per job to reject duplicate submissions; this is
+  ## the maximum number of shares remembered for each job
+
+  #duplicate_share_capacity: 16384
+
+  ## Workers that stop reading (stalled or slow rigs) have their outgoing
+  ## data buffered; once a worker's buffer exceeds this many bytes it stops
+  ## receiving new notifications, and if it stays over the limit for the
+  ## given number of seconds it's disconnected
+
+  #worker_write_buffer_limit: 65536
+  #worker_write_buffer_timeout: 30
+
+  ## Shares from all workers are pipelined to the pool over a single
+  ## connection; this is the maximum number of shares awaiting the pool's
+  ## response at any one time (the rest are queued)
+
+  #submit_window: 64
+
+  ## Optionally journal shares found while the pool is unavailable to a
+  ## file, sending them to the pool once it's back. That only works out if
+  ## the pool hands the proxy back the same extra_nonce1 (resuming its
+  ## previous subscription, which the proxy asks for) before a new block is
+  ## found; other shares are dropped as stale. Workers get a journaled
+  ## share's answer once it's been sent (or dropped). The journal holds at
+  ## most `share_journal_size` shares, written to disk in batches every
+  ## `share_journal_flush_interval` seconds
+
+  #share_journal: '<path to share journal file>'
+  #share_journal_size: 10000
+  #share_journal_flush_interval: 1.0
+
+  ## Variable difficulty: each worker gets a share target of its own, tuned
+  ## so it finds a share every `vardiff_share_interval` seconds (retargeted
+  ## at most every `vardiff_retarget_interval` seconds), never harder than
+  ## the pool's and never easier than `vardiff_min_difficulty`. Shares are
+  ## checked locally; those missing the worker's target are rejected, and
+  ## only those meeting the pool's target are sent on to the pool
+
+  #vardiff: false
+  #vardiff_share_interval: 10
+  #vardiff_retarget_interval: 60
+  #vardiff_min_difficulty: 1
+
+  ## Check every share against the pool's target before sending it on
+  ## (rebuilding the block header locally), even without vardiff; the
+  ## default for SHA-256d coins
+
+  #check_share_targets: false
+
+  ## Verify share solutions locally before accepting them (and checking
+  ## them against the pool's target, even without vardiff), so broken rigs
+  ## don't cost pool round-trips or reputation; Equihash only. Set the
+  ## Equihash parameters and personalization of your coin (ie. 200,9
+  ## ZcashPoW for Zcash, 144,5 BgoldPoW for Bitcoin Gold). Verification runs
+  ## in `verify_processes` processes (defaults to the number of CPUs); it's
+  ## faster with numpy installed (`pip install aiostratum_proxy[speedups]`).
+  ## Not available with `processes` > 1
+
+  #verify_solutions: false
+  #equihash_n: 200
+  #equihash_k: 9
+  #equihash_personalization: ZcashPoW
+  #verify_processes: 4
+
+  ## Record every JSON-RPC line sent and received by this proxy's worker and
+  ## pool connections, timestamped, to a compact binary file; replay it with
+  ## benchmarks/bench_replay.py to reproduce real traffic. Captures grow
+  ## quickly with many workers; meant for diagnosing, not to be left on.
+  ## With `processes` > 1, each worker process writes `<path>.<n>`
+
+  #capture: '<path to capture file>'
+
+  ## Optionally keep per-worker share stats (by the worker name shares are
+  ## submitted under, once it's authorized; for up to
+  ## `share_stats_max_workers` workers at a time): accepted, rejected, stale
+  ## and duplicate share counts, the last share's time, and hashrates
+  ## estimated from the difficulty of accepted shares over the last 5
+  ## minutes, 15 minutes and hour. They're written to the `worker_shares`
+  ## table of a SQLite database every `share_stats_flush_interval` seconds;
+  ## share counts are added to the totals already there. With `processes`
+  ## > 1, worker processes share the database, each under its own proxy
+  ## name (`<name>#<n>`)
+
+  #share_stats: '<path to SQLite database>'
+  #share_stats_flush_interval: 60
+  #share_stats_max_workers: 65536
+
   ## Some pools for some algorithms support sending out a new extra_nonce1
   ## value to connected workers; some pools do not support this, and will
   ## disconnect immediately if this is set to true
 
   #extranonce_subscribe: false
 
+  ## With more than one pool configured, keep every pool connected,
+  ## subscribed and authorized; if the active pool drops, workers are moved
+  ## over to a standby immediately instead of being disconnected (unless
+  ## their nonce space changes and they can't be told about it)
+
+  #hot_standby: false
+
+  ## How to pick which pool to mine on: `ordered` uses the pools in the order
+  ## they're listed below (falling back down the list); `latency` ranks them
+  ## by measured health (connection time, job delivery delay, reject/stale
+  ## rates, connection failures), re-evaluated every
+  ## `pool_selection_interval` seconds. With `hot_standby`, the proxy
+  ## switches to a standby pool once it has scored better than the active
+  ## pool by the `pool_selection_hysteresis` fraction for 3 evaluations in a row
+
+  #pool_selection: ordered
+  #pool_selection_interval: 30
+  #pool_selection_hysteresis: 0.2
+
+  ## Open up to `pool_sessions` connections (sessions) to the active pool,
+  ## each with its own extra_nonce1 (nonce space) and submit window. Another
+  ## session is opened once every open one has `pool_session_workers`
+  ## workers (defaults to `max_workers`, ie. a full nonce space) or has more
+  ## shares to send than its `submit_window` allows; new workers go to the
+  ## least loaded session. Sessions left without workers for
+  ## `pool_session_idle_timeout` seconds are closed
+
+  #pool_sessions: 1
+  #pool_session_workers: 256
+  #pool_session_idle_timeout: 60
+
+  ## When the pool connection drops (and there's no hot standby to fail over
+  ## to), workers are kept connected while it's reconnected; their shares
+  ## are rejected as stale (or journaled, with a `share_journal`) meanwhile.
+  ## Once it's back, they're authorized again and sent the pool's job; if
+  ## the pool hands out a different extra_nonce1, workers subscribed to
+  ## extranonce changes are sent the new one, and the rest are disconnected
+  ## to reconnect. Set to false to disconnect every worker straight away
+
+  #keep_workers_connected: true
+
+  ## A pool that can't be connected to (or doesn't answer `mining.subscribe`
+  ## within `connect_timeout` seconds) is given up on, and the next pool
+  ## tried straight away; each pool is then retried after a randomized delay
+  ## that doubles with every consecutive failure, from `reconnect_delay` up
+  ## to `reconnect_max_delay` seconds. A pool connection that drops is
+  ## reconnected right away
+
+  #connect_timeout: 10
+  #reconnect_delay: 1
+  #reconnect_max_delay: 60
+
+  ## By default, every worker is authorized with the pool using the pool's
+  ## `account_name` (with the worker's rig name appended, if the account
+  ## has none) and `account_password`. With `passthrough_credentials`,
+  ## workers are authorized with their own credentials instead, so a single
+  ## proxy (and its pool sessions) can serve many accounts; it can also be
+  ## set for individual pools. The pool's answers are cached, for up to
+  ## `auth_cache_size` accounts per pool connection: granted ones for
+  ## `auth_cache_ttl` seconds, denied ones for `auth_cache_denied_ttl`;
+  ## reconnecting workers (and rigs sharing an account) aren't authorized
+  ## with the pool again while it's cached
+
+  #passthrough_credentials: false
+  #auth_cache_size: 65536
+  #auth_cache_ttl: 3600
+  #auth_cache_denied_ttl: 60
+
+  ## Spread worker connections over this many processes (one per CPU core
+  ## is a good start), all accepting miners on the same `listen` ports
+  ## (requires SO_REUSEPORT; Linux, BSDs). This process keeps the pool
+  ## connection(s) and shares jobs with the worker processes over a local
+  ## connection on `coordinator_port` (0 picks a free port); each worker
+  ## process gets its own slice of the nonce space, which its `max_workers`
+  ## miners then share
+
+  #processes: 1
+  #coordinator_port: 0
+
   ## These two lines define the aiostratum_proxy Python classes you
-  ## want to use to handle this proxy's workers and pool connections
+  ## want to use to handle this proxy's workers and pool connections; for
+  ## SHA-256d coins (Bitcoin, etc) use
+  ## aiostratum_proxy.protocols.stratum.StratumWorkerProtocol and
+  ## aiostratum_proxy.protocols.stratum.StratumPoolProtocol
 
   worker_class: aiostratum_proxy.protocols.equihash.EquihashWorkerProtocol
   pool_class: aiostratum_proxy.protocols.equihash.EquihashPoolProtocol
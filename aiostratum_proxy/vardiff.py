@@ -0,0 +1,55 @@
+class VarDiff(object):
+    # A worker's share target (variable difficulty), retargeted so the
+    # worker finds a share every `share_interval` seconds or so; targets are
+    # integers, larger being easier.
+    __slots__ = ('target', 'previous_target', 'shares', 'since')
+
+    # largest single retarget step, either way
+    max_adjust = 4.0
+    # retargets smaller than this factor (either way) aren't worth sending
+    min_adjust = 1.5
+
+    def __init__(self, target, now):
+        self.target = target
+        self.previous_target = target
+        self.shares = 0
+        self.since = now
+
+    @property
+    def accept_target(self):
+        # shares found before the worker picked up its latest target
+        # still count
+        return max(self.target, self.previous_target)
+
+    def set_target(self, target, now):
+        self.previous_target = self.target
+        self.target = target
+        self.shares = 0
+        self.since = now
+
+    def record_share(self):
+        self.shares += 1
+
+    def retarget(self, now, share_interval, retarget_interval, hardest, easiest):
+        # returns the new target if it's changed, otherwise `None`
+        elapsed = now - self.since
+        expected = elapsed / share_interval
+
+        # fast rigs are retargeted as soon as they've sent plenty of shares
+        if elapsed < retarget_interval and self.shares < self.max_adjust * retarget_interval / share_interval:
+            return None
+
+        if self.shares:
+            factor = min(max(expected / self.shares, 1 / self.max_adjust), self.max_adjust)
+        else:
+            factor = self.max_adjust
+
+        target = min(max(int(self.target * factor), hardest), easiest)
+        if target == self.target or (1 / self.min_adjust < target / self.target < self.min_adjust
+                                     and hardest <= self.target <= easiest):
+            self.shares = 0
+            self.since = now
+            return None
+
+        self.set_target(target, now)
+        return target
@@ -0,0 +1,173 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .errors import *
+
+
+# Equihash solution verification (as in zcashd's `IsValidSolution`): the
+# solution's 2^k indices each pick an n-bit BLAKE2b hash of the block header;
+# merged pairwise, level by level, every pair's hashes must collide on the
+# next n/(k+1) bits (and be in order), and all of them must XOR to zero.
+#
+# Verification runs in a process pool, so miners sending lots of shares
+# never hold up the event loop; numpy (when installed) speeds up the index
+# unpacking and XOR checks.
+
+def get_equihash_params(n, k):
+    # returns (collision bit length, index bit length, solution byte length,
+    # indices per BLAKE2b hash); raises ConfigurationError if n/k are invalid
+    if n <= 0 or k <= 0 or n % 8 or n % (k + 1) or n // (k + 1) >= 32 or n > 512:
+        raise ConfigurationError("Invalid Equihash parameters n={} k={}".format(n, k))
+
+    collision_bits = n // (k + 1)
+    index_bits = collision_bits + 1
+    solution_size = (2 ** k) * index_bits // 8
+    return collision_bits, index_bits, solution_size, 512 // n
+
+
+def get_personalization(prefix, n, k):
+    if isinstance(prefix, str):
+        prefix = prefix.encode()
+    return prefix + struct.pack('<II', n, k)
+
+
+def read_solution(solution, solution_size):
+    # strip the solution's compact size prefix (ie. 'fd4005' for 1344 bytes)
+    if len(solution) == solution_size:
+        return solution
+    if not solution:
+        return None
+    if solution[0] < 0xfd:
+        prefix_size, size = 1, solution[0]
+    elif solution[0] == 0xfd and len(solution) >= 3:
+        prefix_size, size = 3, struct.unpack('<H', solution[1:3])[0]
+    else:
+        return None
+
+    if size != solution_size or len(solution) != prefix_size + size:
+        return None
+    return solution[prefix_size:]
+
+
+def unpack_indices(solution, count, index_bits):
+    # indices are packed big-endian, `index_bits` each
+    if numpy is not None:
+        bits = numpy.unpackbits(numpy.frombuffer(solution, dtype=numpy.uint8)).reshape(count, index_bits)
+        weights = 1 << numpy.arange(index_bits - 1, -1, -1, dtype=numpy.uint32)
+        return bits.dot(weights)
+
+    value = int.from_bytes(solution, 'big')
+    mask = (1 << index_bits) - 1
+    total = count * index_bits
+    return [(value >> (total - (i + 1) * index_bits)) & mask for i in range(count)]
+
+
+def generate_hashes(header, indices, n, k, personalization, indices_per_hash):
+    # the n-bit hash for each index; indices sharing a BLAKE2b output
+    # (`indices_per_hash` of them) only get it computed once, and every
+    # computation carries on from the same header state
+    hash_size = n // 8
+    base = hashlib.blake2b(digest_size=indices_per_hash * hash_size, person=personalization)
+    base.update(header)
+
+    digests = {}
+    hashes = []
+    for index in indices:
+        block, offset = divmod(int(index), indices_per_hash)
+        digest = digests.get(block)
+        if digest is None:
+            h = base.copy()
+            h.update(struct.pack('<I', block))
+            digest = digests[block] = h.digest()
+        hashes.append(digest[offset * hash_size:(offset + 1) * hash_size])
+    return hashes
+
+
+def check_tree(hashes, indices, n, k, collision_bits):
+    count = len(indices)
+    if len(set(int(i) for i in indices)) != count:
+        return False
+
+    values = [int.from_bytes(h, 'big') for h in hashes]
+    firsts = [int(i) for i in indices]
+    for level in range(1, k + 1):
+        # each merged pair must collide on the next `collision_bits` (and
+        # ultimately XOR to zero), with the left half's first index lower
+        shift = n - level * collision_bits if level < k else 0
+        merged, merged_firsts = [], []
+        for i in range(0, len(values), 2):
+            value = values[i] ^ values[i + 1]
+            if value >> shift or firsts[i] >= firsts[i + 1]:
+                return False
+            merged.append(value)
+            merged_firsts.append(firsts[i])
+        values, firsts = merged, merged_firsts
+
+    return True
+
+
+def check_tree_numpy(hashes, indices, n, k, collision_bits):
+    count = len(indices)
+    if numpy.unique(indices).size != count:
+        return False
+
+    rows = numpy.frombuffer(b''.join(hashes), dtype=numpy.uint8).reshape(count, n // 8)
+    firsts = numpy.asarray(indices)
+    for level in range(1, k + 1):
+        rows = rows[0::2] ^ rows[1::2]
+        if (firsts[0::2] >= firsts[1::2]).any():
+            return False
+        firsts = firsts[0::2]
+
+        # leading bits that must now be zero: whole bytes, then the top
+        # bits of the next byte
+        zero_bits = level * collision_bits if level < k else n
+        whole, partial = divmod(zero_bits, 8)
+        if rows[:, :whole].any():
+            return False
+        if partial and (rows[:, whole] >> (8 - partial)).any():
+            return False
+
+    return True
+
+
+def verify_solution(header, solution, n, k, personalization):
+    # `header` is the 140 byte block header (nonce included), `solution`
+    # the solution bytes (with or without its compact size prefix)
+    collision_bits, index_bits, solution_size, indices_per_hash = get_equihash_params(n, k)
+
+    solution = read_solution(solution, solution_size)
+    if solution is None:
+        return False
+
+    count = 2 ** k
+    indices = unpack_indices(solution, count, index_bits)
+    hashes = generate_hashes(header, indices, n, k, personalization, indices_per_hash)
+
+    if numpy is not None:
+        return check_tree_numpy(hashes, indices, n, k, collision_bits)
+    return check_tree(hashes, indices, n, k, collision_bits)
+
+
+class EquihashVerifier(object):
+    def __init__(self, n=200, k=9, personalization='ZcashPoW', processes=None):
+        get_equihash_params(n, k)
+
+        self.n = n
+        self.k = k
+        self.personalization = get_personalization(personalization, n, k)
+        self.executor = ProcessPoolExecutor(processes)
+
+    async def verify(self, header, solution):
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, verify_solution, header, solution, self.n, self.k, self.personalization)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
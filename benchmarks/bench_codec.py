@@ -0,0 +1,113 @@
+# Stratum line framing and JSON decoding throughput: decoded messages per
+# second (on one core) through aiojsonrpc2's StreamReader based reading, and
+# through the proxy's codec (aiostratum_proxy.codec) with the standard
+# library's json and, if it's installed, orjson. Lines arrive either in large
+# chunks (a busy pool or rig) or one line per chunk.
+#
+#   PYTHONPATH=.:benchmarks python benchmarks/bench_codec.py [messages]
+
+import asyncio
+import json
+import sys
+import time
+
+from aiojsonrpc2.connection import Connection
+
+from aiostratum_proxy import codec
+
+from stubs import bitcoin_job, equihash_job
+
+
+MESSAGES = {
+    'equihash mining.submit': {'id': 4, 'method': 'mining.submit', 'params': [
+        't1abcdefghijklmnopqrstuvwxyz12345678.rig1', '0000000a', '5a000000',
+        '00' * 27, 'fd4005' + 'ab' * 1344]},
+    'bitcoin mining.submit': {'id': 4, 'method': 'mining.submit', 'params': [
+        'bc1qabcdefghijklmnopqrstuvwxyz.rig1', '0000000a', '00000001', '5a000000', '12345678']},
+    'equihash mining.notify': {'id': None, 'method': 'mining.notify', 'params': equihash_job('0000000a')},
+    'bitcoin mining.notify': {'id': None, 'method': 'mining.notify', 'params': bitcoin_job('0000000a')},
+}
+
+
+class BenchTransport(object):
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+def get_chunks(line, count, chunk_size):
+    # `count` lines, in chunks of about `chunk_size` bytes (whole lines)
+    per_chunk = max(chunk_size // len(line), 1)
+    return [line * min(per_chunk, count - n) for n in range(0, count, per_chunk)]
+
+
+async def read_streamreader(chunks, count):
+    reader = asyncio.StreamReader(limit=2 ** 20)
+    reader._transport = BenchTransport()
+    connection = Connection(reader, None)
+    read = 0
+    for chunk in chunks:
+        reader.feed_data(chunk)
+        while read < count and len(reader._buffer):
+            await connection.read()
+            read += 1
+    return read
+
+
+async def read_codec(chunks, count):
+    protocol = codec.StratumStreamProtocol()
+    protocol.connection_made(BenchTransport())
+    connection = codec.StratumConnection(protocol, None)
+    read = 0
+    for chunk in chunks:
+        protocol.data_received(chunk)
+        while protocol.messages:
+            await connection.read()
+            read += 1
+    return read
+
+
+def measure(reader, chunks, count):
+    loop = asyncio.new_event_loop()
+    started = time.perf_counter()
+    read = loop.run_until_complete(reader(chunks, count))
+    elapsed = time.perf_counter() - started
+    loop.close()
+    assert read == count, (read, count)
+    return count / elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    readers = [('aiojsonrpc2 StreamReader', read_streamreader, None),
+               ('codec, json', read_codec, (codec.json_loads, codec.json_dumps))]
+    if codec.orjson is not None:
+        readers.append(('codec, orjson', read_codec, (codec.orjson_loads, codec.orjson_dumps)))
+    else:
+        print("(orjson isn't installed; `pip install orjson` to compare)")
+
+    for name, message in MESSAGES.items():
+        line = (json.dumps(message) + "\n").encode()
+        for chunking, chunk_size in (('64KB chunks', 65536), ('line per chunk', 0)):
+            chunks = get_chunks(line, count, chunk_size)
+            print("{} ({} bytes), {}:".format(name, len(line), chunking))
+            for reader_name, reader, backend in readers:
+                if backend is not None:
+                    codec.loads, codec.dumps = backend
+                print("  {:<26} {:>12,.0f} messages/s".format(reader_name, measure(reader, chunks, count)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Microbenchmark: cost of handing out an extra_nonce1 tail when the nonce
+# space is (nearly) full, comparing the previous linear scan against the
+# free-list allocator.
+#
+#   PYTHONPATH=.:benchmarks python benchmarks/bench_extranonce_allocator.py [nonce space size]
+
+import binascii
+import struct
+import sys
+import timeit
+
+from aiostratum_proxy.errors import MaxClientsConnected
+from aiostratum_proxy.nonces import ExtraNonce1TailAllocator
+
+
+def legacy_get_tail(registered, max_workers):
+    # the original BaseWorkerProtocol.get_extra_nonce1_tail implementation
+    # (widened to 2 bytes for any nonce space above 256)
+    _format = '>H' if max_workers > 256 else '>B'
+    for i in range(0, max_workers):
+        tail = binascii.hexlify(struct.pack(_format, i)).decode('ascii')
+        if tail not in registered:
+            registered.add(tail)
+            return tail
+    raise MaxClientsConnected
+
+
+def bench_legacy(size, number):
+    _format = '{{:0{}x}}'.format(4 if size > 256 else 2)
+    registered = set(_format.format(i) for i in range(size))
+    # free the very last tail, the worst case for a linear scan
+    last = _format.format(size - 1)
+
+    def run():
+        registered.discard(last)
+        legacy_get_tail(registered, size)
+
+    return min(timeit.repeat(run, number=number, repeat=3)) / number
+
+
+def bench_allocator(size, number):
+    allocator = ExtraNonce1TailAllocator(size)
+    for _ in range(size):
+        allocator.allocate()
+
+    def run():
+        allocator.release(size - 1)
+        allocator.allocate()
+
+    return min(timeit.repeat(run, number=number, repeat=3)) / number
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [256, 65536]
+
+    print("{:>8} {:>16} {:>16} {:>10}".format('workers', 'legacy (us)', 'free-list (us)', 'speedup'))
+    for size in sizes:
+        legacy = bench_legacy(size, 20 if size > 256 else 2000)
+        allocator = bench_allocator(size, 100000)
+        print("{:>8} {:>16.3f} {:>16.3f} {:>9.0f}x".format(
+            size, legacy * 1e6, allocator * 1e6, legacy / allocator))
+
+
+if __name__ == '__main__':
+    main()
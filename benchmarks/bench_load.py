@@ -0,0 +1,317 @@
+# End-to-end load test: a real Application (started from a generated
+# config file) between a local stub pool and thousands of simulated miners.
+# Reports
+#
+#   - connect storm: miners connecting, subscribing and authorizing at once
+#     (exercises extra_nonce1 tail allocation)
+#   - share capacity: every miner submitting shares as fast as it's answered,
+#     with shares/sec and p50/p99 submit latency (exercises submit)
+#   - notify fan-out: jobs sent by the pool at `--notify-rate` per second,
+#     timed until the last miner has them (exercises broadcast)
+#   - memory: the proxy process' RSS growth per miner connection
+#
+# Miners run in this process by default; `--miner-processes N` moves them to
+# N other processes, so they don't compete with the proxy for the event loop
+# (and aren't counted in its RSS).
+#
+#   PYTHONPATH=.:benchmarks python benchmarks/bench_load.py [--miners 2000] [--protocol equihash|bitcoin]
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+
+import yaml
+
+from aiostratum_proxy.application import Application
+
+from stubs import SimulatedMiner, StubPool, bitcoin_job
+
+
+PROTOCOLS = {
+    'equihash': {
+        'worker_class': 'aiostratum_proxy.protocols.equihash.EquihashWorkerProtocol',
+        'pool_class': 'aiostratum_proxy.protocols.equihash.EquihashPoolProtocol',
+        'pool': {},
+    },
+    'bitcoin': {
+        'worker_class': 'aiostratum_proxy.protocols.stratum.StratumWorkerProtocol',
+        'pool_class': 'aiostratum_proxy.protocols.stratum.StratumPoolProtocol',
+        # a difficulty low enough that every share meets it
+        'pool': {'job': bitcoin_job, 'extra_nonce2_size': 8, 'target_method': 'mining.set_difficulty',
+                 'target': 2 ** -32},
+    },
+}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def get_rss():
+    # resident set size of this process, in bytes
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # peak, not current; good enough where /proc isn't available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def raise_open_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+class MinerSwarm(object):
+    # A group of simulated miners, driven phase by phase.
+
+    def __init__(self, port, count, offset=0):
+        self.miners = [SimulatedMiner('127.0.0.1', port, account_name='stubaccount.rig{}'.format(offset + n))
+                       for n in range(count)]
+
+    async def connect(self):
+        # returns each miner's time to connect, subscribe and authorize
+        loop = asyncio.get_event_loop()
+
+        async def start(miner):
+            started = loop.time()
+            await miner.start()
+            await miner.wait_for_job(60)
+            return loop.time() - started
+
+        return await asyncio.gather(*[start(m) for m in self.miners])
+
+    async def submit(self, shares):
+        # every miner sends `shares` shares, one after the other; returns
+        # (latencies, errors)
+        loop = asyncio.get_event_loop()
+        latencies, errors = [], [0]
+
+        async def run(miner):
+            for _ in range(shares):
+                sent = loop.time()
+                response = await miner.submit()
+                latencies.append(loop.time() - sent)
+                if not response.get('result'):
+                    errors[0] += 1
+
+        await asyncio.gather(*[run(m) for m in self.miners])
+        return latencies, errors[0]
+
+    async def job_times(self):
+        # job id: the time each miner got it
+        times = {}
+        for miner in self.miners:
+            for job, received in zip(miner.jobs, miner.notify_times):
+                times.setdefault(job[0], []).append(received)
+        return times
+
+    async def close(self):
+        for miner in self.miners:
+            await miner.close()
+
+
+async def serve_remote_swarm(conn, swarm):
+    # the event loop keeps running (and the miners reading) between phases
+    loop = asyncio.get_event_loop()
+    while True:
+        command, args = await loop.run_in_executor(None, conn.recv)
+        conn.send(await getattr(swarm, command)(*args))
+        if command == 'close':
+            break
+
+
+def run_remote_swarm(conn, port, count, offset):
+    # entry point of a miner process; runs the phases it's told to
+    raise_open_file_limit()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(serve_remote_swarm(conn, MinerSwarm(port, count, offset)))
+    loop.close()
+
+
+class RemoteMinerSwarm(object):
+    # A MinerSwarm in another process, with the same interface.
+
+    def __init__(self, port, count, offset=0):
+        ctx = multiprocessing.get_context('spawn')
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=run_remote_swarm, args=(child_conn, port, count, offset), daemon=True)
+        self.process.start()
+
+    async def call(self, command, *args):
+        loop = asyncio.get_event_loop()
+        self.conn.send((command, args))
+        return await loop.run_in_executor(None, self.conn.recv)
+
+    async def connect(self):
+        return await self.call('connect')
+
+    async def submit(self, shares):
+        return await self.call('submit', shares)
+
+    async def job_times(self):
+        return await self.call('job_times')
+
+    async def close(self):
+        await self.call('close')
+        self.process.join(5)
+
+
+def write_config(path, protocol, pool):
+    settings = PROTOCOLS[protocol]
+    config = {
+        'proxies': [{
+            'name': 'bench',
+            'max_workers': 65536,
+            'worker_class': settings['worker_class'],
+            'pool_class': settings['pool_class'],
+            'listen': [{'host': '127.0.0.1', 'port': 0}],
+            'pools': [pool.pool_settings()],
+        }],
+    }
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+    results = {'protocol': args.protocol, 'miners': args.miners, 'miner_processes': args.miner_processes}
+
+    pool = await StubPool(unique_extra_nonce1=True, **PROTOCOLS[args.protocol]['pool']).start()
+
+    config_dir = tempfile.mkdtemp()
+    config_file = os.path.join(config_dir, 'bench.yml')
+    write_config(config_file, args.protocol, pool)
+
+    app = Application(config_file)
+    await app.startup()
+    proxy = app.proxies['bench']
+    port = proxy.workers.servers[0].sockets[0].getsockname()[1]
+
+    # the proxy only connects to the pool once a worker shows up; that first
+    # worker's wait is measured on its own, so it's not counted in the storm
+    first = MinerSwarm(port, 1, args.miners)
+    results['first_connect_ms'] = (await first.connect())[0] * 1000
+
+    if args.miner_processes:
+        per_process = -(-args.miners // args.miner_processes)
+        swarms = [RemoteMinerSwarm(port, min(per_process, args.miners - n), n)
+                  for n in range(0, args.miners, per_process)]
+    else:
+        swarms = [MinerSwarm(port, args.miners)]
+
+    rss_before = get_rss()
+
+    # connect storm
+    started = loop.time()
+    connect_times = [t for ts in await asyncio.gather(*[s.connect() for s in swarms]) for t in ts]
+    elapsed = loop.time() - started
+    results['connect_per_sec'] = len(connect_times) / elapsed
+    results['connect_p50_ms'] = percentile(connect_times, 50) * 1000
+    results['connect_p99_ms'] = percentile(connect_times, 99) * 1000
+    results['rss_per_connection'] = (get_rss() - rss_before) / float(args.miners)
+
+    # share capacity
+    started = loop.time()
+    submitted = await asyncio.gather(*[s.submit(args.shares) for s in swarms])
+    elapsed = loop.time() - started
+    latencies = [l for ls, _ in submitted for l in ls]
+    results['shares_per_sec'] = len(latencies) / elapsed
+    results['submit_p50_ms'] = percentile(latencies, 50) * 1000
+    results['submit_p99_ms'] = percentile(latencies, 99) * 1000
+    results['share_errors'] = sum(e for _, e in submitted)
+    results['pool_shares'] = len(pool.submits)
+
+    # notify fan-out
+    sent = {}
+    for _ in range(args.jobs):
+        pool.notify()
+        sent[pool.current_job[0]] = loop.time()
+        await asyncio.sleep(1.0 / args.notify_rate)
+    await asyncio.sleep(1)
+
+    received = {}
+    for swarm in swarms + [first]:
+        for job_id, ts in (await swarm.job_times()).items():
+            received.setdefault(job_id, []).extend(ts)
+
+    fanouts, missed = [], 0
+    for job_id, sent_at in sent.items():
+        ts = received.get(job_id, [])
+        missed += args.miners + 1 - len(ts)
+        if ts:
+            fanouts.append(max(ts) - sent_at)
+    results['fanout_p50_ms'] = percentile(fanouts, 50) * 1000
+    results['fanout_p99_ms'] = percentile(fanouts, 99) * 1000
+    results['fanout_missed'] = missed
+
+    for swarm in swarms + [first]:
+        await swarm.close()
+    await app.shutdown()
+    await pool.stop()
+    os.remove(config_file)
+    os.rmdir(config_dir)
+
+    return results
+
+
+def report(results):
+    print("{protocol}: {miners} miners ({where})".format(
+        where='{} miner processes'.format(results['miner_processes']) if results['miner_processes'] else 'in process',
+        **results))
+    print("first connection:  {:>10}                    {first_connect_ms:8.2f}ms  (includes connecting to the pool)".format(
+        '', **results))
+    print("connect storm:     {connect_per_sec:>10,.0f} connections/s  p50 {connect_p50_ms:8.2f}ms  "
+          "p99 {connect_p99_ms:8.2f}ms".format(**results))
+    print("share capacity:    {shares_per_sec:>10,.0f} shares/s       p50 {submit_p50_ms:8.2f}ms  "
+          "p99 {submit_p99_ms:8.2f}ms  ({share_errors} errors, {pool_shares} reached the pool)".format(**results))
+    print("notify fan-out:    {:>10}                p50 {fanout_p50_ms:8.2f}ms  p99 {fanout_p99_ms:8.2f}ms  "
+          "({fanout_missed} missed)".format('', **results))
+    print("memory:            {rss_per_connection:>10,.0f} bytes RSS per connection".format(**results))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--protocol", choices=sorted(PROTOCOLS), default='equihash')
+    parser.add_argument("--miners", type=int, default=2000)
+    parser.add_argument("--shares", type=int, default=10, help="shares submitted per miner")
+    parser.add_argument("--jobs", type=int, default=20, help="jobs sent by the pool")
+    parser.add_argument("--notify-rate", type=float, default=10, help="jobs per second")
+    parser.add_argument("--miner-processes", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="output the results as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    # the proxy's and the pool's sockets, plus in-process miners'
+    needed = args.miners * (1 if args.miner_processes else 2) + 100
+    if raise_open_file_limit() < needed:
+        sys.exit("open file limit too low for {} miners (need {})".format(args.miners, needed))
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = loop.run_until_complete(run(args))
+    loop.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        report(results)
+
+    sys.exit(1 if results['share_errors'] or results['fanout_missed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Runs many proxies side by side in one event loop, each against its own
+# local stub pool, and checks they stay independent: every proxy's miners
+# only see their own pool's extra_nonce1 and jobs, and shares only reach
+# their own pool. Also reports memory used per proxy (on top of what's
+# shared by all of them, ie. imported modules).
+#
+#   PYTHONPATH=.:benchmarks python benchmarks/bench_multi_proxy.py [proxies] [miners per proxy]
+
+import asyncio
+import logging
+import sys
+import tracemalloc
+
+from aiostratum_proxy.application import Proxy
+
+from stubs import SimulatedMiner, StubPool
+
+
+def make_proxy(n, pool):
+    return Proxy(
+        name='proxy{}'.format(n),
+        worker_class='aiostratum_proxy.protocols.equihash.EquihashWorkerProtocol',
+        pool_class='aiostratum_proxy.protocols.equihash.EquihashPoolProtocol',
+        listen=[{'host': '127.0.0.1', 'port': 0}],
+        pools=[pool.pool_settings()])
+
+
+async def run(proxy_count, miner_count):
+    # the stub pools, and a proxy that's started (and stopped) first so the
+    # protocol modules are imported and everything's warmed up, are set up
+    # before the baseline; what's measured is only what each proxy adds
+    pools = [await StubPool(extra_nonce1='{:08x}'.format(n), job_prefix='p{}-'.format(n)).start()
+             for n in range(proxy_count)]
+    warmup_pool = await StubPool().start()
+    warmup = make_proxy('-warmup', warmup_pool)
+    await warmup.startup()
+    await warmup.shutdown()
+    await warmup_pool.stop()
+    del warmup, warmup_pool
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    proxies = []
+    for n, pool in enumerate(pools):
+        proxy = make_proxy(n, pool)
+        await proxy.startup()
+        proxies.append(proxy)
+
+    proxies_memory = tracemalloc.get_traced_memory()[0] - before
+
+    miners = []
+    for n, proxy in enumerate(proxies):
+        port = proxy.workers.servers[0].sockets[0].getsockname()[1]
+        miners.append([SimulatedMiner('127.0.0.1', port) for _ in range(miner_count)])
+
+    await asyncio.gather(*[m.start() for ms in miners for m in ms])
+    await asyncio.gather(*[m.wait_for_job() for ms in miners for m in ms])
+
+    # a new job on every pool; each proxy's miners should get only their own
+    for pool in pools:
+        pool.notify()
+    await asyncio.sleep(0.5)
+
+    await asyncio.gather(*[m.submit() for ms in miners for m in ms])
+
+    errors = 0
+    for n, (pool, proxy, ms) in enumerate(zip(pools, proxies, miners)):
+        expected_en1 = '{:08x}'.format(n)
+        for m in ms:
+            if not m.extra_nonce1.startswith(expected_en1):
+                errors += 1
+                print("proxy{}: miner got extra_nonce1 {}".format(n, m.extra_nonce1))
+            foreign = [j[0] for j in m.jobs if not j[0].startswith('p{}-'.format(n))]
+            if foreign or len(set(j[0] for j in m.jobs)) != 2:
+                errors += 1
+                print("proxy{}: miner got jobs {}".format(n, [j[0] for j in m.jobs]))
+        if len(pool.submits) != len(ms) or len(proxy.workers.clients) != len(ms):
+            errors += 1
+            print("proxy{}: pool got {} shares, proxy has {} workers".format(
+                n, len(pool.submits), len(proxy.workers.clients)))
+
+    # the simulated miners (and the stub pools' side of their connections)
+    # run in this process too, so this is an upper bound
+    total_memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    print("{} proxies x {} miners: {}".format(proxy_count, miner_count, 'independent' if not errors else '{} ERRORS'.format(errors)))
+    print("memory per idle proxy:        {:>10,.0f} bytes".format(proxies_memory / proxy_count))
+    print("memory per proxy with miners: {:>10,.0f} bytes".format(total_memory / proxy_count))
+
+    for ms in miners:
+        for m in ms:
+            await m.close()
+    for proxy in proxies:
+        await proxy.shutdown()
+    for pool in pools:
+        await pool.stop()
+
+    return errors
+
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL)
+
+    proxy_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    miner_count = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    errors = loop.run_until_complete(run(proxy_count, miner_count))
+    loop.close()
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
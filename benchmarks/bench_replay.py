@@ -0,0 +1,347 @@
+# Replays a traffic capture (see the `capture` proxy setting) through a real
+# proxy, against local stand-ins: a pool sending the captured pool's jobs
+# and targets (and answering shares the way it did), and miners sending
+# the captured workers' requests, each at its original time - or
+# `--speed` times faster. Then compares the replay with the capture: request
+# latency (p50/p99, by method) and outcomes (result or error code).
+#
+# Shares are answered after the captured pool's round-trip time, at any
+# speed. The proxy only connects to the pool once a worker shows up, so a
+# throwaway worker gets it connected before the replay starts.
+#
+#   PYTHONPATH=.:benchmarks python benchmarks/bench_replay.py <capture file> [--speed 1] [--protocol equihash|bitcoin]
+#
+# Use `--config <file>` to run the proxy with the (first) proxy settings of
+# your own config file (its `listen` and `pools` are replaced).
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import yaml
+
+from aiostratum_proxy.application import Application
+from aiostratum_proxy.capture import EVENT_CLOSE, EVENT_IN, EVENT_OPEN, SIDE_POOL, SIDE_WORKER, read_capture
+
+from stubs import StubPool
+
+
+PROTOCOLS = {
+    'equihash': ('aiostratum_proxy.protocols.equihash.EquihashWorkerProtocol',
+                 'aiostratum_proxy.protocols.equihash.EquihashPoolProtocol'),
+    'bitcoin': ('aiostratum_proxy.protocols.stratum.StratumWorkerProtocol',
+                'aiostratum_proxy.protocols.stratum.StratumPoolProtocol'),
+}
+
+# pool notifications replayed to the proxy
+POOL_NOTIFICATIONS = ('mining.notify', 'mining.set_target', 'mining.set_difficulty', 'client.show_message')
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def get_outcome(response):
+    if response.get('error'):
+        error = response['error']
+        return 'error {}'.format(error.get('code') if isinstance(error, dict) else error[0] if error else '?')
+    return 'ok' if response.get('result') else 'false'
+
+
+def get_submit_key(params):
+    # identifies a share sent to the pool, whichever worker or nonce space
+    # it comes from in the replay (the job and the nonce/solution)
+    return json.dumps([params[1], params[-1]])
+
+
+class CapturedConnection(object):
+    def __init__(self, connection_id, side):
+        self.connection_id = connection_id
+        self.side = side
+        self.opened = None
+        self.closed = None
+
+        # (time, message) read by the proxy, and written by it
+        self.received = []
+        self.sent = []
+
+    def get_requests(self):
+        # request id: (time, method, params) for requests read by the proxy
+        return {m['id']: (t, m.get('method'), m.get('params')) for t, m in self.received
+                if m.get('id') is not None and m.get('method')}
+
+    def get_responses(self, messages):
+        # request id: (time, response) for responses in `messages`
+        return {m['id']: (t, m) for t, m in messages if m.get('id') is not None and 'method' not in m}
+
+    def get_results(self):
+        # request id: (method, latency, outcome) of every request the proxy
+        # answered
+        responses = self.get_responses(self.sent)
+        results = {}
+        for _id, (t, method, params) in self.get_requests().items():
+            if _id in responses:
+                responded, response = responses[_id]
+                results[_id] = (method, responded - t, get_outcome(response))
+        return results
+
+
+def load_capture(path):
+    started, records = read_capture(path)
+    connections = {}
+    for r in records:
+        connection = connections.get(r.connection)
+        if connection is None:
+            connection = connections[r.connection] = CapturedConnection(r.connection, r.side)
+
+        if r.event == EVENT_OPEN:
+            connection.opened = r.time
+        elif r.event == EVENT_CLOSE:
+            if connection.closed is None:
+                connection.closed = r.time
+        else:
+            for line in r.data.split(b'\n'):
+                try:
+                    message = json.loads(line.decode())
+                except ValueError:
+                    continue
+                if isinstance(message, dict):
+                    (connection.received if r.event == EVENT_IN else connection.sent).append((r.time, message))
+
+    workers = [c for c in connections.values() if c.side == SIDE_WORKER and c.opened is not None]
+    pools = [c for c in connections.values() if c.side == SIDE_POOL and c.opened is not None]
+    return started, workers, pools
+
+
+class ReplayPool(StubPool):
+    # A stub pool subscribing connections the way the captured pool did,
+    # sending its notifications on the captured timeline, and answering
+    # shares it was sent the way it answered them.
+
+    def __init__(self, pool_connections):
+        super().__init__()
+        self.background_submits = True
+        self.timeline = []
+        self.responses = {}
+        self.subscribe_result = None
+        self.latest = {}
+
+        for c in pool_connections:
+            responses = c.get_responses(c.received)
+            for _id, (t, method, params) in {m['id']: (t, m.get('method'), m.get('params')) for t, m in c.sent
+                                              if m.get('id') is not None and m.get('method')}.items():
+                response = responses.get(_id)
+                if response is None:
+                    continue
+                if method == 'mining.subscribe' and self.subscribe_result is None:
+                    self.subscribe_result = response[1].get('result')
+                elif method == 'mining.submit' and params:
+                    self.responses[get_submit_key(params)] = (response[1], response[0] - t)
+
+        # extra sessions and hot standbys got the same jobs; the first pool
+        # connection's are replayed
+        if pool_connections:
+            self.timeline = [(t, m) for t, m in pool_connections[0].received
+                             if m.get('id') is None and m.get('method') in POOL_NOTIFICATIONS]
+
+    async def play(self, started, speed):
+        loop = asyncio.get_event_loop()
+        for t, message in self.timeline:
+            await asyncio.sleep(max(started + t / speed - loop.time(), 0))
+            # connections subscribing later get the latest of each
+            self.latest[message['method']] = message
+            for writer in list(self.writers):
+                self.send(writer, message)
+
+    async def reply(self, writer, msg, extra_nonce1, first_authorize=True):
+        method = msg.get('method')
+        response = {'id': msg.get('id'), 'result': True, 'error': None}
+        if method == 'mining.subscribe' and self.subscribe_result is not None:
+            response['result'] = self.subscribe_result
+        elif method == 'mining.submit' and msg.get('params'):
+            self.submits.append(msg['params'])
+            captured = self.responses.get(get_submit_key(msg['params']))
+            if captured is not None:
+                captured, rtt = captured
+                await asyncio.sleep(rtt)
+                response['result'], response['error'] = captured.get('result'), captured.get('error')
+
+        self.send(writer, response)
+
+        if method == 'mining.authorize' and first_authorize:
+            for name in POOL_NOTIFICATIONS:
+                if name in self.latest:
+                    self.send(writer, self.latest[name])
+
+
+class ReplayMiner(object):
+    # Sends a captured worker's requests on the captured timeline, timing
+    # the proxy's responses.
+
+    def __init__(self, captured, port):
+        self.captured = captured
+        self.port = port
+        self.requests = captured.get_requests()
+
+        self.sent = {}
+        # request id: (method, latency, outcome)
+        self.results = {}
+
+    async def play(self, started, speed):
+        loop = asyncio.get_event_loop()
+        await asyncio.sleep(max(started + self.captured.opened / speed - loop.time(), 0))
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        except OSError:
+            return
+
+        read_fut = asyncio.ensure_future(self.read(reader))
+        for t, message in self.captured.received:
+            await asyncio.sleep(max(started + t / speed - loop.time(), 0))
+            if read_fut.done():
+                break
+            if message.get('id') is not None:
+                self.sent[message['id']] = loop.time()
+            writer.write((json.dumps(message) + "\n").encode())
+
+        # wait for the last responses (and, if it was, for the captured
+        # connection to be closed)
+        end = self.captured.closed
+        if end is None:
+            end = self.captured.received[-1][0] if self.captured.received else self.captured.opened
+        await asyncio.sleep(max(started + end / speed - loop.time(), 0) + 1)
+        writer.close()
+        read_fut.cancel()
+
+    async def read(self, reader):
+        loop = asyncio.get_event_loop()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                message = json.loads(line.decode())
+            except ValueError:
+                continue
+            _id = message.get('id') if isinstance(message, dict) else None
+            if _id in self.sent and 'method' not in message:
+                request = self.requests.get(_id)
+                self.results[_id] = (request[1] if request else None, loop.time() - self.sent.pop(_id),
+                                     get_outcome(message))
+
+
+def write_config(path, args, pool):
+    if args.config:
+        with open(args.config) as f:
+            settings = (yaml.safe_load(f).get('proxies') or [{}])[0]
+    else:
+        worker_class, pool_class = PROTOCOLS[args.protocol]
+        settings = {'max_workers': 65536, 'worker_class': worker_class, 'pool_class': pool_class}
+
+    settings.update({
+        'name': 'replay',
+        'listen': [{'host': '127.0.0.1', 'port': 0}],
+        'pools': [pool.pool_settings()],
+    })
+    for name in ('processes', 'capture', 'share_journal'):
+        settings.pop(name, None)
+
+    with open(path, 'w') as f:
+        yaml.safe_dump({'proxies': [settings]}, f)
+
+
+def compare(miners):
+    # latencies by method, and outcomes request by request
+    captured, replayed, differences = [], [], {}
+    for miner in miners:
+        captured_results = miner.captured.get_results()
+        captured.extend(captured_results.values())
+        replayed.extend(miner.results.values())
+
+        for _id, (method, latency, outcome) in captured_results.items():
+            replay_outcome = miner.results[_id][2] if _id in miner.results else 'no response'
+            if replay_outcome != outcome:
+                key = (method, outcome, replay_outcome)
+                differences[key] = differences.get(key, 0) + 1
+
+    print("{:<22} {:>8} {:>12} {:>12} {:>12} {:>12}".format(
+        'method', 'requests', 'captured p50', 'replay p50', 'captured p99', 'replay p99'))
+    for method in sorted(set(m for m, _, _ in captured) | set(m for m, _, _ in replayed), key=str):
+        c = [l for m, l, _ in captured if m == method]
+        r = [l for m, l, _ in replayed if m == method]
+        print("{:<22} {:>8} {:>10.2f}ms {:>10.2f}ms {:>10.2f}ms {:>10.2f}ms".format(
+            str(method), len(r), percentile(c, 50) * 1000, percentile(r, 50) * 1000,
+            percentile(c, 99) * 1000, percentile(r, 99) * 1000))
+
+    print("outcomes: {} of {} requests as captured".format(
+        len(captured) - sum(differences.values()), len(captured)))
+    for (method, outcome, replay_outcome), count in sorted(differences.items(), key=lambda d: -d[1]):
+        print("  {} x {}: captured {}, replayed {}".format(count, method, outcome, replay_outcome))
+
+    return differences
+
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+
+    _, workers, pools = load_capture(args.capture)
+    print("capture: {} worker connections ({} requests), {} pool connections".format(
+        len(workers), sum(len(w.get_requests()) for w in workers), len(pools)))
+
+    pool = await ReplayPool(pools).start()
+
+    config_dir = tempfile.mkdtemp()
+    config_file = os.path.join(config_dir, 'replay.yml')
+    write_config(config_file, args, pool)
+
+    app = Application(config_file)
+    await app.startup()
+    port = app.proxies['replay'].workers.servers[0].sockets[0].getsockname()[1]
+
+    miners = [ReplayMiner(w, port) for w in workers]
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    await app.proxies['replay'].pool.wait_until_ready()
+    writer.close()
+
+    started = loop.time()
+    pool_fut = asyncio.ensure_future(pool.play(started, args.speed))
+    await asyncio.gather(*[m.play(started, args.speed) for m in miners])
+    print("replayed in {:.1f}s (at {}x)".format(loop.time() - started, args.speed))
+
+    pool_fut.cancel()
+    await app.shutdown()
+    await pool.stop()
+    os.remove(config_file)
+    os.rmdir(config_dir)
+
+    return compare(miners)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture", help="traffic capture file")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay this many times faster")
+    parser.add_argument("--protocol", choices=sorted(PROTOCOLS), default='equihash')
+    parser.add_argument("--config", help="config file to take the proxy settings from")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    differences = loop.run_until_complete(run(args))
+    loop.close()
+
+    sys.exit(1 if differences else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# Memory held per idle worker connection: a proxy with `max_workers: 65536`
+# gets 1k, 10k and 65k workers (each subscribed, authorized and sent a job,
+# then left idle), and the bytes the proxy allocated for them (everything
+# but the sockets themselves) are divided by the number of workers. Workers
+# are fed through in-memory transports rather than sockets, so 65k of them
+# fit in any file descriptor limit; the pool is a local stub on a socket.
+#
+#   PYTHONPATH=.:benchmarks python benchmarks/bench_worker_memory.py [workers ...] [--protocol equihash|bitcoin] [--vardiff] [--top N]
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import tracemalloc
+
+from aiostratum_proxy.application import Proxy
+from aiostratum_proxy.codec import StratumStreamProtocol
+
+from stubs import StubPool, bitcoin_job
+
+
+PROTOCOLS = {
+    'equihash': ('aiostratum_proxy.protocols.equihash.EquihashWorkerProtocol',
+                 'aiostratum_proxy.protocols.equihash.EquihashPoolProtocol', {}),
+    'bitcoin': ('aiostratum_proxy.protocols.stratum.StratumWorkerProtocol',
+                'aiostratum_proxy.protocols.stratum.StratumPoolProtocol',
+                {'job': bitcoin_job, 'extra_nonce2_size': 4, 'target_method': 'mining.set_difficulty', 'target': 1}),
+}
+
+SUBSCRIBE = json.dumps({'id': 1, 'method': 'mining.subscribe', 'params': []}).encode() + b'\n'
+
+
+class DummySocket(object):
+    def setsockopt(self, *args):
+        pass
+
+
+class MemoryTransport(object):
+    # stands in for a worker's socket transport; counts the lines the
+    # proxy writes to it, and discards them
+    __slots__ = ('protocol', 'peername', 'lines', 'closing')
+
+    socket = DummySocket()
+
+    def __init__(self, n):
+        self.protocol = None
+        self.peername = ('10.{}.{}.{}'.format(n >> 16 & 255, n >> 8 & 255, n & 255), 3333)
+        self.lines = 0
+        self.closing = False
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self.peername
+        if name == 'socket':
+            return self.socket
+        return default
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def write(self, data):
+        self.lines += data.count(b'\n')
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            asyncio.get_event_loop().call_soon(self.protocol.connection_lost, None)
+
+
+def connect_worker(proxy, n):
+    transport = MemoryTransport(n)
+    protocol = transport.protocol = StratumStreamProtocol(proxy.workers.handle_connection)
+    protocol.connection_made(transport)
+    authorize = json.dumps({'id': 2, 'method': 'mining.authorize', 'params': ['rig{}'.format(n), 'x']}).encode()
+    protocol.data_received(SUBSCRIBE + authorize + b'\n')
+    return transport
+
+
+async def wait_for_lines(transports, lines, timeout=120):
+    # subscribe and authorize responses, a target and a job
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    while any(t.lines < lines for t in transports):
+        if loop.time() - started > timeout:
+            raise RuntimeError("workers not set up after {}s".format(timeout))
+        await asyncio.sleep(0.05)
+
+
+def traced_memory(snapshot):
+    # everything but what this script allocated (its transports)
+    return sum(s.size for s in snapshot.filter_traces([tracemalloc.Filter(False, __file__)]).statistics('filename'))
+
+
+async def measure(count, protocol, vardiff, top):
+    worker_class, pool_class, pool_kwargs = PROTOCOLS[protocol]
+    pool = await StubPool(**pool_kwargs).start()
+    proxy = Proxy(
+        name='memory', worker_class=worker_class, pool_class=pool_class,
+        listen=[{'host': '127.0.0.1', 'port': 0}], max_workers=65536, vardiff=vardiff,
+        pools=[pool.pool_settings()])
+    await proxy.startup()
+
+    # the first worker gets the pool connected; measured from after it's gone
+    first = connect_worker(proxy, 0)
+    await wait_for_lines([first], 4)
+    first.close()
+    await asyncio.sleep(0.1)
+
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+
+    transports = []
+    for n in range(count):
+        transports.append(connect_worker(proxy, n))
+        if n % 1000 == 999:
+            await asyncio.sleep(0)
+    await wait_for_lines(transports, 4)
+    await asyncio.sleep(0.1)
+
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+
+    per_worker = (traced_memory(after) - traced_memory(before)) / count
+    print("{:>6} workers: {:>8,.0f} bytes per idle worker connection ({} workers connected)".format(
+        count, per_worker, len(proxy.workers.clients)))
+
+    if top:
+        stats = after.filter_traces([tracemalloc.Filter(False, __file__)]).compare_to(
+            before.filter_traces([tracemalloc.Filter(False, __file__)]), 'lineno')
+        for stat in stats[:top]:
+            frame = stat.traceback[0]
+            print("        {:>8,.0f} bytes  {}:{}".format(stat.size_diff / count, frame.filename, frame.lineno))
+
+    for transport in transports:
+        transport.close()
+    await proxy.shutdown()
+    await pool.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('workers', nargs='*', type=int, default=[1000, 10000, 65536])
+    parser.add_argument('--protocol', choices=sorted(PROTOCOLS), default='equihash')
+    parser.add_argument('--vardiff', action='store_true', help="with per-worker variable difficulty")
+    parser.add_argument('--top', type=int, default=0, help="show the top N allocation sites per worker")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    tracemalloc.start()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for count in args.workers:
+        loop.run_until_complete(measure(count, args.protocol, args.vardiff, args.top))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
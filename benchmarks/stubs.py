@@ -0,0 +1,241 @@
+# Local stand-ins for a stratum pool and for miners, used by the benchmark
+# scripts in this directory; everything runs offline on 127.0.0.1.
+
+import asyncio
+import json
+import os
+
+
+def equihash_job(job_id, prevhash='00' * 32, clean_jobs=True):
+    # job_id, version, prevhash, merkleroot, reserved, time, bits, clean_jobs
+    return [job_id, "04000000", prevhash, "11" * 32, "00" * 32, "5a000000", "1f07ffff", clean_jobs]
+
+
+def bitcoin_job(job_id, prevhash='00' * 32, clean_jobs=True):
+    # job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs
+    return [job_id, prevhash, '01000000' + '01' + '00' * 32 + 'ffffffff' + '20', 'ffffffff01' + '00' * 8 + '00' + '00000000',
+            ['22' * 32, '33' * 32], '20000000', '1d00ffff', '5a000000', clean_jobs]
+
+
+class StubPool(object):
+    # A minimal Equihash-flavoured stratum pool: it accepts subscriptions
+    # (handing out `extra_nonce1`), authorizes everyone, accepts every share
+    # (optionally after `submit_delay` seconds) and sends a new job every
+    # `notify_interval` seconds (if set). With `unique_extra_nonce1`, each
+    # connection gets an extra_nonce1 of its own, like real pools hand out.
+    # Bitcoin-flavoured with `job=bitcoin_job, extra_nonce2_size=4,
+    # target_method='mining.set_difficulty'` (and a difficulty as `target`).
+
+    def __init__(self, extra_nonce1='abcd1234', job_prefix='', notify_interval=None,
+                 submit_delay=0, target='0007ffff' + 'f' * 56, unique_extra_nonce1=False,
+                 job=equihash_job, extra_nonce2_size=None, target_method='mining.set_target'):
+        self.job = job
+        self.extra_nonce2_size = extra_nonce2_size
+        self.target_method = target_method
+        self.extra_nonce1 = extra_nonce1
+        self.unique_extra_nonce1 = unique_extra_nonce1
+        self.connection_count = 0
+        self.job_prefix = job_prefix
+        self.notify_interval = notify_interval
+        self.submit_delay = submit_delay
+        # shares are answered in the background (out of order) when delayed
+        self.background_submits = bool(submit_delay)
+        self.target = target
+
+        self.server = None
+        self.writers = set()
+        self.job_count = 0
+        self.current_job = self.next_job()
+        self.notify_fut = None
+
+        self.submits = []
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    def pool_settings(self, name='stub', **kwargs):
+        settings = {'name': name, 'host': '127.0.0.1', 'port': self.port,
+                    'account_name': 'stubaccount', 'account_password': 'x'}
+        settings.update(kwargs)
+        return settings
+
+    def next_job(self):
+        self.job_count += 1
+        job_id = '{}{:08x}'.format(self.job_prefix, self.job_count)
+        return self.job(job_id, prevhash=os.urandom(32).hex())
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        if self.notify_interval:
+            self.notify_fut = asyncio.ensure_future(self.notifier())
+        return self
+
+    async def stop(self):
+        if self.notify_fut:
+            self.notify_fut.cancel()
+        for writer in list(self.writers):
+            writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def send(self, writer, data):
+        writer.write((json.dumps(data) + "\n").encode())
+
+    def notify(self, job=None):
+        self.current_job = job or self.next_job()
+        for writer in list(self.writers):
+            self.send(writer, {'id': None, 'method': 'mining.notify', 'params': self.current_job})
+
+    async def notifier(self):
+        while True:
+            await asyncio.sleep(self.notify_interval)
+            self.notify()
+
+    async def reply(self, writer, msg, extra_nonce1, first_authorize=True):
+        method = msg.get('method')
+        result = True
+        if method == 'mining.subscribe':
+            result = [None, extra_nonce1]
+            if self.extra_nonce2_size is not None:
+                result.append(self.extra_nonce2_size)
+        elif method == 'mining.submit':
+            if self.submit_delay:
+                await asyncio.sleep(self.submit_delay)
+            self.submits.append(msg.get('params'))
+
+        self.send(writer, {'id': msg.get('id'), 'result': result, 'error': None})
+
+        # like real pools, target and job follow a connection's first
+        # authorization (the proxy authorizes every miner account it sees)
+        if method == 'mining.authorize' and first_authorize:
+            self.send(writer, {'id': None, 'method': self.target_method, 'params': [self.target]})
+            self.send(writer, {'id': None, 'method': 'mining.notify', 'params': self.current_job})
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+
+        self.connection_count += 1
+        extra_nonce1 = self.extra_nonce1
+        if self.unique_extra_nonce1:
+            extra_nonce1 = '{}{:04x}'.format(extra_nonce1, self.connection_count)
+        authorized = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line.decode())
+                if msg.get('method') == 'mining.submit' and self.background_submits:
+                    asyncio.ensure_future(self.reply(writer, msg, extra_nonce1))
+                else:
+                    await self.reply(writer, msg, extra_nonce1, not authorized)
+                if msg.get('method') == 'mining.authorize':
+                    authorized = True
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+
+class SimulatedMiner(object):
+    # A miner connection; subscribes, authorizes, keeps track of the jobs
+    # it's been sent and can submit (fake) Equihash shares.
+
+    def __init__(self, host, port, account_name='stubaccount.rig'):
+        self.host = host
+        self.port = port
+        self.account_name = account_name
+
+        self.reader = self.writer = None
+        self.next_id = 0
+        self.pending = {}
+        self.read_fut = None
+
+        self.extra_nonce1 = None
+        self.extra_nonce2_size = None
+        self.target = None
+        self.jobs = []
+        self.notify_times = []
+        self.job_received = None
+        self.nonce = 0
+
+    @property
+    def job_id(self):
+        return self.jobs[-1][0] if self.jobs else None
+
+    async def connect(self):
+        self.job_received = asyncio.Event()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.read_fut = asyncio.ensure_future(self.read())
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+        if self.read_fut:
+            self.read_fut.cancel()
+
+    async def read(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            msg = json.loads(line.decode())
+            fut = self.pending.pop(msg.get('id'), None)
+            if fut is not None:
+                if not fut.done():
+                    fut.set_result(msg)
+            elif msg.get('method') == 'mining.notify':
+                self.jobs.append(msg['params'])
+                self.notify_times.append(loop.time())
+                self.job_received.set()
+            elif msg.get('method') in ('mining.set_target', 'mining.set_difficulty'):
+                self.target = msg['params'][0]
+            elif msg.get('method') == 'mining.set_extranonce':
+                self.extra_nonce1 = msg['params'][0]
+
+        for fut in self.pending.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError('disconnected'))
+
+    async def call(self, method, params):
+        self.next_id += 1
+        fut = asyncio.get_event_loop().create_future()
+        self.pending[self.next_id] = fut
+        self.writer.write((json.dumps({'id': self.next_id, 'method': method, 'params': params}) + "\n").encode())
+        return await fut
+
+    async def subscribe(self):
+        msg = await self.call('mining.subscribe', [])
+        self.extra_nonce1 = msg['result'][1]
+        if len(msg['result']) > 2:
+            self.extra_nonce2_size = msg['result'][2]
+        return msg
+
+    async def authorize(self):
+        return await self.call('mining.authorize', [self.account_name, 'x'])
+
+    async def start(self):
+        await self.connect()
+        await self.subscribe()
+        await self.authorize()
+        return self
+
+    async def submit(self, job_id=None):
+        self.nonce += 1
+        if self.extra_nonce2_size is not None:
+            # Bitcoin-flavoured; extranonce2, the job's ntime and a nonce
+            job = self.jobs[-1]
+            return await self.call('mining.submit', [
+                self.account_name, job_id or self.job_id, '{:x}'.format(self.nonce).zfill(2 * self.extra_nonce2_size),
+                job[7], '{:08x}'.format(self.nonce & 0xffffffff)])
+
+        # nonce2 fills the 32 byte nonce less what's taken by extra_nonce1
+        nonce2 = '{:x}'.format(self.nonce).zfill(64 - len(self.extra_nonce1))
+        return await self.call('mining.submit', [
+            self.account_name, job_id or self.job_id, '5a000000', nonce2, 'fd4005' + '00' * 1344])
+
+    async def wait_for_job(self, timeout=10):
+        await asyncio.wait_for(self.job_received.wait(), timeout)